@@ -0,0 +1,477 @@
+"""
+Benchmark suite. Measures the migrator's throughput against local stand-ins for mapmyride and strava, so neither the real services nor the real quota are touched.
+
+  - `stand_in_server`: a local HTTP server mimicking every mapmyride and strava endpoint the migrator talks to
+  - `run_account()`: migrates a synthetic account against the stand-ins. Meant to be run on its own process, so its peak memory usage can be measured
+  - `main()`: runs the migrator for each requested account size, then reports its throughput
+
+Usage: benchmark.py [--sizes=100,1000,10000] [--latency=5] [--gzip] [--trackpoints=200] [--rate-429=0] [--rate-500=0.01] [--rate-download-500=0] [--window=10]
+                    [--short-limit=N] [--apps=1] [--mode=full|download] [--json=results.json] [-- migrator flags]
+
+Anything after a lone `--` is passed onto the migrator as is. i.e. `benchmark.py --sizes=1000 -- --pipeline --download-workers=8`
+"""
+import email.parser
+import email.policy
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from helpers import get_argument_value
+
+TCX_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities>
+    <Activity Sport="Biking">
+      <Id>{start}</Id>
+      <Lap StartTime="{start}">
+        <TotalTimeSeconds>{duration}</TotalTimeSeconds>
+        <DistanceMeters>{distance}</DistanceMeters>
+        <Track>
+{trackpoints}
+        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+"""
+TRACKPOINT_TEMPLATE = """          <Trackpoint>
+            <Time>{time}</Time>
+            <Position><LatitudeDegrees>{lat:.6f}</LatitudeDegrees><LongitudeDegrees>{lon:.6f}</LongitudeDegrees></Position>
+            <DistanceMeters>{distance:.1f}</DistanceMeters>
+            <HeartRateBpm><Value>{heart_rate}</Value></HeartRateBpm>
+          </Trackpoint>"""
+
+class stand_in_server(ThreadingHTTPServer): # pylint: disable=too-many-instance-attributes
+  """
+  #### Description
+  A local HTTP server standing in for both mapmyride and strava, serving synthetic accounts.
+
+  #### Notes
+  Strava's endpoints answer with realistic `x-ratelimit-*` headers, accounted on clock-aligned windows just like strava's, and replying `429` once the short window's limit is reached.
+  On top of that, uploads can be made to randomly fail with `429` or `500` errors, and TCX downloads with `500` errors.
+
+  Every byte read from or written onto a socket is counted, so the data moved by each run can be reported.
+  """
+  daemon_threads = True
+  daily_window = 86400
+
+  def __init__(self, latency: float = 0, compress: bool = False, trackpoints: int = 200, rate_429: float = 0, rate_500: float = 0, # pylint: disable=too-many-arguments,too-many-positional-arguments
+               rate_download_500: float = 0, window: int = 900, short_limit: int = 100000, daily_limit: int = 1000000):
+    """
+    #### Description
+    Builds a new stand-in server, listening on a random local port
+    #### Parameters
+    - `latency`: Seconds to wait before answering each request
+    - `compress`: Whether to serve the CSV and TCX files gzip-compressed, as mapmyride does
+    - `trackpoints`: Trackpoints on each synthetic workout
+    - `rate_429`: Share of uploads to fail with a `429`, between `0` and `1`
+    - `rate_500`: Share of uploads to fail with a `500`, between `0` and `1`
+    - `rate_download_500`: Share of TCX downloads to fail with a `500`, between `0` and `1`
+    - `window`: Length of the short ratelimit window, in seconds. Strava's is 900
+    - `short_limit`: Requests allowed on each short window, to each API application
+    - `daily_limit`: Requests allowed every day, to each API application
+    """
+    super().__init__(("127.0.0.1", 0), stand_in_handler)
+    self.latency = latency
+    self.compress = compress
+    self.trackpoints = trackpoints
+    self.rate_429 = rate_429
+    self.rate_500 = rate_500
+    self.rate_download_500 = rate_download_500
+    self.window = window
+    self.short_limit = short_limit
+    self.daily_limit = daily_limit
+    self.lock = threading.Lock()
+    self.random = random.Random(0)
+    self.workouts = 0
+    self.reset()
+
+  def handle_error(self, request, client_address):
+    """
+    Connections dropped by the migrator, i.e. once it exits, are expected, so they aren't reported
+    """
+    if not isinstance(sys.exc_info()[1], ConnectionError):
+      super().handle_error(request, client_address)
+
+  @property
+  def base_url(self) -> str:
+    """
+    The server's base URL
+    """
+    return f"http://127.0.0.1:{self.server_address[1]}"
+
+  def reset(self, workouts: int = 0):
+    """
+    #### Description
+    Starts serving a new synthetic account, clearing all counters
+    #### Parameters
+    - `workouts`: Amount of workouts on the account
+    """
+    with self.lock:
+      self.workouts = workouts
+      self.tokens = {} # Access token issued -> the API application it was issued to
+      self.quotas = {} # API application -> its [short usage, short reset, daily usage, daily reset]
+      self.uploads = 0
+      self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "uploads": 0, "polls": 0, "injected_429": 0, "injected_500": 0, "injected_download_500": 0, "ratelimited": 0}
+
+  def count(self, **amounts):
+    """
+    #### Description
+    Adds to the server's counters
+    """
+    with self.lock:
+      for key, amount in amounts.items():
+        self.stats[key] += amount
+
+  def issue_token(self, client_id: str) -> str:
+    """
+    #### Description
+    Issues a new access token to an API application
+    #### Parameters
+    - `client_id`: The application's client id
+    """
+    with self.lock:
+      token = f"bench-{client_id}-{self.workouts}-{time.time()}"
+      self.tokens[token] = client_id
+      return token
+
+  def take_quota(self, client_id: str) -> tuple:
+    """
+    #### Description
+    Accounts a request to strava's API against an API application's ratelimit, as strava does
+    #### Parameters
+    - `client_id`: The application's client id. Requests without a valid token are accounted on their own
+    #### Returns
+    - A tuple containing whether the request is within the limits, and the `x-ratelimit-*` headers to reply with
+    """
+    with self.lock:
+      now = time.time()
+      quota = self.quotas.setdefault(client_id, [0, 0, 0, 0])
+      if now >= quota[1]:
+        quota[0], quota[1] = 0, (now // self.window + 1) * self.window
+      if now >= quota[3]:
+        quota[2], quota[3] = 0, (now // self.daily_window + 1) * self.daily_window
+      allowed = quota[0] < self.short_limit and quota[2] < self.daily_limit
+      if allowed:
+        quota[0] += 1
+        quota[2] += 1
+      else:
+        self.stats["ratelimited"] += 1
+      return allowed, {"x-ratelimit-limit": f"{self.short_limit},{self.daily_limit}", "x-ratelimit-usage": f"{quota[0]},{quota[2]}"}
+
+  def inject_error(self, download: bool = False) -> int:
+    """
+    #### Description
+    Rolls the dice on failing a request
+    #### Parameters
+    - `download`: Whether it's a TCX download, instead of an upload
+    #### Returns
+    - The status code to fail with, or `0` if it shouldn't fail
+    """
+    with self.lock:
+      roll = self.random.random()
+      if download:
+        if roll < self.rate_download_500:
+          self.stats["injected_download_500"] += 1
+          return 500
+        return 0
+      if roll < self.rate_429:
+        self.stats["injected_429"] += 1
+        return 429
+      if roll < self.rate_429 + self.rate_500:
+        self.stats["injected_500"] += 1
+        return 500
+    return 0
+
+  def csv_file(self) -> bytes:
+    """
+    #### Description
+    Builds the account's workout list, laid out like mapmyride's CSV export
+    """
+    header = ["Date Submitted", "Workout Date", "Activity Type", "Calories Burned (kCal)", "Distance (km)", "Workout Time (seconds)",
+              "Avg Pace (min/km)", "Max Pace (min/km)", "Avg Speed (km/h)", "Max Speed (km/h)", "Avg Heart Rate", "Steps", "Notes", "Source", "Link"]
+    rows = [",".join(header)]
+    for workout_id in range(1, self.workouts + 1):
+      # Dated as per the workout's TCX file, which starts an hour after the previous one
+      date = time.strftime("%b. %d, %Y", time.gmtime(1600000000 + workout_id * 3600)).replace(" 0", " ")
+      rows.append(f"\"{date}\",\"{date}\",Road Cycling,500,20.0,3600,3,2,20,40,140,,\"b'Workout {workout_id}'\",,"
+                  f"http://www.mapmyfitness.com/workout/{1000000 + workout_id}/")
+    return ("\n".join(rows) + "\n").encode("utf8")
+
+  def tcx_file(self, workout_id: int) -> bytes:
+    """
+    #### Description
+    Builds a synthetic TCX workout, starting an hour apart from the previous one
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    """
+    start = 1600000000 + (workout_id - 1000000) * 3600 # Matching its date on the CSV file, where ids are numbered from 1000001
+    points = [TRACKPOINT_TEMPLATE.format(time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start + i)), lat=40 + i / 1e5, lon=-3 - i / 1e5,
+                                         distance=i * 5.0, heart_rate=120 + i % 40) for i in range(self.trackpoints)]
+    return TCX_TEMPLATE.format(start=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start)), duration=self.trackpoints,
+                               distance=self.trackpoints * 5.0, trackpoints="\n".join(points)).encode("utf8")
+
+class stand_in_handler(BaseHTTPRequestHandler):
+  """
+  #### Description
+  Request handler for the stand-in server, routing each request to the endpoint it mimics
+  """
+  protocol_version = "HTTP/1.1" # Keep-alive, as both mapmyride and strava allow
+
+  def log_message(self, format, *args): # pylint: disable=redefined-builtin
+    """
+    Requests aren't logged, or the benchmark would be measuring the terminal
+    """
+
+  def reply(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: dict = None, compress: bool = False):
+    """
+    #### Description
+    Sends a response, accounting for its size
+    """
+    if compress:
+      body = gzip.compress(body, compresslevel=6)
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    if compress:
+      self.send_header("Content-Encoding", "gzip")
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.count(bytes_out=len(body) + 200) # Roughly, for the status line and headers
+
+  def read_body(self) -> bytes:
+    """
+    #### Description
+    Reads the request's body, either sized by its `Content-Length` or chunked, accounting for its size
+    """
+    if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+      chunks = []
+      while (size := int(self.rfile.readline().split(b";")[0], 16)) > 0:
+        chunks.append(self.rfile.read(size))
+        self.rfile.readline()
+      while self.rfile.readline() not in (b"\r\n", b"\n", b""): # Trailers, if any
+        pass
+      body = b"".join(chunks)
+    else:
+      body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+    self.server.count(requests=1, bytes_in=len(body) + len(str(self.headers)))
+    return body
+
+  def valid_upload(self, body: bytes) -> bool:
+    """
+    #### Description
+    Checks an upload's body is well-formed `multipart/form-data`, holding a file matching its `data_type`, as strava would
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("utf8") + body)
+    if not message.is_multipart():
+      return False
+    parts = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True) for part in message.iter_parts()}
+    data_type = (parts.get("data_type") or b"").decode("utf8")
+    if data_type not in ("tcx", "tcx.gz", "fit", "fit.gz") or not parts.get("file"):
+      return False
+    try:
+      data = gzip.decompress(parts["file"]) if data_type.endswith(".gz") else parts["file"]
+    except (OSError, EOFError):
+      return False
+    return data[8:12] == b".FIT" if data_type.startswith("fit") else data.lstrip().startswith(b"<?xml")
+
+  def client(self) -> str:
+    """
+    The API application the request's access token was issued to. An empty string if it wasn't issued by /oauth/token
+    """
+    return self.server.tokens.get(self.headers.get("Authorization", "").removeprefix("Bearer "), "")
+
+  def do_GET(self):
+    """
+    Routes GET requests
+    """
+    self.read_body()
+    time.sleep(self.server.latency)
+    path = self.path.split("?")[0]
+    client = self.client()
+
+    if path == "/workout/export/csv":
+      self.reply(200, self.server.csv_file(), content_type="text/csv", compress=self.server.compress)
+    elif (match := re.fullmatch(r"/workout/export/(\d+)/+tcx", path)):
+      if self.server.inject_error(download=True):
+        self.reply(500, b"Injected error", content_type="text/plain")
+        return
+      self.reply(200, self.server.tcx_file(int(match.group(1))), content_type="application/vnd.garmin.tcx+xml", compress=self.server.compress)
+    elif path == "/api/v3/athlete":
+      # Only the token issued by /oauth/token is valid, so the token refresh is exercised too
+      _, headers = self.server.take_quota(client)
+      self.reply(200 if client else 401, b'{"id": 1}', headers=headers)
+    elif path == "/api/v3/athlete/activities":
+      _, headers = self.server.take_quota(client)
+      self.reply(200, b"[]", headers=headers)
+    elif (match := re.fullmatch(r"/api/v3/uploads/(\d+)", path)):
+      allowed, headers = self.server.take_quota(client)
+      self.server.count(polls=1)
+      upload_id = int(match.group(1))
+      body = json.dumps({"id": upload_id, "status": "Your activity is ready.", "error": None, "activity_id": upload_id + 1000000})
+      self.reply(200 if allowed else 429, body.encode("utf8"), headers=headers)
+    else:
+      self.reply(404)
+
+  def do_POST(self):
+    """
+    Routes POST requests
+    """
+    request_body = self.read_body()
+    time.sleep(self.server.latency)
+
+    if self.path == "/oauth/token":
+      client_id = urllib.parse.parse_qs(request_body.decode("utf8")).get("client_id", [""])[0]
+      body = {"access_token": self.server.issue_token(client_id), "refresh_token": "bench-refresh", "expires_at": int(time.time()) + 21600, "expires_in": 21600}
+      self.reply(200, json.dumps(body).encode("utf8"))
+    elif self.path == "/api/v3/uploads":
+      allowed, headers = self.server.take_quota(self.client())
+      if not self.valid_upload(request_body):
+        self.reply(400, b'{"message": "Bad Request", "errors": [{"resource": "Upload", "field": "file", "code": "invalid"}]}', headers=headers)
+        return
+      status = self.server.inject_error() if allowed else 429
+      if status:
+        self.reply(status, b'{"message": "Injected error"}', headers=headers)
+        return
+      with self.server.lock:
+        self.server.uploads += 1
+        upload_id = self.server.uploads
+      self.server.count(uploads=1)
+      self.reply(201, json.dumps({"id": upload_id, "status": "Your activity is still being processed."}).encode("utf8"), headers=headers)
+    else:
+      self.reply(404)
+
+def run_account(workdir: str, migrator_args: list, window: int, mode: str, results: multiprocessing.Queue, apps: int = 1): # pylint: disable=too-many-arguments,too-many-positional-arguments
+  """
+  #### Description
+  Migrates a synthetic account against the stand-ins, reporting how long it took and its peak memory usage. Meant to be run on its own process.
+
+  #### Parameters
+    - `workdir`: Directory where to keep the account's secrets file, workouts and log
+    - `migrator_args`: Flags to run the migrator with
+    - `window`: Length of the stand-in's short ratelimit window, in seconds
+    - `mode`: `full` to run the whole migrator, or `download` to only download workouts through the `helpers` functions
+    - `results`: Queue to put the results onto
+    - `apps`: Amount of strava API applications to spread requests across, each with its own secrets file
+  """
+  started_at = time.perf_counter()
+  result, counts, wall_time = False, {}, 0.0
+  log_file = open(f"{workdir}/migrator.log", mode="w", encoding="utf8") # pylint: disable=consider-using-with
+  try:
+    # Imported here, so the stand-ins' base URLs are already set on the environment
+    import helpers # pylint: disable=import-outside-toplevel
+    import migrator # pylint: disable=import-outside-toplevel
+    from strava_ratelimiter import strava_ratelimiter # pylint: disable=import-outside-toplevel
+    from workout_ledger import workout_ledger # pylint: disable=import-outside-toplevel
+
+    strava_ratelimiter.short_window = window
+    output_dir = f"{workdir}/outputs"
+    os.makedirs(f"{output_dir}/archive", exist_ok=True)
+    secrets_files = [f"{workdir}/secrets-{app}.json" for app in range(apps)]
+    for app, secrets_file in enumerate(secrets_files):
+      with open(secrets_file, mode="w", encoding="utf8") as file:
+        # The access token is stale, so it gets refreshed as usual
+        file.write(json.dumps({"client_id": f"bench-{app}", "client_secret": "bench", "access_token": "stale", "refresh_token": "bench-refresh",
+                               "athlete_id": 1}))
+
+    sys.stdout = log_file
+    started_at = time.perf_counter()
+    result = True
+    try:
+      if mode == "download":
+        ledger = workout_ledger(workouts_dir=output_dir)
+        result, csv_file = helpers.get_mmr_csv_file(headers=(("Cookie", "bench"),), workdir=output_dir)
+        result = result and helpers.download_mmr_workouts(headers=(("Cookie", "bench"),), output_dir=output_dir,
+                                                          workout_list=helpers.list_mmr_workouts(csv_file_path=csv_file), ledger=ledger,
+                                                          workers=int(get_argument_value(migrator_args, "--download-workers", "--download-workers=") or 1),
+                                                          compress="--gzip" in migrator_args)
+        ledger.close()
+      else:
+        migrator.main(["migrator.py", "--mmr-cookie=bench", f"--output-dir={output_dir}", f"--secrets-file={','.join(secrets_files)}"] + migrator_args)
+    except SystemExit as e:
+      result = e.code == 0
+    finally:
+      sys.stdout = sys.__stdout__
+    wall_time = time.perf_counter() - started_at
+
+    ledger = workout_ledger(workouts_dir=output_dir)
+    counts = ledger.counts()
+    ledger.close()
+  except Exception: # pylint: disable=broad-exception-caught
+    # A crashed run is reported as failed, instead of leaving the benchmark waiting on it forever
+    traceback.print_exc(file=log_file)
+    traceback.print_exc()
+    result = False
+  finally:
+    sys.stdout = sys.__stdout__
+    log_file.close()
+    results.put({"result": result, "wall_time": wall_time or time.perf_counter() - started_at, "workouts": counts,
+                 "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}) # ru_maxrss is in KiB on linux
+
+def main(args: list):
+  """
+  Runs the benchmark
+  """
+  migrator_args = args[args.index("--") + 1:] if "--" in args else []
+  args = args[:args.index("--")] if "--" in args else args
+
+  sizes = [int(size) for size in (get_argument_value(args, "--sizes", "--sizes=") or "100,1000,10000").split(",")]
+  mode = get_argument_value(args, "--mode", "--mode=") or "full"
+  window = int(get_argument_value(args, "--window", "--window=") or 10)
+  apps = int(get_argument_value(args, "--apps", "--apps=") or 1)
+  server = stand_in_server(latency=float(get_argument_value(args, "--latency", "--latency=") or 5) / 1000,
+                           compress="--gzip" in args,
+                           trackpoints=int(get_argument_value(args, "--trackpoints", "--trackpoints=") or 200),
+                           rate_429=float(get_argument_value(args, "--rate-429", "--rate-429=") or 0),
+                           rate_500=float(get_argument_value(args, "--rate-500", "--rate-500=") or 0.01),
+                           rate_download_500=float(get_argument_value(args, "--rate-download-500", "--rate-download-500=") or 0),
+                           window=window,
+                           short_limit=int(get_argument_value(args, "--short-limit", "--short-limit=") or 100000))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  # Accounts are migrated on their own processes, which inherit these, so the migrator talks to the stand-ins
+  os.environ["MMR_BASE_URL"] = server.base_url
+  os.environ["STRAVA_BASE_URL"] = server.base_url
+
+  print(f"🏁 Benchmarking \"{mode}\" mode against stand-ins at {server.base_url}, with flags: {' '.join(migrator_args) or 'none'}\n")
+  print(f"{'workouts':>9} | {'result':>6} | {'wall (s)':>9} | {'workouts/s':>10} | {'MB in':>8} | {'MB out':>8} | {'peak RSS (MB)':>13} | {'429s':>5} | {'500s':>5}")
+  print("-" * 100)
+
+  context = multiprocessing.get_context("spawn")
+  report = []
+  for size in sizes:
+    server.reset(workouts=size)
+    with tempfile.TemporaryDirectory(prefix=f"benchmark-{size}-") as workdir:
+      results = context.Queue()
+      process = context.Process(target=run_account, args=(workdir, migrator_args, window, mode, results, apps))
+      process.start()
+      run = results.get()
+      process.join()
+
+    done = sum(run["workouts"].get(status, 0) for status in (("downloaded",) if mode == "download" else ("uploaded", "processed")))
+    run.update(size=size, done=done, throughput=done / run["wall_time"], **server.stats)
+    report.append(run)
+    print(f"{size:>9} | {'✅' if run['result'] else '❌':>5} | {run['wall_time']:>9.2f} | {run['throughput']:>10.1f} | {run['bytes_out'] / 1e6:>8.2f} | "
+          f"{run['bytes_in'] / 1e6:>8.2f} | {run['peak_rss'] / 1e6:>13.1f} | {run['injected_429'] + run['ratelimited']:>5} | {run['injected_500'] + run['injected_download_500']:>5}")
+
+  print("\nMB in/out are from the migrator's side: downloaded from, and uploaded to, the stand-ins")
+  json_file = get_argument_value(args, "--json", "--json=")
+  if json_file:
+    with open(json_file, mode="w", encoding="utf8") as file:
+      file.write(json.dumps({"mode": mode, "migrator_args": migrator_args, "runs": report}, indent=2))
+  server.shutdown()
+
+if __name__ == "__main__":
+  main(sys.argv)
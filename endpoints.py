@@ -0,0 +1,11 @@
+"""
+This module contains the base URLs of the services this program talks to.
+
+Both can be overridden through environment variables, i.e. to point this program at local stand-ins for benchmarking:
+  - `MMR_BASE_URL`: mapmyride's website. Defaults to `https://www.mapmyfitness.com`
+  - `STRAVA_BASE_URL`: strava's website and API. Defaults to `https://www.strava.com`
+"""
+import os
+
+MMR_BASE_URL = os.environ.get("MMR_BASE_URL", "https://www.mapmyfitness.com").rstrip("/")
+STRAVA_BASE_URL = os.environ.get("STRAVA_BASE_URL", "https://www.strava.com").rstrip("/")
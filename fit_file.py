@@ -0,0 +1,316 @@
+"""
+This module contains the encoder and decoder for FIT files, the compact binary format workouts get converted to before being uploaded, when asked to.
+
+  - `fit_crc()`: calculates the CRC every FIT file's header and body are checked with
+  - `encode_fit()`: encodes an activity onto a FIT file
+  - `decode_fit()`: decodes a FIT file written by `encode_fit()` back onto an activity
+  - `verify_fit()`: checks a FIT file holds everything on the activity it was encoded from
+
+Activities are `dict`s holding the activity's `sport`, as a FIT sport number, and its `laps`. Each lap is a `dict` with its `start` time, as a unix timestamp, its `elapsed` seconds,
+its `distance` in meters, `calories`, `max_speed` in m/s, `avg_hr`, `max_hr` and `avg_cadence`, plus its `records`. Each record is a `dict` with its `time`, `lat` and `lon` in degrees,
+`altitude` and `distance` in meters, `heart_rate`, `cadence`, `speed` in m/s and `power` in watts. All but the times may be `None`, or missing.
+
+Only the messages strava needs to import an activity are written: `file_id`, `event`, `record`, `lap`, `session` and `activity`, as defined by the FIT SDK's profile.
+
+For more details onto each function, these are also docstring'd.
+"""
+import struct
+
+FIT_EPOCH = 631065600 # 1989-12-31T00:00:00Z, which FIT timestamps count from, as a unix timestamp
+SEMICIRCLES = 2 ** 31 / 180 # Semicircles per degree, the unit FIT positions are stored in
+
+# Base type -> (base type number, struct format, minimum valid value, invalid value). Invalid values are each type's maximum
+BASE_TYPES = {
+  "enum": (0x00, "B", 0, 0xFF),
+  "uint8": (0x02, "B", 0, 0xFF),
+  "uint16": (0x84, "H", 0, 0xFFFF),
+  "sint32": (0x85, "i", -0x80000000, 0x7FFFFFFF),
+  "uint32": (0x86, "I", 0, 0xFFFFFFFF)
+}
+BASE_TYPE_NUMBERS = {number: name for name, (number, _, _, _) in BASE_TYPES.items()}
+
+# Message name -> (global message number, fields). Each field as (key, field number, base type, scale, offset), stored as round((value + offset) * scale)
+MESSAGES = {
+  "file_id": (0, (
+    ("type", 0, "enum", 1, 0),
+    ("manufacturer", 1, "uint16", 1, 0),
+    ("product", 2, "uint16", 1, 0),
+    ("time_created", 4, "uint32", 1, -FIT_EPOCH)
+  )),
+  "event": (21, (
+    ("time", 253, "uint32", 1, -FIT_EPOCH),
+    ("event", 0, "enum", 1, 0),
+    ("event_type", 1, "enum", 1, 0)
+  )),
+  "record": (20, (
+    ("time", 253, "uint32", 1, -FIT_EPOCH),
+    ("lat", 0, "sint32", SEMICIRCLES, 0),
+    ("lon", 1, "sint32", SEMICIRCLES, 0),
+    ("altitude", 2, "uint16", 5, 500),
+    ("heart_rate", 3, "uint8", 1, 0),
+    ("cadence", 4, "uint8", 1, 0),
+    ("distance", 5, "uint32", 100, 0),
+    ("speed", 6, "uint16", 1000, 0),
+    ("power", 7, "uint16", 1, 0)
+  )),
+  "lap": (19, (
+    ("end", 253, "uint32", 1, -FIT_EPOCH),
+    ("event", 0, "enum", 1, 0),
+    ("event_type", 1, "enum", 1, 0),
+    ("start", 2, "uint32", 1, -FIT_EPOCH),
+    ("elapsed", 7, "uint32", 1000, 0),
+    ("timer", 8, "uint32", 1000, 0),
+    ("distance", 9, "uint32", 100, 0),
+    ("calories", 11, "uint16", 1, 0),
+    ("max_speed", 14, "uint16", 1000, 0),
+    ("avg_hr", 15, "uint8", 1, 0),
+    ("max_hr", 16, "uint8", 1, 0),
+    ("avg_cadence", 17, "uint8", 1, 0)
+  )),
+  "session": (18, (
+    ("end", 253, "uint32", 1, -FIT_EPOCH),
+    ("event", 0, "enum", 1, 0),
+    ("event_type", 1, "enum", 1, 0),
+    ("start", 2, "uint32", 1, -FIT_EPOCH),
+    ("sport", 5, "enum", 1, 0),
+    ("elapsed", 7, "uint32", 1000, 0),
+    ("timer", 8, "uint32", 1000, 0),
+    ("distance", 9, "uint32", 100, 0),
+    ("calories", 11, "uint16", 1, 0),
+    ("first_lap_index", 25, "uint16", 1, 0),
+    ("num_laps", 26, "uint16", 1, 0)
+  )),
+  "activity": (34, (
+    ("end", 253, "uint32", 1, -FIT_EPOCH),
+    ("timer", 0, "uint32", 1000, 0),
+    ("num_sessions", 1, "uint16", 1, 0),
+    ("type", 2, "enum", 1, 0),
+    ("event", 3, "enum", 1, 0),
+    ("event_type", 4, "enum", 1, 0)
+  ))
+}
+MESSAGE_NAMES = {number: name for name, (number, _) in MESSAGES.items()}
+
+def crc_table() -> list:
+  """
+  #### Description
+  Builds the lookup table for FIT's CRC-16, which is CRC-16/ARC, so it's calculated a byte at a time
+  """
+  table = []
+  for crc in range(256):
+    for _ in range(8):
+      crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    table.append(crc)
+  return table
+
+CRC_TABLE = crc_table()
+
+def fit_crc(data: bytes, crc: int = 0) -> int:
+  """
+  #### Description
+  Calculates the CRC-16 FIT files are checked with.
+
+  #### Parameters
+    - `data`: The bytes to check
+    - `crc`: The CRC of any bytes preceding them. Defaults to `0`
+
+  #### Returns
+    - The `CRC`. Checking a whole file, including its trailing CRC, gives `0` if it's intact
+  """
+  for byte in data:
+    crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+  return crc
+
+def fit_value(field: tuple, value: float) -> int:
+  """
+  #### Description
+  Scales a value onto the integer a field stores it as, or onto its base type's invalid value if it's missing or out of its range
+  """
+  _, _, base_type, scale, offset = field
+  _, _, minimum, invalid = BASE_TYPES[base_type]
+  if value is None:
+    return invalid
+  stored = round((value + offset) * scale)
+  return stored if minimum <= stored < invalid else invalid
+
+def encode_fit(activity: dict) -> bytes:
+  """
+  #### Description
+  Encodes an activity onto a FIT activity file.
+
+  #### Parameters
+    - `activity`: The activity, as described on this module's docstring. It must have at least a lap
+
+  #### Returns
+    - The FIT file's `bytes`
+
+  #### Notes
+  Each message type is defined once, with a local message type of its own, right before its first message. Records are defined with only those fields set on any of them,
+  so workouts without i.e. power readings don't carry an invalid value on each record.
+
+  Values out of a field's range, like altitudes above 12,607 meters, are written as invalid. That's caught by comparing the result against the activity with `decode_fit()`.
+  """
+  laps = activity["laps"]
+  records = [record for lap in laps for record in lap["records"]]
+  if not laps:
+    raise ValueError("No laps to encode")
+  start = min([lap["start"] for lap in laps] + [record["time"] for record in records[:1]])
+  end = max([lap["start"] + (lap.get("elapsed") or 0) for lap in laps] + [record["time"] for record in records[-1:]])
+  body = bytearray()
+  definitions = {} # Message name -> (local message type, fields, struct)
+
+  def write(name: str, values: dict):
+    if name not in definitions:
+      global_number, fields = MESSAGES[name]
+      if name == "record":
+        fields = tuple(field for field in fields if field[0] == "time" or any(record.get(field[0]) is not None for record in records))
+      local_type = len(definitions)
+      definitions[name] = (local_type, fields, struct.Struct("<B" + "".join(BASE_TYPES[field[2]][1] for field in fields)))
+      body.extend(struct.pack("<BBBHB", 0x40 | local_type, 0, 0, global_number, len(fields)))
+      for _, number, base_type, _, _ in fields:
+        base_type_number, fmt, _, _ = BASE_TYPES[base_type]
+        body.extend(struct.pack("<BBB", number, struct.calcsize(fmt), base_type_number))
+    local_type, fields, message = definitions[name]
+    body.extend(message.pack(local_type, *(fit_value(field, values.get(field[0])) for field in fields)))
+
+  write("file_id", {"type": 4, "manufacturer": 255, "product": 0, "time_created": start}) # Activity file, made by a development manufacturer
+  write("event", {"time": start, "event": 0, "event_type": 0}) # Timer started
+  for lap in laps:
+    for record in lap["records"]:
+      write("record", record)
+    write("lap", dict(lap, end=lap["start"] + (lap.get("elapsed") or 0), timer=lap.get("elapsed"), event=9, event_type=1))
+  write("event", {"time": end, "event": 0, "event_type": 4}) # Timer stopped for good
+
+  def total(key: str) -> float:
+    values = [lap[key] for lap in laps if lap.get(key) is not None]
+    return sum(values) if values else None
+
+  write("session", {"end": end, "event": 8, "event_type": 1, "start": start, "sport": activity.get("sport", 0), "elapsed": end - start, "timer": total("elapsed"),
+                    "distance": total("distance"), "calories": total("calories"), "first_lap_index": 0, "num_laps": len(laps)})
+  write("activity", {"end": end, "timer": total("elapsed"), "num_sessions": 1, "type": 0, "event": 26, "event_type": 1})
+
+  header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(body), b".FIT")
+  header += struct.pack("<H", fit_crc(header))
+  return header + body + struct.pack("<H", fit_crc(body, fit_crc(header)))
+
+def decode_fit(data: bytes) -> dict:
+  """
+  #### Description
+  Decodes a FIT activity file back onto an activity.
+
+  #### Parameters
+    - `data`: The FIT file's `bytes`
+
+  #### Returns
+    - The activity, as described on this module's docstring. Fields the file doesn't have, or has as invalid, are `None`
+
+  #### Notes
+  It's meant to check what `encode_fit()` writes, so it only reads the messages and fields it writes. Any others, including developer fields, are skipped over.
+  Records are assigned to the lap following them, as FIT activity files lay them out. Both header and file CRCs are checked.
+
+  Raises a `ValueError` if the file isn't a FIT file, is corrupt, or uses compressed timestamp headers, which `encode_fit()` never writes.
+  """
+  if len(data) < 12 or data[8:12] != b".FIT":
+    raise ValueError("Not a FIT file")
+  header_size, _, _, body_size = struct.unpack_from("<BBHI", data)
+  end = header_size + body_size
+  if len(data) < end + 2:
+    raise ValueError("FIT file is truncated")
+  if header_size >= 14 and data[12:14] != b"\x00\x00" and fit_crc(data[:14]) != 0:
+    raise ValueError("FIT file's header CRC doesn't match")
+  if fit_crc(data[:end + 2]) != 0:
+    raise ValueError("FIT file's CRC doesn't match")
+
+  definitions = {} # Local message type -> (message name, fields, struct)
+  activity = {"sport": None, "laps": []}
+  records = []
+  position = header_size
+  while position < end:
+    record_header = data[position]
+    position += 1
+    if record_header & 0x80:
+      raise ValueError("Compressed timestamp headers aren't supported")
+    local_type = record_header & 0x0F
+
+    if record_header & 0x40: # Definition message
+      _, architecture, field_count = struct.unpack_from("<BBxxB", data, position)
+      endian = ">" if architecture else "<"
+      global_number = struct.unpack_from(f"{endian}H", data, position + 2)[0]
+      position += 5
+      name = MESSAGE_NAMES.get(global_number)
+      known = {field[1]: field for field in MESSAGES[name][1]} if name else {}
+      fields, fmt = [], endian
+      for _ in range(field_count):
+        number, size, base_type_number = struct.unpack_from("<BBB", data, position)
+        position += 3
+        base_type = BASE_TYPE_NUMBERS.get(base_type_number)
+        if number in known and base_type and struct.calcsize(BASE_TYPES[base_type][1]) == size:
+          fields.append((known[number], base_type))
+          fmt += BASE_TYPES[base_type][1]
+        else:
+          fmt += f"{size}x"
+      if record_header & 0x20: # Developer fields, skipped over
+        developer_count = data[position]
+        fmt += "".join(f"{size}x" for size in data[position + 2:position + 1 + developer_count * 3:3])
+        position += 1 + developer_count * 3
+      definitions[local_type] = (name, fields, struct.Struct(fmt))
+      continue
+
+    if local_type not in definitions:
+      raise ValueError(f"FIT file uses local message type {local_type} before defining it")
+    name, fields, message = definitions[local_type]
+    values = {}
+    for ((key, _, _, scale, offset), base_type), stored in zip(fields, message.unpack_from(data, position)):
+      values[key] = None if stored == BASE_TYPES[base_type][3] else stored / scale - offset
+    position += message.size
+
+    if name == "record":
+      records.append(values)
+    elif name == "lap":
+      values["records"], records = records, []
+      activity["laps"].append(values)
+    elif name == "session":
+      activity["sport"] = values.get("sport")
+  if position != end:
+    raise ValueError("FIT file's last message is truncated")
+  if records:
+    raise ValueError("FIT file has records after its last lap")
+  return activity
+
+def verify_fit(activity: dict, data: bytes):
+  """
+  #### Description
+  Checks a FIT file holds everything on the activity it was encoded from, by decoding it back and comparing both, lap by lap and record by record.
+
+  #### Parameters
+    - `activity`: The activity, as given to `encode_fit()`
+    - `data`: The FIT file's `bytes`, as returned by `encode_fit()`
+
+  #### Notes
+  Values are compared down to the resolution of the field holding them: whole seconds for times, under a centimeter for positions, a centimeter for distances and
+  0.2 meters for altitudes, so anything FIT can't hold, like out of range values, is caught.
+
+  Raises a `ValueError` describing the first difference found, if any.
+  """
+  decoded = decode_fit(data)
+  if decoded["sport"] != activity.get("sport", 0):
+    raise ValueError(f"Sport was {activity.get('sport', 0)}, but reads back as {decoded['sport']}")
+  if len(decoded["laps"]) != len(activity["laps"]):
+    raise ValueError(f"There were {len(activity['laps'])} laps, but {len(decoded['laps'])} read back")
+
+  def compare(message: str, original: dict, read_back: dict, where: str):
+    for key, _, _, scale, _ in MESSAGES[message][1]:
+      if key not in original:
+        continue
+      expected, value = original[key], read_back.get(key)
+      if expected is None and value is None:
+        continue
+      if expected is None or value is None or abs(expected - value) > 0.5 / scale + 1e-9:
+        raise ValueError(f"The {key} of {where} was {expected}, but reads back as {value}")
+
+  for lap_number, (lap, decoded_lap) in enumerate(zip(activity["laps"], decoded["laps"]), start=1):
+    compare("lap", lap, decoded_lap, f"lap {lap_number}")
+    if len(decoded_lap["records"]) != len(lap["records"]):
+      raise ValueError(f"Lap {lap_number} had {len(lap['records'])} trackpoints, but {len(decoded_lap['records'])} read back")
+    for record_number, (record, decoded_record) in enumerate(zip(lap["records"], decoded_lap["records"]), start=1):
+      compare("record", record, decoded_record, f"trackpoint {record_number} of lap {lap_number}")
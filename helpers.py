@@ -1,22 +1,44 @@
 """
 This module contains all functions used by this program, for greater code clarity.
 
-  - `download_mmr_workouts()`: downloads workouts from mapmyride
+  - `archive_workout()`: moves a finished workout out of the way, either onto the archive folder or onto a packed archive
+  - `backoff_delay()`: how long to wait before retrying something that failed, with exponential backoff and jitter
+  - `download_mmr_workout()`: downloads a single workout from mapmyride as a TCX file
+  - `download_mmr_workouts()`: downloads workouts from mapmyride, optionally several at a time
   - `get_mmr_csv_file()`: gets a list of all workouts as a csv file
   - `get_strava_access_token()`: `WIP`: gets strava's write access token. Part of the not yet implemented oauth2 auth flow
-  - `list_mmr_workouts()`: builds a list of mapmyride workouts with only the data we need
+  - `list_mmr_workouts()`: lazily iterates over mapmyride workouts with only the data we need
   - `print_help_text()`: prints this program's help text and quits
+  - `save_response_to_file()`: streams an HTTP response onto disk chunk by chunk, decoding gzip on the fly
   - `upload_workouts_to_strava()`: uploads all workouts to strava from TCX files
 
 For more details onto each function, these are also docstring'd.
 """
+import concurrent.futures
 import csv
+import hashlib
+import json
 import os
-import time
+import queue
+import random
+from collections import deque
+from collections.abc import Iterator
 import zlib
 import sys
-import urllib.request
-import urllib3
+import threading
+import time
+import urllib.parse
+from endpoints import MMR_BASE_URL, STRAVA_BASE_URL
+from http_transport import http_transport
+from mmr_workout import mmr_workout
+from multipart_upload import multipart_upload
+from run_metrics import run_metrics
+from strava_activity_index import strava_activity_index
+from strava_app_pool import strava_app_pool
+from strava_upload_poller import strava_upload_poller
+from tcx_preprocessor import fit_filename
+from workout_archive import workout_archive
+from workout_ledger import workout_ledger
 
 def get_argument_value(args:list[str], flag:str, separator:str = "=") -> str:
   """
@@ -57,10 +79,201 @@ def print_help_text(exit_code:int = 1):
   print(
       "--mmr_cookie          | The session cookie from mapmyride. It can be stolen from any browser request to mapmyride via the inspector."
   )
+  print(
+      "--download-workers    | Amount of workouts to download from mapmyride at the same time. Defaults to 1"
+  )
+  print(
+      "--gzip                | Keeps downloaded workouts gzip-compressed on disk and uploads them to strava as \"tcx.gz\""
+  )
+  print(
+      "--incremental         | Only deals with workouts added to mapmyride since the last run, ideal for scheduled syncs"
+  )
+  print(
+      "--pipeline            | Uploads each workout to strava as soon as it's downloaded, instead of waiting for all downloads to finish"
+  )
+  print(
+      "--preprocess          | Drops redundant trackpoints and empty extensions from workouts, and catches invalid ones, before uploading them"
+  )
+  print(
+      "--downsample          | Also drops trackpoints closer than this amount of seconds to the previous one. Implies \"--preprocess\""
+  )
+  print(
+      "--preprocess-workers  | Amount of processes used to preprocess workouts. Defaults to one per CPU"
+  )
+  print(
+      "--fit                 | Also converts workouts into FIT files, several times smaller, checking nothing gets lost, and uploads those instead. Implies \"--preprocess\""
+  )
+  print(
+      "--skip-duplicates     | Skips uploading workouts already on strava, matching them by start time and distance"
+  )
+  print(
+      "--pack-archive        | Appends finished workouts onto a few compressed pack files, instead of keeping each on its own file"
+  )
+  print(
+      "--extract             | Comma-separated mapmyride ids of workouts to extract from the packed archive, onto the current directory. Needs no \"--mmr-cookie\""
+  )
+  print(
+      "--newest-first        | Downloads and uploads the most recent workouts first. Defaults to the oldest ones first, so they show up on strava in order"
+  )
+  print(
+      "--daemon              | Sleeps through strava's daily ratelimit instead of stopping, until every workout is migrated. Stops cleanly on SIGTERM"
+  )
+  print(
+      "--manifest            | Path to a JSON file listing several accounts to migrate at the same time, instead of a single \"--mmr-cookie\""
+  )
+  print(
+      "--batch-workers       | Amount of accounts from the manifest to migrate at the same time. Defaults to all of them"
+  )
+  print(
+      "--batch-summary       | Where to write the batch's progress summary to. Defaults to \"batch_summary.json\", next to the manifest"
+  )
+  print(
+      "--output-dir          | Where to store downloaded workouts and the ledger. Defaults to \"outputs\", next to this program"
+  )
+  print(
+      "--secrets-file        | Where to store strava's credentials. Defaults to \"temp/secrets.json\", next to this program. List several, comma-separated, to spread uploads across as many strava API applications"
+  )
+  print(
+      "--metrics             | Where to write the run's metrics to, as JSON. Defaults to \"run_metrics.json\", on the output directory"
+  )
+  print(
+      "--metrics-prom        | Where to also write the run's metrics to, as a Prometheus textfile"
+  )
   print("--help              | Prints this help text")
   sys.exit(exit_code)
 
-def get_mmr_csv_file(headers:tuple, workdir: str, url: str = "https://www.mapmyfitness.com/workout/export/csv") -> bool:
+def archive_workout(workouts_dir: str, workout: mmr_workout, archive: workout_archive = None):
+  """
+  #### Description
+  Moves a finished workout out of the output directory, so it only holds pending work.
+
+  #### Parameters
+    - `workouts_dir`: The full path to the directory where all the TCX files reside
+    - `workout`: The finished workout, with its `filename` set
+    - `archive`: If provided, the workout is appended onto it, then its file removed, instead of being moved onto the `archive` folder as is
+
+  #### Notes
+  Only its TCX file is kept. The FIT file it may have been converted to, to be uploaded as, is removed.
+  """
+  if os.path.isfile(f"{workouts_dir}/{fit_filename(workout.filename)}"):
+    os.remove(f"{workouts_dir}/{fit_filename(workout.filename)}")
+  if archive is None:
+    os.rename(f"{workouts_dir}/{workout.filename}",f"{workouts_dir}/archive/{workout.filename}")
+    return
+  archive.add(workout_id=workout.workout_id, path=f"{workouts_dir}/{workout.filename}")
+  os.remove(f"{workouts_dir}/{workout.filename}")
+
+def backoff_delay(attempt: int, base_delay: float = 2, max_delay: float = 120) -> float:
+  """
+  #### Description
+  Calculates how long to wait before retrying something that failed, backing off exponentially.
+
+  #### Parameters
+    - `attempt`: How many times it's been retried already
+    - `base_delay`: Seconds to wait, at most, before the first retry
+    - `max_delay`: Seconds to wait between retries, at most
+
+  #### Returns
+    - The `seconds` to wait
+
+  #### Notes
+  Delays are picked at random between zero and the backed off one ("full jitter"), so retries that failed together don't all hit the server again at once.
+  """
+  return random.uniform(0, min(base_delay * 2 ** attempt, max_delay))
+
+def save_response_to_file(response, outputfile: str, chunk_size: int = 65536, compress: bool = False, metrics: run_metrics = None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                          expect: tuple = ()) -> tuple:
+  """
+  #### Description
+  Streams an HTTP response onto disk chunk by chunk, so its body is never fully held in memory.
+
+  #### Parameters
+    - `response`: A file-like HTTP response to read the body from
+    - `outputfile`: Full path where to store the response body at
+    - `chunk_size`: Amount of bytes to read from the response at a time
+    - `compress`: Whether to store the body gzip-compressed. Defaults to `False`
+    - `metrics`: If provided, the time spent decompressing, compressing and writing onto disk gets recorded on it
+    - `expect`: If provided, the prefixes the body may start with, once decompressed and past any leading whitespace. Anything else raises a `ValueError`
+
+  #### Returns
+    - A tuple containing the amount of `bytes` written to disk, and their `sha256 checksum`
+
+  #### Notes
+  If the body turns out to be gzip-compressed, as told by its first bytes, it gets decompressed incrementally while being written. When `compress` is set,
+  an already gzip-compressed body is written as is (it's still decompressed on the side, just to make sure it's complete), and any other body gets compressed on the fly.
+
+  Data is written onto a `.part` file that's only renamed to `outputfile` once complete, so an interrupted download never leaves a truncated file behind that could be mistaken for a finished one.
+  """
+  partfile = f"{outputfile}.part"
+  written = 0
+  checksum = hashlib.sha256()
+  read = 0
+  head = b"" # The body's first bytes, decompressed, to check it against `expect`
+  decompressor = None
+  compressor = None
+  timings = {"decompress": 0.0, "compress": 0.0, "disk_write": 0.0}
+
+  try:
+    with open(partfile, mode="wb") as f:
+      while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+          break
+        if read == 0:
+          if chunk[:2] == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          elif compress:
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        read += len(chunk)
+        started = time.perf_counter()
+        decoded = chunk
+        if decompressor is not None:
+          decoded = decompressor.decompress(chunk)
+          if not compress:
+            chunk = decoded
+          timings["decompress"] += time.perf_counter() - started
+        elif compressor is not None:
+          chunk = compressor.compress(chunk)
+          timings["compress"] += time.perf_counter() - started
+        head += decoded[:512 - len(head)]
+        started = time.perf_counter()
+        f.write(chunk)
+        timings["disk_write"] += time.perf_counter() - started
+        checksum.update(chunk)
+        written += len(chunk)
+
+      if decompressor is not None:
+        chunk = decompressor.flush()
+        head += chunk[:512 - len(head)]
+        if not compress:
+          f.write(chunk)
+          checksum.update(chunk)
+          written += len(chunk)
+        if not decompressor.eof: # The gzip stream ended before its trailer, so it's truncated
+          raise EOFError(f"Truncated gzip stream while saving \"{outputfile}\"")
+      elif compressor is not None:
+        chunk = compressor.flush()
+        f.write(chunk)
+        checksum.update(chunk)
+        written += len(chunk)
+
+    if expect and not head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(expect):
+      raise ValueError(f"\"{outputfile}\" isn't what was expected. It starts with {head[:60]!r}")
+  except:
+    if os.path.isfile(partfile):
+      os.remove(partfile)
+    raise
+
+  os.replace(partfile, outputfile)
+  if metrics is not None:
+    if decompressor is not None:
+      metrics.record("decompress", timings["decompress"], size=read)
+    if compressor is not None:
+      metrics.record("compress", timings["compress"], size=written)
+    metrics.record("disk_write", timings["disk_write"], size=written)
+  return written, checksum.hexdigest()
+
+def get_mmr_csv_file(headers:tuple, workdir: str, url: str = f"{MMR_BASE_URL}/workout/export/csv", metrics: run_metrics = None) -> bool:
   """
   #### Description
   Gets mapMyRide's workout list as a csv file and saves it for use by the uploader.
@@ -69,6 +282,7 @@ def get_mmr_csv_file(headers:tuple, workdir: str, url: str = "https://www.mapmyf
     - `headers`: A tuple containing the headers required for this request
     - `url`: Endpoint where to download the CSV file data from. Defaults to currently known value but can be overriden
     - `workdir`: Working directory where to store the CSV file at
+    - `metrics`: If provided, the download's timing and size get recorded on it
 
   #### Returns
     - `True` if successful, `False` if not.
@@ -76,50 +290,54 @@ def get_mmr_csv_file(headers:tuple, workdir: str, url: str = "https://www.mapmyf
   #### Notes
   This function and how to retrieve the csv file programatically were derived from its [CSV documentation](https://support.mapmyfitness.com/hc/en-us/articles/1500009118782-Export-Workout-Data),
   and by some req-res hacking, since applications for API access are no longer being granted.
+
+  The file is streamed onto disk as it arrives, so large workout histories are never fully held in memory.
   """
   outputfile = f"{workdir}/workout_list.csv"
-  # First, lets build our request, with stolen data from an actually working request from the
-  # mapMyRide website. Auth cookie as well.
-  my_request = urllib.request.Request(url)
-
-  for key, value in headers:
-    my_request.add_header(key, value)
-
-  # Now, let's download the workout. It'll be encoded as a gzip object
+  # Now, let's download the file straight onto disk, with stolen headers from an actually working request from the
+  # mapMyRide website. Auth cookie as well. If it's encoded as a gzip object, it'll be decoded on the fly
+  started = time.perf_counter()
   try:
-    page = urllib.request.urlopen(my_request).read().decode("utf-8")
-    # Let's decode our gzip
-    # Now, let's store our file onto disk
-
-    with open(outputfile, mode="wb", encoding="utf8") as f:
-      f.write(str(page))
+    response = http_transport.shared().request("GET", url, headers=dict(headers), stream=True)
+    try:
+      if response.status != 200:
+        return False, ""
+      size, _ = save_response_to_file(response=response, outputfile=outputfile, metrics=metrics)
+    finally:
+      response.drain_conn() # Whatever is left unread, i.e. an error page, so the connection can be reused
+      response.release_conn()
   except:
     return False, ""
+  if metrics is not None:
+    metrics.record("csv_fetch", time.perf_counter() - started, size=size)
 
   return True, outputfile
 
-def list_mmr_workouts(csv_file_path: str) -> list:
+def list_mmr_workouts(csv_file_path: str) -> Iterator[mmr_workout]:
   """
   #### Description
-  Reads the mapMyRide csv file and returns a list that only contains those colums we'll be using.
+  Reads the mapMyRide csv file and lazily yields, row by row, only those colums we'll be using.
   #### Parameters
     - `csv_file_path`: Full path to the csv_file to be read
 
   #### Returns
-    - A `list` containing only those items that'll be used by this program
+    - An `iterator` of `mmr_workout` records, each containing only those items that'll be used by this program, numbered as per their position on the file
 
   #### Notes
   This one comes from analyzing mapMyRide's CSV file, since it's not documented anywhere and they're no longer granting requests for API access.
+
+  Since rows are parsed as they're consumed, memory usage remains flat no matter how large the workout history is. Call it again to iterate over the file one more time.
   """
   # From csv file analysis
+  col_workout_date = 1
   col_workout_type = 2
   col_notes = 12
   col_source = 13
   col_dl_link = 14
-  payload = []
   # First, let's get info required to download a workout
   with open(csv_file_path, mode="r", newline="", encoding="utf8") as csvfile:
     item = csv.reader(csvfile, delimiter=",")
+    seq = 0
     for row in item:
       # This will skip the CSV file's header
       if "Date Submitted" in row:
@@ -133,10 +351,72 @@ def list_mmr_workouts(csv_file_path: str) -> list:
       workout_type = row[col_workout_type]
       workout_id = row[col_dl_link].rsplit('/', 2)[1]
 
-      payload.append([link, notes, workout_type, workout_id])
-  return payload
+      yield mmr_workout(workout_id=workout_id, date=mmr_workout.parse_date(row[col_workout_date]), workout_type=workout_type,
+                        notes=notes, link=link, seq=seq)
+      seq += 1
+
+def download_mmr_workout(http: http_transport, headers: tuple, workout_id: str, url: str, filename: str, outputfile: str, ledger: workout_ledger, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                         compress: bool = False, metrics: run_metrics = None) -> bool:
+  """
+  #### Description
+  Downloads a single workout as a TCX file from mapmyride.
+
+  #### Parameters
+    - `http`: The transport to send the request through, so keep-alive connections get reused
+    - `headers`: A tuple containing the headers required for this request
+    - `workout_id`: mapmyride's workout id
+    - `url`: The workout's link, as found on the CSV file
+    - `filename`: The name the workout will be stored with
+    - `outputfile`: Full path where to store the workout at
+    - `ledger`: The ledger where to record the workout as downloaded
+    - `compress`: Whether to keep the workout gzip-compressed on disk. Defaults to `False`
+    - `metrics`: If provided, the download's timing and size get recorded on it
 
-def download_mmr_workouts(headers: tuple, output_dir: str, workout_list: list) -> bool:
+  #### Returns
+    - `True` if successful, `False` if not. The reason why is recorded on the ledger
+  """
+  # First, lets build our request, with stolen data from an actually working request from the
+  # mapMyRide website. Auth cookie as well.
+  export_url = (MMR_BASE_URL
+                + urllib.parse.urlsplit(str(url)).path.replace("/workout/","/workout/export/")
+                + "/tcx")
+
+  # Now, let's download the workout. It'll be encoded as a gzip object, which gets decoded while streamed onto disk
+  started = time.perf_counter()
+  try:
+    response = http.request("GET", export_url, headers=dict(headers), stream=True)
+    try:
+      if response.status != 200:
+        if metrics is not None:
+          metrics.count(f"download_{response.status}")
+        ledger.mark_error(workout_id=workout_id, error=f"download: HTTP {response.status}")
+        return False
+      print(f"💾 Exporting file \"{filename}\" from workout at \"{url}\"...")
+      # Redirects are followed, so once the cookie's expired mapmyride's login page gets here with a 200. That's no workout, so it mustn't be kept as one
+      size, checksum = save_response_to_file(response=response, outputfile=outputfile, compress=compress, metrics=metrics,
+                                             expect=(b"<?xml", b"<TrainingCenterDatabase"))
+      ledger.mark_downloaded(workout_id=workout_id, filename=filename, size=size, checksum=checksum)
+    finally:
+      response.drain_conn()
+      response.release_conn()
+  except ValueError:
+    if metrics is not None:
+      metrics.count("download_not_tcx")
+    print(f"❌ Workout \"{filename}\" didn't come back as a TCX file. Check the mapmyride cookie is still valid")
+    ledger.mark_error(workout_id=workout_id, error=f"download: {sys.exc_info()[1]}")
+    return False
+  except:
+    if metrics is not None:
+      metrics.count("download_errors")
+    ledger.mark_error(workout_id=workout_id, error=f"download: {sys.exc_info()[1]!r}")
+    return False
+  if metrics is not None:
+    metrics.record("download", time.perf_counter() - started, size=size)
+  return True
+
+def download_mmr_workouts(headers: tuple, output_dir: str, workout_list: Iterator[mmr_workout], ledger: workout_ledger, workers: int = 1, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                          compress: bool = False, upload_queue: queue.Queue = None, incremental: bool = False, metrics: run_metrics = None,
+                          retry_attempts: int = 5, shutdown: threading.Event = None) -> bool:
   """
   #### Description
   Downloads all workouts, each as a TCX file, from a mapmyride account onto a chosen directory.
@@ -144,148 +424,372 @@ def download_mmr_workouts(headers: tuple, output_dir: str, workout_list: list) -
   #### Parameters
     - `headers`: A tuple containing the headers required for this request
     - `output_dir`: Target directory where to store the workouts at
-    - `workout_list`: The list generated by the `list_mmr_workouts()` function
+    - `workout_list`: The workouts to download, in the order to download them in. i.e. the iterator generated by the `list_mmr_workouts()` function,
+      or a `mmr_workout_index`'s chronological view. It's consumed lazily
+    - `ledger`: The ledger keeping track of each workout's progress
+    - `workers`: Amount of workouts to download at the same time. Defaults to 1
+    - `compress`: Whether to keep workouts gzip-compressed on disk, as `.tcx.gz` files. Defaults to `False`
+    - `upload_queue`: If provided, each workout is put onto it as soon as it lands on disk, with its `filename` set, for `upload_workouts_to_strava()` to consume
+    - `incremental`: Whether `workout_list` only holds workouts added since the last sync, plus those left unfinished by previous runs. Defaults to `False`
+    - `metrics`: If provided, each download's timing and size get recorded on it
+    - `retry_attempts`: Rounds of retries for downloads that failed. Defaults to `5`
+    - `shutdown`: If provided, no more downloads are started once it's set, though those in flight are waited for
 
   #### Returns
-    - `True` if successful, `False` if not
+    - `True` once all workouts have been gone through. `False` if stopped early through `shutdown`
 
   #### Notes
   This function may take a while to run if the targeted mapmyride account holds too many workouts. Since there's no public-facing API documentation available, it's unknown if a ratelimiter is implemented on their side.
-  """
-  # Let's download each file from the payload list to a temp folder
-  i = 0 # This'll be used to generate unique readable filenames
-
-  for url, _, wtype, id in workout_list:
-    # Let's build our filename and check if it's already been saved. This'll allow some degree of resume capability
-    filename = f"{'{0:0>4}'.format(str(i))}-{id}-{wtype.replace(' ','-').replace('/','')}.tcx"
-    i = i + 1
-
-    outputfile = f"{output_dir}/{filename}"
-    if not os.path.isfile(outputfile):
-      # First, lets build our request, with stolen data from an actually working request from the
-      # mapMyRide website. Auth cookie as well.
-      my_request = urllib.request.Request(str(url)
-                                          .replace("/workout/","/workout/export/")
-                                          .replace("http://", "https://")
-                                          + "/tcx")
-
-      for key, value in headers:
-        my_request.add_header(key, value)
-
-      # Now, let's download the workout. It'll be encoded as a gzip object
-      try:
-        page = urllib.request.urlopen(my_request).read()
-        # Let's decode our gzip
-        decoded_result = zlib.decompress(page, 16 + zlib.MAX_WBITS).decode("utf-8")
-        # Now, let's store our file onto disk
-        print(f"💾 Exporting file \"{filename}\" from workout at \"{url}\"...")
-        with open(outputfile, mode="w", encoding="utf8") as f:
-          f.write(str(decoded_result))
 
-      except:
-        return False
-    else:
-      print(f"✅ Skipping file \"{filename}\", as it already exists...")
-      continue
+  Filenames are numbered after each workout's position on the CSV file, so they remain stable no matter in which order workouts are downloaded, nor in which order downloads finish.
+  Workouts already recorded on the ledger as downloaded are skipped, which allows resuming previous runs. Only workouts missing from the ledger get registered onto it,
+  in batches, so going through an account that's mostly synced already doesn't cost a write per workout.
 
-  print(f"\n🏁 Workouts downloaded. \"{i}\" workout{'s' if i > 1 else ''} to \"{output_dir}\"\n")
+  On incremental runs, only unfinished workouts are looked up on the ledger, rather than every one of them, and every workout listed gets registered,
+  since those are few. The highest workout id gone through is recorded on the ledger once all of them have been, so the next run can tell which ones are new.
+
+  A failed download doesn't stop the rest. Failed downloads are retried once the whole list has been gone through, backing off exponentially, with jitter, between rounds.
+  Those still failing after that are left pending, with their error recorded on the ledger, so they're retried on the next run.
+  """
+  # Let's get what's been done already with a single query. This'll allow resuming previous runs
+  states = ledger.states(unfinished_only=incremental)
+  registered = set() if incremental else ledger.registered_ids()
+  unregistered = [] # Workouts not on the ledger yet, registered all at once right before any download is submitted
+
+  # A single transport shared by all workers, so connections to mapmyride are kept alive and reused
+  http = http_transport.shared()
+  pending = {} # Download in flight -> its arguments
+  failed = [] # Arguments of those downloads that failed, to be retried once the whole list has been gone through
+  new_workouts = 0
+  listed = 0
+  watermark = 0 # Highest workout id gone through
+
+  def enqueue_upload(future: concurrent.futures.Future, workout: mmr_workout):
+    # Runs once each download finishes, so its workout can be uploaded right away
+    if not future.cancelled() and future.result():
+      upload_queue.put(workout)
+
+  def submit(executor: concurrent.futures.Executor, download: tuple):
+    workout, outputfile = download
+    future = executor.submit(download_mmr_workout, http, headers, workout.workout_id, workout.link, workout.filename, outputfile, ledger, compress, metrics)
+    if upload_queue is not None:
+      future.add_done_callback(lambda future, workout=workout: enqueue_upload(future, workout))
+    pending[future] = download
+
+  def collect(return_when: str):
+    # A failed download never stops the rest. It's put aside to be retried later on
+    done, _ = concurrent.futures.wait(pending, return_when=return_when)
+    for future in done:
+      download = pending.pop(future)
+      if not future.result():
+        failed.append(download)
+
+  if shutdown is None:
+    shutdown = threading.Event()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    for workout in workout_list:
+      if shutdown.is_set():
+        break
+      listed += 1
+      id = workout.workout_id
+      status, saved_filename = states.get(id, ("pending", None))
+      if id not in states:
+        new_workouts += 1
+      if id.isdigit():
+        watermark = max(watermark, int(id))
+
+      if id not in registered:
+        unregistered.append(workout)
+      # Let's build our filename and check if it's already been saved
+      filename = f"{'{0:0>4}'.format(str(workout.seq))}-{id}-{workout.workout_type.replace(' ','-').replace('/','')}.tcx"
+
+      if status != "pending":
+        print(f"✅ Skipping file \"{saved_filename}\", as it's already been {status}...")
+        workout.filename = saved_filename
+        if upload_queue is not None and status == "downloaded":
+          upload_queue.put(workout)
+        continue
+
+      outputfile = f"{output_dir}/{filename}"
+
+      if compress:
+        filename = f"{filename}.gz"
+        outputfile = f"{outputfile}.gz"
+
+      workout.filename = filename
+      ledger.register(workouts=unregistered) # Its download gets recorded onto its row, so that has to exist by then
+      unregistered.clear()
+      submit(executor, (workout, outputfile))
+
+      # Keep only a bounded amount of downloads in flight, so we don't queue the whole list at once
+      if len(pending) >= workers * 2:
+        collect(return_when=concurrent.futures.FIRST_COMPLETED)
+
+    ledger.register(workouts=unregistered)
+    ledger.commit()
+    collect(return_when=concurrent.futures.ALL_COMPLETED)
+
+    # Now, let's retry those that failed, in rounds, backing off between each
+    for attempt in range(retry_attempts):
+      if not failed:
+        break
+      delay = backoff_delay(attempt)
+      print(f"\n🔁 Retrying \"{len(failed)}\" failed download{'s' if len(failed) != 1 else ''} in {round(delay, 1)} seconds ({attempt + 1}/{retry_attempts})...\n")
+      if metrics is not None:
+        metrics.count("download_retries", len(failed))
+      if shutdown.wait(delay):
+        break
+      retrying, failed = failed, []
+      for download in retrying:
+        submit(executor, download)
+        if len(pending) >= workers * 2:
+          collect(return_when=concurrent.futures.FIRST_COMPLETED)
+      collect(return_when=concurrent.futures.ALL_COMPLETED)
+
+  if failed:
+    print(f"\n⚠️  \"{len(failed)}\" workout{'s' if len(failed) != 1 else ''} couldn't be downloaded. They'll be retried on the next run")
+  if shutdown.is_set():
+    print("\n🛑 Downloads stopped, as asked to.")
+    return False
+
+  ledger.record_sync(new_workouts=new_workouts, watermark=watermark)
+  if incremental:
+    print(f"\n🔄 Found \"{new_workouts}\" new workout{'s' if new_workouts != 1 else ''} since the last sync")
+
+  print(f"\n🏁 Workouts downloaded. \"{listed}\" workout{'s' if listed > 1 else ''} to \"{output_dir}\"\n")
   return True
 
-def upload_workouts_to_strava(workouts_dir: str, workout_list: list, strava_access_token: str) -> bool:
+def upload_workouts_to_strava(workouts_dir: str, ledger: workout_ledger, apps: strava_app_pool, compress: bool = False, upload_queue: queue.Queue = None, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                              activity_index: strava_activity_index = None, metrics: run_metrics = None, retry_attempts: int = 5,
+                              newest_first: bool = False, archive: workout_archive = None) -> bool:
   """
   #### Description
-  Uploads all workouts found on a given directory that match the mapmyride CSV file to Strava.
+  Uploads all workouts recorded on the ledger as downloaded to Strava.
 
   #### Parameters
     - `workouts_dir`: The full path to the directory where all the TCX files reside
-    - `workout_list`: The list generated by the `list_mmr_workouts()` function
-    - `strava_access_token`: The strava access token provided to this program
+    - `ledger`: The ledger keeping track of each workout's progress
+    - `apps`: The strava API applications to upload with, each with its own credentials and ratelimiter. Access tokens are renewed ahead of their expiry,
+      or when strava rejects them, so long runs don't fail with `401`s
+    - `compress`: Whether to gzip-compress plain files while uploading them. Defaults to `False`
+    - `upload_queue`: If provided, workouts are taken from it as `download_mmr_workouts()` puts them there, until a `None` is found, instead of from the ledger
+    - `activity_index`: If provided, workouts matching an activity already on strava are skipped instead of uploaded
+    - `metrics`: If provided, each upload's latency and size, plus retries and errors, get recorded on it. A live ETA is printed every 25 uploads too
+    - `retry_attempts`: Rounds of retries for uploads that failed due to connection or server errors. Defaults to `5`
+    - `newest_first`: Whether to upload the most recent workouts first, instead of the oldest ones. Only applies to those taken from the ledger. Defaults to `False`
+    - `archive`: If provided, finished workouts are appended onto it, instead of being moved onto the `archive` folder as loose files
 
   #### Returns
     - `True` if successful, `False` if not
 
   #### Notes
+  Workouts taken from the ledger are uploaded in chronological order, by the day they took place on, so they show up on strava's feed in the order they happened.
+
+  Files already stored as `.tcx.gz` are always uploaded as such, since strava accepts gzip-compressed TCX files. Each file is streamed from disk as it's sent,
+  compressed on the fly if needed, so memory per upload stays constant however large the file is.
+  Workouts converted into FIT files by the preprocessing stage are uploaded as those instead, as `fit`, or `fit.gz` if compressing.
+
   This function may take a while to run if there are too many workouts, since Strava implements [a ratelimiter on its API](https://developers.strava.com/docs/getting-started/#basic).
+  Requests are paced by each application's `strava_ratelimiter`, and spread across them by the `strava_app_pool`, which only sleeps once all of them are used up,
+  until the earliest 15-minute window resets. Workouts that get rate limited are put back in the queue.
+  An application whose access token keeps being rejected is dropped, and the rest carry on.
+
+  A failed upload doesn't stop the rest. Those failing due to connection or server errors are retried once all others have been gone through, backing off exponentially,
+  with jitter, between rounds. Those still failing after that, or rejected by strava, are left in place with their error recorded on the ledger.
+
+  Since strava processes uploads asynchronously, a `strava_upload_poller` follows up on each of them in the background, recording the resulting activity id or error on the ledger.
   """
-  throttle_wait = 910 # Sleep for 15 minutes before resuming, to avoid
-                      # hitting API ratelimiter
+  if metrics is None:
+    metrics = run_metrics()
+    metrics.track(apps)
+
+  poller = strava_upload_poller(ledger=ledger, apps=apps, metrics=metrics)
+  poller.start()
 
   # ===============================================================================================
-  # First, let's construct a list of files to upload ==============================================
+  # First, let's get the workouts to upload, either from the ledger or as they get downloaded =====
   # ===============================================================================================
-  filelist = os.listdir(workouts_dir)
+  failed = [] # Workouts that failed due to connection or server errors, to be retried once all others have been gone through
 
-  result = {}
-  for list_element in filelist:
-    if ".tcx" not in list_element: # Filter out other files, like .gitignore, .DS_Store, etc
-      continue
-    result[list_element.split('-')[1]] = list_element # Add to dict, use workout id as key
+  def workout_list() -> Iterator[mmr_workout]:
+    if upload_queue is None:
+      yield from ledger.pending_uploads(newest_first=newest_first)
+    else:
+      yield from iter(upload_queue.get, None)
+    # Now, let's retry those that failed, in rounds, backing off between each
+    for attempt in range(retry_attempts):
+      if not failed:
+        return
+      delay = backoff_delay(attempt)
+      print(f"\n🔁 Retrying \"{len(failed)}\" failed upload{'s' if len(failed) != 1 else ''} in {round(delay, 1)} seconds ({attempt + 1}/{retry_attempts})...\n")
+      metrics.count("upload_retries", len(failed))
+      if apps.shutdown.wait(delay):
+        return
+      retrying = list(failed)
+      failed.clear()
+      yield from retrying
+
+  workouts = workout_list()
+  retries = deque() # Workouts that got rate limited, to be retried before any other
 
-  full_list=[]
-  for list_item in workout_list:
-    if list_item[3] in result:
-      full_list.append(list_item + [result[list_item[3]]])
-  full_list.sort(reverse=True)
   # ===============================================================================================
   # Now, let's upload our files one by one ========================================================
   # ===============================================================================================
   # Getting strava's auth code
-  http = urllib3.PoolManager()
+  http = http_transport.shared()
+  uploaded = 0
+  unauthorized = {} # Consecutive uploads rejected due to the access token, by application
+  eta_every = 25
+
+  while True:
+    workout = retries.popleft() if retries else next(workouts, None)
+    if workout is None:
+      break
+    notes, workout_id, workout_file = workout.notes, workout.workout_id, workout.filename
+
+    if activity_index is not None:
+      # Workouts already on strava would only be rejected as duplicates, wasting a request
+      try:
+        start, distance = activity_index.workout_summary(f"{workouts_dir}/{workout_file}")
+      except:
+        start, distance = 0, 0
+      activity_id = activity_index.find(start=start, distance=distance) if start else 0
+      if activity_id:
+        print(f"⏭️  Skipping workout \"{workout_file}\", as it's already on strava as activity \"{activity_id}\"")
+        metrics.count("duplicates_skipped")
+        ledger.mark_duplicate(workout_id=workout_id, activity_id=activity_id)
+        archive_workout(workouts_dir=workouts_dir, workout=workout, archive=archive)
+        continue
 
-  for _, notes, _, _, workout_file in full_list:
-    with open(workouts_dir + "/" + workout_file, 'rb') as file:
-      tcx_data = file.read()
+    app = apps.acquire()
+    if app is None:
+      if apps.shutdown.is_set():
+        print("\n🛑 Uploads stopped, as asked to.")
+      elif len(apps) == 0:
+        print("\n💥 Strava rejected every access token, and they couldn't be renewed. Delete them from the secrets files to authorize the apps again.")
+      else: # Hit daily ratelimit
+        print("\n💥 Daily ratelimit reached. Wait until tomorrow and try again, or run it with \"--daemon\" to have it wait on its own.")
+      poller.stop()
+      return False
+    credentials, ratelimiter = app
+
+    # Workouts converted to FIT are uploaded as such, since those are several times smaller
+    upload_file = fit_filename(workout_file)
+    if not os.path.isfile(f"{workouts_dir}/{upload_file}"):
+      upload_file = workout_file
+
+    # TCX is verbose XML, so sending it gzip-compressed saves plenty of bandwidth
+    upload_name = upload_file
+    if compress and not upload_file.endswith(".gz"):
+      upload_name = f"{upload_file}.gz"
+
+    file_type = "fit" if upload_file.endswith(".fit") else "tcx"
+    if upload_name.endswith(".gz"):
+      data_type, content_type = f"{file_type}.gz", "application/gzip"
+    elif file_type == "fit":
+      data_type, content_type = "fit", "application/vnd.ant.fit"
+    else:
+      data_type, content_type = "tcx", "application/tcx"
+
+    strava_access_token = credentials.token()
+    if strava_access_token == "":
+      print(f"\n💥 The access token of app \"{credentials.client_id}\" expired and couldn't be renewed. Carrying on without it.")
+      apps.discard(app)
+      retries.append(workout)
+      continue
+
+    # The body is streamed straight from the file, compressing it on the way if needed, so it's never held in memory as a whole
+    try:
+      body = multipart_upload(fields={"data_type": data_type, "description": notes}, file_field="file", path=f"{workouts_dir}/{upload_file}",
+                              filename=upload_name, content_type=content_type, compress=upload_name != upload_file)
+    except FileNotFoundError:
+      # Retrying won't bring it back, so it's left to be downloaded again on the next run
+      print(f"❌ Workout \"{workout_file}\" is gone from disk. It'll be downloaded again on the next run")
+      ledger.mark_pending(workout_id=workout_id, error=f"upload: {sys.exc_info()[1]!r}")
+      continue
+    except OSError:
+      print(f"❌ Workout \"{workout_file}\" couldn't be read: {sys.exc_info()[1]}")
+      ledger.mark_error(workout_id=workout_id, error=f"upload: {sys.exc_info()[1]!r}")
+      continue
 
     # Create the request headers
     headers = {
       'Authorization': f'Bearer {strava_access_token}',
-      'Content-Disposition': f'attachment; filename="{workout_file}"'
-    }
-
-    # create the data payload
-    data = {
-      "data_type": "tcx",
-      'file': (workouts_dir + "/" + workout_file, tcx_data, 'application/tcx'),
-      'description': notes
+      'Content-Disposition': f'attachment; filename="{upload_name}"',
+      **body.headers()
     }
 
     # Send the request
+    started = time.perf_counter()
     try:
       response = http.request(
         method='POST',
-        url='https://www.strava.com/api/v3/uploads',
+        url=f'{STRAVA_BASE_URL}/api/v3/uploads',
         headers=headers,
-        fields=data
+        body=body
       )
     except:
-      return False
-
-    # Print the response
-    response_status_code = response.headers._container['status'][1][0:3]
-
-    # [15min-limit, daily-limit]
-    response_x_ratelimit_limit = response.headers._container['x-ratelimit-limit'][1].split(",")
-    # [15min-limit-usage, daily-limit-usage]
-    response_x_ratelimit_usage = response.headers._container['x-ratelimit-usage'][1].split(",")
-
-    if response_status_code == '201': # Success!
-      print(f"✅ Workout \"{workout_file}\" uploaded successfully. \
-            15m ratelimit [used/limit]: [{response_x_ratelimit_usage[0]},{response_x_ratelimit_limit[0]}] \
-            daily ratelimit [used/limit]: [{response_x_ratelimit_usage[1]},{response_x_ratelimit_limit[1]}]")
-      os.rename(f"{workouts_dir}/{workout_file}",f"{workouts_dir}/archive/{workout_file}")
+      print(f"❌ Workout \"{workout_file}\" failed to upload: {sys.exc_info()[1]}. Put aside to be retried")
+      metrics.count("upload_errors")
+      ledger.mark_error(workout_id=workout_id, error=f"upload: {sys.exc_info()[1]!r}")
+      failed.append(workout)
+      continue
+    finally:
+      body.close()
+    metrics.record("upload", time.perf_counter() - started, size=body.sent)
+
+    ratelimiter.update(response.headers)
+
+    if response.status == 201: # Success!
+      print(f"✅ Workout \"{workout_file}\" uploaded successfully. {ratelimiter.status()}")
+      upload_id = json.loads(response.data).get("id")
+      ledger.mark_uploaded(workout_id=workout_id, upload_id=upload_id)
+      poller.add(workout_id=workout_id, upload_id=upload_id)
+      archive_workout(workouts_dir=workouts_dir, workout=workout, archive=archive)
+      uploaded += 1
+      if uploaded % eta_every == 0:
+        # Let's tell how long is left, and refresh the metrics files so they can be followed live
+        eta = metrics.estimate(workouts=ledger.counts())
+        print(f"⏱️  {uploaded} workouts uploaded so far. ETA: {metrics.format_eta(eta)}")
+        metrics.write()
+
+    elif response.status == 429: # Hit ratelimiter
+      print(f"\n⏰ Workout \"{workout_file}\" hit a ratelimit. Put back in the queue to be retried once it's reset\n")
+      metrics.count("upload_429")
+      metrics.count("retries")
+      ratelimiter.exhaust()
+      retries.append(workout)
+
+    elif response.status >= 500: # Server error
+      print(f"❌ Workout \"{workout_file}\" failed to upload due to error {response.status}. Put aside to be retried")
+      metrics.count(f"upload_{response.status}")
+      ledger.mark_error(workout_id=workout_id, error=f"upload: HTTP {response.status}")
+      failed.append(workout)
+
+    elif response.status == 401: # Token expired ahead of time, or got revoked
+      metrics.count("upload_401")
+      unauthorized[credentials.client_id] = unauthorized.get(credentials.client_id, 0) + 1
+      # A token rejected right after being renewed won't do any better next time, so let's not loop forever
+      if unauthorized[credentials.client_id] > 1 or not credentials.renew(stale_token=strava_access_token):
+        print(f"\n💥 Strava rejected the access token of app \"{credentials.client_id}\", and it couldn't be renewed. "
+              "Delete it from its secrets file to authorize the app again.")
+        apps.discard(app)
+      retries.append(workout)
+      continue
 
-    elif response_status_code == '429': # Hit ratelimiter
-      print(f"\n⏰ Workout \"{workout_file}\" hit a ratelimit. Waiting {throttle_wait / 60} minutes before retrying\n")
-      time.sleep(throttle_wait)
+    elif response.status in (400, 409, 413, 415, 422): # Rejected by strava. i.e. a malformed file. Retrying won't help, not even on later runs
+      print(f"❌ Workout \"{workout_file}\" was rejected by strava with error {response.status}. Left in place, and won't be uploaded again")
+      metrics.count(f"upload_{response.status}")
+      ledger.mark_rejected(workout_id=workout_id, error=f"upload: HTTP {response.status}: {response.data.decode('utf8', errors='replace')[:200]}")
 
-    elif response_status_code == '500': # Server error
-      print(f"❌ Workout \"{workout_file}\" failed to upload due to error 500. Left in place so it can be retried")
+    else: # Anything else, like a 403 while the app lacks permissions, isn't down to the workout, so it's retried on the next run
+      print(f"❌ Workout \"{workout_file}\" failed to upload due to error {response.status}. Left in place, to be retried on the next run")
+      metrics.count(f"upload_{response.status}")
+      ledger.mark_error(workout_id=workout_id, error=f"upload: HTTP {response.status}: {response.data.decode('utf8', errors='replace')[:200]}")
 
-    if int(response_x_ratelimit_usage[0]) >= int(response_x_ratelimit_limit[0]): # Hit 15-min ratelimit
-      print(f"\n⏰ 15-min ratelimit reached. Waiting {throttle_wait / 60} minutes before retrying\n")
-      time.sleep(throttle_wait)
+    unauthorized[credentials.client_id] = 0
 
-    if int(response_x_ratelimit_usage[1]) >= int(response_x_ratelimit_limit[1]): # Hit daily ratelimit
-      print("\n💥 Daily ratelimit reached. Wait until tomorrow and try again.")
-      return False
+  print("\n⏳ Waiting for strava to finish processing uploads...")
+  poller.finish()
   return True
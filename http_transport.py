@@ -0,0 +1,85 @@
+"""
+This module contains the HTTP transport every request to both mapmyride and strava goes through
+"""
+import threading
+
+class http_transport:
+  """
+  #### Description
+  A thread-safe set of keep-alive connection pools, one per host, sending every request with the same timeouts and compression.
+
+  #### Notes
+  A single instance, got through `http_transport.shared()`, serves the whole run, so each host's TLS handshake is paid once per connection instead of once per request.
+
+  `urllib3` is only imported once the first request is sent, so runs that never reach the network, or do so late, i.e. while the access token is known to be valid, start quicker.
+
+  Up to `maxsize` connections are kept alive for each host. Requests beyond that, i.e. from more download workers than that, still go through, on connections closed right after.
+  """
+  connect_timeout = 10 # Seconds to wait for a connection to be established
+  read_timeout = 60 # Seconds to wait for the server to send any data
+  maxsize = 32 # Connections kept alive for each host
+  instance = None
+  instance_lock = threading.Lock()
+
+  def __init__(self, maxsize: int = 0):
+    """
+    #### Description
+    Builds a new transport. Its pools aren't built until the first request is sent
+    #### Parameters
+    - `maxsize`: Connections kept alive for each host. Defaults to the class' `maxsize`
+    """
+    self.lock = threading.Lock()
+    self.maxsize = maxsize or self.maxsize
+    self.pools = None
+
+  @classmethod
+  def shared(cls) -> "http_transport":
+    """
+    #### Description
+    Gets the transport shared by the whole program, building it on first use
+    #### Returns
+    - The shared `http_transport`
+    """
+    with cls.instance_lock:
+      if cls.instance is None:
+        cls.instance = cls()
+      return cls.instance
+
+  def pool_manager(self):
+    """
+    #### Description
+    Gets the underlying pool manager, importing `urllib3` and building it on first use
+    #### Returns
+    - A `urllib3.PoolManager`
+    """
+    with self.lock:
+      if self.pools is None:
+        import urllib3 # pylint: disable=import-outside-toplevel
+        self.pools = urllib3.PoolManager(maxsize=self.maxsize, timeout=urllib3.Timeout(connect=self.connect_timeout, read=self.read_timeout))
+      return self.pools
+
+  def request(self, method: str, url: str, headers: dict = None, fields: dict = None, body=None, multipart: bool = True, stream: bool = False): # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    #### Description
+    Sends a request, asking for a gzip-compressed response
+    #### Parameters
+    - `method`: The HTTP method. i.e. `GET` or `POST`
+    - `url`: The full URL to send the request to
+    - `headers`: The request's headers. Any `Accept-Encoding` among them is replaced, since gzip is the only encoding handled throughout
+    - `fields`: If provided, the request's fields. Sent on the query string on `GET` requests, and on the body otherwise
+    - `body`: If provided, the request's raw body, either as `bytes` or as a file-like object to stream it from. i.e. a `multipart_upload`
+    - `multipart`: Whether to send `fields` on the body as `multipart/form-data`, or as `application/x-www-form-urlencoded` instead. Defaults to `True`
+    - `stream`: Whether to leave the body on the wire, to be read raw, still compressed if it was, with `read()`. Defaults to `False`, reading it whole and decompressed onto `data`
+    #### Returns
+    - The `urllib3.HTTPResponse`. Streamed ones must be given back with `release_conn()` once read, so their connection is reused
+    """
+    headers = {key: value for key, value in (headers or {}).items() if key.lower() != "accept-encoding"}
+    headers["Accept-Encoding"] = "gzip"
+    options = {}
+    if fields is not None:
+      options["fields"] = fields
+      if method not in ("GET", "HEAD", "DELETE", "OPTIONS"):
+        options["encode_multipart"] = multipart
+    if body is not None:
+      options["body"] = body
+    return self.pool_manager().request(method, url, headers=headers, preload_content=not stream, decode_content=not stream, **options)
@@ -1,86 +1,140 @@
 """
 Main file
 """
+import concurrent.futures
+import json
 import os
+import queue
+import signal
 from sys import argv as args
 import sys
+import threading
+import time
+import urllib.parse
 import helpers as f
+import tcx_preprocessor
+from endpoints import MMR_BASE_URL
+from mmr_workout_index import mmr_workout_index
+from run_metrics import run_metrics
+from strava_activity_index import strava_activity_index
+from strava_app_pool import strava_app_pool
+from strava_credentials import strava_credentials
 from strava_oauth import strava_oauth as oauth
+from strava_ratelimiter import strava_ratelimiter
+from workout_archive import workout_archive
+from workout_ledger import workout_ledger
 
-def main(args):
+def authenticate(secrets_file: str, interactive: bool = True, metrics: run_metrics = None) -> strava_credentials:
   """
-  Main program
+  Gets valid strava credentials, refreshing the access token or going through strava's oauth flow as needed. Returns `None` if unable to
   """
-  result = False
-
-  # Let's get our flags...
-  FLAG_HELP = "--help" in args
-  if FLAG_HELP:
-    f.print_help_text(2)
-
-  # Get args
-  mmr_cookie = f.get_argument_value(args=args, flag="--mmr-cookie", separator="--mmr-cookie=")
-
-  if mmr_cookie == "":
-    print("❌ Argument \"--mmr-cookie\" is missing or empty!")
-    f.print_help_text(1)
-
-  #region #? Do strava auth
-  workdir = os.path.dirname(os.path.realpath(__file__))
-  secrets_file = f"{workdir}/temp/secrets.json"
-  strava_access_token, refresh_token = "", ""
+  strava_access_token, refresh_token, expires_at, athlete_id = "", "", 0, 0
 
   if not os.path.exists(secrets_file):
+    if not interactive:
+      print(f"[strava] \033[91m❌ Secrets file \"{secrets_file}\" not found. Run the migrator for this account on its own once, to authorize it.\033[0m")
+      return None
     # There's no secrets file. Ask user for client ID & Secret
     client_id, client_secret = oauth.ask_for_secrets()
     if client_secret == "" or client_id == "":
       print("[strava] \033[91m❌ Either the \"Client Secret\" or \"ID\" provided are empty. Check them then try again.\033[0m")
-      sys.exit(1)
-    else:
-      # Write client info to secrets file
-      oauth.write_secrets_file(secrets_file=secrets_file, \
-                              client_id=client_id, \
-                              client_secret=client_secret)
+      return None
+    # Write client info to secrets file
+    oauth.write_secrets_file(secrets_file=secrets_file, \
+                            client_id=client_id, \
+                            client_secret=client_secret)
   else:
     # Get all credentials from file
-    strava_access_token, refresh_token, client_id, client_secret = oauth.read_secrets_file(secrets_file)
+    strava_access_token, refresh_token, client_id, client_secret, expires_at, athlete_id = oauth.read_secrets_file(secrets_file)
+
+  credentials = strava_credentials(secrets_file=secrets_file, client_id=client_id, client_secret=client_secret, access_token=strava_access_token,
+                                   refresh_token=refresh_token, expires_at=expires_at, athlete_id=athlete_id, metrics=metrics)
 
   if strava_access_token == "":
+    if not interactive:
+      print(f"[strava] \033[91m❌ No access token found on \"{secrets_file}\". Run the migrator for this account on its own once, to authorize it.\033[0m")
+      return None
     # No access token present. Let's retrieve them
-    strava_access_token, refresh_token = oauth.do_oauth_flow(client_id=client_id, \
-                                                      client_secret=client_secret)
+    credentials.access_token, credentials.refresh_token, credentials.expires_at, credentials.athlete_id = oauth.do_oauth_flow(client_id=client_id, \
+                                                                                                                             client_secret=client_secret)
+  elif expires_at == 0:
+    # Written by a previous version, so the token's expiry is unknown. Renewing it tells, and gets it saved, so this happens just once.
+    # If it can't be renewed, the old token's still used as long as strava takes it
+    if not credentials.renew(stale_token=strava_access_token) and not oauth.check_access_token(strava_access_token, metrics=metrics):
+      credentials.access_token = ""
   else:
-    if not oauth.check_access_token(strava_access_token):
-      # Refresh invalid access_token since it's invalid, so we don't bother user
-      strava_access_token = oauth.refresh_access_token(client_id=client_id, \
-                                                client_secret=client_secret, \
-                                                refresh_token=refresh_token)
+    # Its expiry is known, so there's no need to ask strava whether it's still valid. It only gets renewed if about to expire
+    credentials.access_token = credentials.token()
 
-  if strava_access_token == "":
-    # If at this point we still have no access token, we've failed and can't do anything about it,
-    # so we exit with error
+  if credentials.access_token == "":
+    # If at this point we still have no access token, we've failed and can't do anything about it
     print("[strava] \033[91m❌ Unable to retrieve tokens. Check provided \"Client ID\" & \"Secret\", then try again\033[0m")
-    sys.exit(1)
-  else:
-    oauth.write_secrets_file(secrets_file=secrets_file, \
-                            client_id=client_id, \
-                            client_secret=client_secret, \
-                            access_token=strava_access_token, \
-                            refresh_token=refresh_token)
+    return None
+
+  credentials.save()
 
   print("[strava] \033[92m🔐 Authentication successful!\n\033[0m")
-  #endregion
+  return credentials
+
+def migrate_account(mmr_cookie: str, secrets_file: str, output_dir: str, download_workers: int = 1, compress: bool = False, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                    pipeline: bool = False, incremental: bool = False, interactive: bool = True, preprocess: bool = False,
+                    preprocess_workers: int = 0, downsample: int = 0, skip_duplicates: bool = False, metrics_file: str = "",
+                    prometheus_file: str = "", daemon: bool = False, shutdown: threading.Event = None, newest_first: bool = False,
+                    pack_archive: bool = False, fit: bool = False) -> bool:
+  """
+  Migrates all workouts from a mapmyride account to strava. Returns `True` if successful, `False` if not.
+  Several strava API applications can be used at once, to multiply the ratelimit's quota, by listing their secrets files comma-separated on `secrets_file`.
+  On daemon mode, it sleeps through strava's daily ratelimit instead of giving up. Setting `shutdown` stops it cleanly, leaving it ready to be resumed
+  """
+  metrics = run_metrics(summary_file=metrics_file or f"{output_dir}/run_metrics.json", prometheus_file=prometheus_file)
+  # Each secrets file holds a different strava API application, all of them authorized by the same athlete
+  credentials = []
+  for app_secrets_file in secrets_file.split(","):
+    app_credentials = authenticate(secrets_file=app_secrets_file.strip(), interactive=interactive, metrics=metrics)
+    if app_credentials is None:
+      return False
+    credentials.append(app_credentials)
+
+  if len(credentials) > 1:
+    # Workouts uploaded through an app authorized by someone else would end up on their strava profile. Let's not start at all
+    athletes = {app.secrets_file: app.athlete_id for app in credentials if app.athlete_id}
+    if len(set(athletes.values())) > 1:
+      listing = ", ".join(f"\"{file}\" by athlete {athlete_id}" for file, athlete_id in athletes.items())
+      print(f"[strava] \033[91m❌ The apps weren't all authorized by the same athlete: {listing}. Authorize them all from the same strava profile\033[0m")
+      return False
+    unknown = [f"\"{app.secrets_file}\"" for app in credentials if not app.athlete_id]
+    if unknown:
+      print(f"[strava] ⚠️  Unable to check who authorized {', '.join(unknown)}, as they were authorized by an earlier version. "
+            "Delete their access tokens to authorize them again if unsure\n")
+
+  os.makedirs(f"{output_dir}/archive", exist_ok=True)
+  try:
+    return migrate_workouts(mmr_cookie=mmr_cookie, credentials=credentials, output_dir=output_dir, metrics=metrics,
+                            download_workers=download_workers, compress=compress, pipeline=pipeline, incremental=incremental,
+                            preprocess=preprocess, preprocess_workers=preprocess_workers, downsample=downsample, skip_duplicates=skip_duplicates,
+                            daemon=daemon, shutdown=shutdown if shutdown is not None else threading.Event(), newest_first=newest_first,
+                            pack_archive=pack_archive, fit=fit)
+  finally:
+    metrics.write()
+    print(f"📊 Run metrics written to \"{metrics.summary_file}\"")
 
-  csv_url = "https://www.mapmyfitness.com/workout/export/csv"
-  files_dir = "outputs"
+def migrate_workouts(mmr_cookie: str, credentials: list, output_dir: str, metrics: run_metrics, download_workers: int = 1, compress: bool = False, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                     pipeline: bool = False, incremental: bool = False, preprocess: bool = False, preprocess_workers: int = 0, downsample: int = 0,
+                     skip_duplicates: bool = False, daemon: bool = False, shutdown: threading.Event = None, newest_first: bool = False,
+                     pack_archive: bool = False, fit: bool = False) -> bool:
+  """
+  Downloads all workouts from a mapmyride account, then uploads them to strava, recording how long each stage takes. Returns `True` if successful, `False` if not
+  """
+
+  csv_url = f"{MMR_BASE_URL}/workout/export/csv"
   mmr_headers = (
     ("Accept", "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8"),
-    ("Accept-Encoding","gzip, deflate, br"),
+    ("Accept-Encoding","gzip"),
     ("Accept-Language","en-GB,en;q=0.5"),
     ("Connection","keep-alive"),
     ("Cookie", mmr_cookie),
     ("DNT","1"),
-    ("Host","www.mapmyfitness.com"),
+    ("Host",urllib.parse.urlsplit(MMR_BASE_URL).netloc),
     ("Sec-Fetch-Dest","document"),
     ("Sec-Fetch-Mode","navigate"),
     ("Sec-Fetch-Site","none"),
@@ -91,35 +145,364 @@ def main(args):
     ("User-Agent","Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/118.0")
   )
 
-  result, csv_file = f.get_mmr_csv_file(headers=mmr_headers, url=csv_url, workdir=workdir)
+  result, csv_file = f.get_mmr_csv_file(headers=mmr_headers, url=csv_url, workdir=output_dir, metrics=metrics)
   if result:
     print("✅ CSV File downloaded.\n")
   else:
     print("❌ Failed to Obtain CSV file.")
-    sys.exit(1)
+    return False
 
-  workout_list = f.list_mmr_workouts(csv_file_path=csv_file)
+  ledger = workout_ledger(workouts_dir=output_dir)
+  listing = f.list_mmr_workouts(csv_file_path=csv_file)
+  incremental = incremental and bool(ledger.last_sync())
+  if incremental:
+    print(f"🔄 Syncing workouts added since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ledger.last_sync()))}...\n")
+    # mapmyride assigns ids incrementally, so those added since the last sync are above its watermark. Any other one is left out unless it's unfinished
+    watermark = ledger.watermark()
+    unfinished = ledger.states(unfinished_only=True)
+    listing = (workout for workout in listing if workout.workout_id in unfinished or workout.sort_key()[1] > watermark)
 
-  result = f.download_mmr_workouts(headers=mmr_headers, output_dir=f"{workdir}/{files_dir}",
-                        workout_list=workout_list
-                        )
+  # Built once, then shared by every stage, so workouts are downloaded, and uploaded, in chronological order
+  workouts = mmr_workout_index(listing)
+  print(f"📋 Found {len(workouts)} {'new or unfinished ' if incremental else ''}workouts on mapMyRide\n")
+
+  archive = None
+  if pack_archive:
+    # Finished workouts get appended onto a few pack files, so the output directory only holds pending work
+    archive = workout_archive(archive_dir=f"{output_dir}/archive")
+    moved = archive.pack_loose_files()
+    if moved:
+      print(f"📦 Packed {moved} workouts archived as loose files by previous runs\n")
+
+  # Strava's ratelimits are enforced per application, so each one gets its own ratelimiter
+  apps = strava_app_pool(apps=[(app, strava_ratelimiter()) for app in credentials],
+                         wait_for_daily=daemon, shutdown=shutdown)
+  if len(apps) > 1:
+    print(f"[strava] 🔀 Spreading requests across {len(apps)} API applications\n")
+  metrics.track(apps)
+  activity_index = None
+  if skip_duplicates:
+    activity_index = strava_activity_index()
+    if activity_index.load(apps=apps):
+      print(f"[strava] 📇 Found {activity_index.size} activities already on strava\n")
+    elif shutdown.is_set():
+      activity_index = None
+    else:
+      print("[strava] ⚠️  Unable to list activities already on strava. Uploading without checking for duplicates\n")
+      activity_index = None
 
-  if not result:
-    print("❌ Failed to obtain mapMyRide workouts.")
-    sys.exit(1)
+  if pipeline:
+    # Both stages run at once, linked by a bounded queue, so uploads start as soon as the first workout lands on disk
+    upload_queue = queue.Queue(maxsize=100)
+    download_queue = queue.Queue(maxsize=100) if preprocess else upload_queue
+    download_result = []
+
+    def download_stage():
+      try:
+        download_result.append(f.download_mmr_workouts(headers=mmr_headers, output_dir=output_dir,
+                                                       workout_list=workouts.chronological(newest_first=newest_first),
+                                                       ledger=ledger,
+                                                       workers=download_workers,
+                                                       compress=compress,
+                                                       upload_queue=download_queue,
+                                                       incremental=incremental,
+                                                       metrics=metrics,
+                                                       shutdown=shutdown
+                                                       ))
+      finally:
+        download_queue.put(None) # Tells the next stage there's nothing else coming
+
+    downloader = threading.Thread(target=download_stage, daemon=True)
+    downloader.start()
+
+    if preprocess:
+      # Preprocessing sits between both stages, on its own process pool, so it keeps up with downloads
+      preprocessor = threading.Thread(target=tcx_preprocessor.preprocess_queue, daemon=True,
+                                      kwargs={"input_queue": download_queue, "output_queue": upload_queue, "workouts_dir": output_dir,
+                                              "ledger": ledger, "workers": preprocess_workers, "downsample": downsample, "fit": fit,
+                                              "shutdown": shutdown})
+      preprocessor.start()
+
+    result = f.upload_workouts_to_strava(workouts_dir=output_dir,
+                              ledger=ledger,
+                              apps=apps,
+                              compress=compress,
+                              upload_queue=upload_queue,
+                              activity_index=activity_index,
+                              metrics=metrics,
+                              newest_first=newest_first,
+                              archive=archive
+                              )
+    if not result:
+      # Uploads stopped early. Keep the queue moving so downloads can still finish for the next run
+      print("⏳ Waiting for pending downloads to finish...")
+      while upload_queue.get() is not None:
+        pass
+    downloader.join()
+
+    if not download_result or not download_result[0]:
+      if not shutdown.is_set():
+        print("❌ Failed to obtain mapMyRide workouts.")
+      ledger.close()
+      return False
   else:
-    print("\n✅ Workouts downloaded. Uploading to Strava...\n")
+    result = f.download_mmr_workouts(headers=mmr_headers, output_dir=output_dir,
+                          workout_list=workouts.chronological(newest_first=newest_first),
+                          ledger=ledger,
+                          workers=download_workers,
+                          compress=compress,
+                          incremental=incremental,
+                          metrics=metrics,
+                          shutdown=shutdown
+                          )
+
+    if not result:
+      if not shutdown.is_set():
+        print("❌ Failed to obtain mapMyRide workouts.")
+      ledger.close()
+      return False
 
-  result = f.upload_workouts_to_strava(workouts_dir=f"{workdir}/{files_dir}",
-                            workout_list=workout_list,
-                            strava_access_token=strava_access_token
-                            )
+    if preprocess:
+      print("\n🧹 Workouts downloaded. Preprocessing them...\n")
+      if not tcx_preprocessor.preprocess_workouts(workouts_dir=output_dir, ledger=ledger, workers=preprocess_workers, downsample=downsample, fit=fit,
+                                                  shutdown=shutdown) and not shutdown.is_set():
+        # Those not preprocessed yet mustn't be uploaded as they are
+        print("❌ Failed to preprocess workouts. Run it again to resume where it was left off.")
+        ledger.close()
+        return False
+    if not shutdown.is_set():
+      print("\n✅ Workouts downloaded. Uploading to Strava...\n")
+
+    result = f.upload_workouts_to_strava(workouts_dir=output_dir,
+                              ledger=ledger,
+                              apps=apps,
+                              compress=compress,
+                              activity_index=activity_index,
+                              metrics=metrics,
+                              newest_first=newest_first,
+                              archive=archive
+                              )
+
+  metrics.estimate(workouts=ledger.counts())
+  report_failures(ledger=ledger, report_file=f"{output_dir}/failure_report.json")
+  ledger.close()
+  if shutdown.is_set():
+    print("🛑 Stopped cleanly. Run it again to resume where it was left off.")
+    return False
   if result:
     print("✅ Done. Workouts uploaded.")
-    sys.exit(0)
   else:
     print("❌ Failed to upload workouts to Strava.")
-    sys.exit(1)
+  return result
+
+def report_failures(ledger: workout_ledger, report_file: str, shown: int = 20) -> int:
+  """
+  Writes every workout stuck due to an error onto a JSON report, and prints the first few. Returns how many there are
+  """
+  failures = [{"workout_id": workout_id, "filename": filename, "status": status, "attempts": attempts, "error": error}
+              for workout_id, filename, status, attempts, error in ledger.failures()]
+  with open(report_file, mode="w", encoding="utf8") as file:
+    file.write(json.dumps(failures, indent=2))
+  if failures:
+    print(f"\n⚠️  \"{len(failures)}\" workout{'s' if len(failures) != 1 else ''} couldn't be migrated. Full report written to \"{report_file}\":")
+    for failure in failures[:shown]:
+      print(f"  ❌ {failure['workout_id']} \"{failure['filename']}\" ({failure['status']}, {failure['attempts']} failed attempts): {failure['error']}")
+    if len(failures) > shown:
+      print(f"  ... and {len(failures) - shown} more")
+  return len(failures)
+
+def extract_workouts(output_dir: str, workout_ids: list) -> bool:
+  """
+  Extracts workouts from the packed archive onto the current directory, as TCX files. Returns `True` if all of them were found, `False` if not
+  """
+  archive = workout_archive(archive_dir=f"{output_dir}/archive")
+  found = True
+  for workout_id in workout_ids:
+    outputfile = archive.extract(workout_id=workout_id.strip(), output_dir=os.getcwd())
+    if outputfile:
+      print(f"📤 Workout \"{workout_id}\" extracted to \"{outputfile}\"")
+    else:
+      print(f"❌ Workout \"{workout_id}\" isn't on the packed archive at \"{output_dir}/archive\"")
+      found = False
+  return found
+
+def run_batch(manifest_file: str, batch_workers: int = 0, summary_file: str = "", **options) -> bool:
+  """
+  Migrates all accounts listed on a manifest file at the same time, each isolated from the others. Returns `True` if all were successful, `False` if not
+  """
+  manifest_dir = os.path.dirname(os.path.realpath(manifest_file))
+  with open(manifest_file, mode="r", encoding="utf8") as file:
+    accounts = json.loads(file.read())
+
+  # A malformed manifest is caught before any account starts, rather than halfway through the batch
+  if not isinstance(accounts, list) or not accounts:
+    print(f"❌ Manifest \"{manifest_file}\" must be a non-empty list of accounts!")
+    return False
+  for position, account in enumerate(accounts, start=1):
+    missing = [key for key in ("name", "mmr_cookie", "output_dir", "secrets_file") if not isinstance(account, dict) or not account.get(key)]
+    if missing:
+      print(f"❌ Account #{position} on the manifest is missing: {', '.join(missing)}")
+      return False
+  names = [account["name"] for account in accounts]
+  duplicates = sorted({name for name in names if names.count(name) > 1})
+  if duplicates:
+    print(f"❌ Account names on the manifest must be unique. Repeated: {', '.join(duplicates)}")
+    return False
+
+  if summary_file == "":
+    summary_file = f"{manifest_dir}/batch_summary.json"
+  summary = {account["name"]: {"state": "queued"} for account in accounts}
+  summary_lock = threading.Lock()
+
+  def resolve(path: str) -> str:
+    # Relative paths on the manifest are relative to the manifest itself
+    return path if os.path.isabs(path) else f"{manifest_dir}/{path}"
+
+  def write_summary(name: str, **changes):
+    with summary_lock:
+      summary[name].update(changes)
+      with open(summary_file, mode="w", encoding="utf8") as file:
+        file.write(json.dumps({"updated_at": time.time(), "accounts": summary}, indent=2))
+
+  def ledger_counts(output_dir: str) -> dict:
+    # Accounts that failed before getting a ledger have nothing to count, and aren't given an empty one
+    if not os.path.isfile(f"{output_dir}/{workout_ledger.db_name}"):
+      return {}
+    ledger = workout_ledger(workouts_dir=output_dir)
+    try:
+      return ledger.counts()
+    finally:
+      ledger.close()
+
+  def migrate(account: dict) -> bool:
+    started_at = time.time()
+    counts = {}
+    try:
+      write_summary(account["name"], state="running", started_at=started_at)
+      output_dir = resolve(account["output_dir"])
+      # Either a single secrets file, or a list of them, one per strava API application
+      secrets_files = account["secrets_file"] if isinstance(account["secrets_file"], list) else account["secrets_file"].split(",")
+      account_options = dict(options)
+      if account_options.get("prometheus_file"):
+        # Each account gets its own textfile, so they don't overwrite each other's
+        root, extension = os.path.splitext(account_options["prometheus_file"])
+        account_options["prometheus_file"] = f"{root}-{account['name']}{extension}"
+      account_options["metrics_file"] = "" # Each account's summary stays on its own output directory
+      result = migrate_account(mmr_cookie=account["mmr_cookie"], secrets_file=",".join(resolve(path) for path in secrets_files),
+                               output_dir=output_dir, interactive=False, **account_options)
+    except: # One account failing must never take the others down
+      print(f"❌ Account \"{account['name']}\" failed: {sys.exc_info()[1]}")
+      result = False
+    try:
+      counts = ledger_counts(resolve(account["output_dir"]))
+    except:
+      print(f"⚠️  Account \"{account['name']}\" progress couldn't be read from its ledger: {sys.exc_info()[1]}")
+    write_summary(account["name"], state="done" if result else "failed", finished_at=time.time(),
+                  duration=round(time.time() - started_at), workouts=counts)
+    return result
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=batch_workers or len(accounts)) as executor:
+    results = list(executor.map(migrate, accounts)) # In the manifest's order
+
+  print(f"\n📋 Batch summary, also written to \"{summary_file}\":")
+  for account, result in zip(accounts, results):
+    print(f"  {'✅' if result else '❌'} {account['name']}: {summary[account['name']]['state']}, {summary[account['name']].get('workouts', {})}")
+  return all(results)
+
+def main(args):
+  """
+  Main program
+  """
+  # Let's get our flags...
+  FLAG_HELP = "--help" in args
+  if FLAG_HELP:
+    f.print_help_text(2)
+  FLAG_GZIP = "--gzip" in args
+  FLAG_PIPELINE = "--pipeline" in args
+  FLAG_INCREMENTAL = "--incremental" in args
+  FLAG_PREPROCESS = "--preprocess" in args
+  FLAG_SKIP_DUPLICATES = "--skip-duplicates" in args
+  FLAG_NEWEST_FIRST = "--newest-first" in args
+  FLAG_DAEMON = "--daemon" in args
+  FLAG_PACK_ARCHIVE = "--pack-archive" in args
+  FLAG_FIT = "--fit" in args
+
+  # Get args
+  workdir = os.path.dirname(os.path.realpath(__file__))
+  output_dir = f.get_argument_value(args=args, flag="--output-dir", separator="--output-dir=") or f"{workdir}/outputs"
+  extract = f.get_argument_value(args=args, flag="--extract", separator="--extract=")
+  if extract != "":
+    sys.exit(0 if extract_workouts(output_dir=output_dir, workout_ids=extract.split(",")) else 1)
+
+  manifest_file = f.get_argument_value(args=args, flag="--manifest", separator="--manifest=")
+  mmr_cookie = f.get_argument_value(args=args, flag="--mmr-cookie", separator="--mmr-cookie=")
+
+  if mmr_cookie == "" and manifest_file == "":
+    print("❌ Argument \"--mmr-cookie\" is missing or empty!")
+    f.print_help_text(1)
+
+  download_workers = f.get_argument_value(args=args, flag="--download-workers", separator="--download-workers=")
+  if download_workers == "":
+    download_workers = "1"
+  if not download_workers.isdigit() or int(download_workers) < 1:
+    print("❌ Argument \"--download-workers\" must be a number greater than zero!")
+    f.print_help_text(1)
+
+  downsample = f.get_argument_value(args=args, flag="--downsample", separator="--downsample=")
+  if downsample == "":
+    downsample = "0"
+  if not downsample.isdigit():
+    print("❌ Argument \"--downsample\" must be a number of seconds!")
+    f.print_help_text(1)
+
+  preprocess_workers = f.get_argument_value(args=args, flag="--preprocess-workers", separator="--preprocess-workers=")
+  if preprocess_workers == "":
+    preprocess_workers = "0"
+  if not preprocess_workers.isdigit():
+    print("❌ Argument \"--preprocess-workers\" must be a number!")
+    f.print_help_text(1)
+
+  batch_workers = f.get_argument_value(args=args, flag="--batch-workers", separator="--batch-workers=")
+  if batch_workers == "":
+    batch_workers = "0"
+  if not batch_workers.isdigit():
+    print("❌ Argument \"--batch-workers\" must be a number!")
+    f.print_help_text(1)
+
+  options = {
+    "download_workers": int(download_workers),
+    "compress": FLAG_GZIP,
+    "pipeline": FLAG_PIPELINE,
+    "incremental": FLAG_INCREMENTAL,
+    "preprocess": FLAG_PREPROCESS or int(downsample) > 0 or FLAG_FIT,
+    "preprocess_workers": int(preprocess_workers),
+    "downsample": int(downsample),
+    "skip_duplicates": FLAG_SKIP_DUPLICATES,
+    "metrics_file": f.get_argument_value(args=args, flag="--metrics=", separator="--metrics="),
+    "prometheus_file": f.get_argument_value(args=args, flag="--metrics-prom", separator="--metrics-prom="),
+    "daemon": FLAG_DAEMON,
+    "shutdown": threading.Event(),
+    "newest_first": FLAG_NEWEST_FIRST,
+    "pack_archive": FLAG_PACK_ARCHIVE,
+    "fit": FLAG_FIT
+  }
+
+  def stop(signum, _):
+    # Let whatever is in flight finish, so the ledger is left consistent, and the next run resumes right where this one stopped
+    print(f"\n🛑 Got {signal.Signals(signum).name}. Shutting down once the requests in flight are done...")
+    options["shutdown"].set()
+  signal.signal(signal.SIGTERM, stop)
+
+  if manifest_file != "":
+    result = run_batch(manifest_file=manifest_file, batch_workers=int(batch_workers),
+                       summary_file=f.get_argument_value(args=args, flag="--batch-summary", separator="--batch-summary="),
+                       **options)
+  else:
+    secrets_file = f.get_argument_value(args=args, flag="--secrets-file", separator="--secrets-file=")
+    result = migrate_account(mmr_cookie=mmr_cookie, secrets_file=secrets_file or f"{workdir}/temp/secrets.json",
+                             output_dir=output_dir, **options)
+
+  sys.exit(0 if result else 1)
 
 if __name__ == "__main__":
   main(args)
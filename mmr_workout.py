@@ -0,0 +1,64 @@
+"""
+This module contains the record describing each workout listed on mapmyride's CSV file
+"""
+import calendar
+
+class mmr_workout:
+  """
+  #### Description
+  A workout listed on mapmyride's CSV file, along with the name it's stored with once downloaded.
+
+  #### Notes
+  It's slotted, so the whole workout history can be held in memory at once, as a few hundred bytes per workout, to be sorted.
+  """
+  __slots__ = ("seq", "workout_id", "date", "workout_type", "notes", "link", "filename")
+  months = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+
+  def __init__(self, workout_id: str, date: int = 0, workout_type: str = "", notes: str = "", link: str = "", seq: int = 0, filename: str = None): # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    #### Description
+    Builds a new workout record
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `date`: The day the workout took place on, as a unix timestamp of its midnight UTC. `0` if unknown
+    - `workout_type`: The workout's activity type. i.e. `Road Cycling`
+    - `notes`: The workout's notes, used as the activity's description on strava
+    - `link`: The workout's link on mapmyride
+    - `seq`: The workout's position on the CSV file
+    - `filename`: The name the workout is stored with on disk. `None` until it's been downloaded
+    """
+    self.seq = seq
+    self.workout_id = workout_id
+    self.date = date
+    self.workout_type = workout_type
+    self.notes = notes
+    self.link = link
+    self.filename = filename
+
+  def __repr__(self) -> str:
+    return f"mmr_workout({self.workout_id!r}, date={self.date}, filename={self.filename!r})"
+
+  def sort_key(self) -> tuple:
+    """
+    #### Description
+    Gets the key that sorts workouts chronologically. Those on the same day are sorted by id, since mapmyride assigns them incrementally
+    #### Returns
+    - A `tuple` with the workout's date and id
+    """
+    return (self.date, int(self.workout_id) if self.workout_id.isdigit() else 0)
+
+  @classmethod
+  def parse_date(cls, text: str) -> int:
+    """
+    #### Description
+    Parses a date as written on mapmyride's CSV file. i.e. `Oct. 3, 2023`, `May 3, 2023` or `Sept. 3, 2023`
+    #### Parameters
+    - `text`: The date
+    #### Returns
+    - The date's midnight UTC, as a `unix timestamp`. `0` if it can't be parsed
+    """
+    try:
+      month, day, year = text.replace(".", "").replace(",", "").split()
+      return calendar.timegm((int(year), cls.months.index(month[:3].lower()) + 1, int(day), 0, 0, 0))
+    except:
+      return 0
@@ -0,0 +1,69 @@
+"""
+This module contains the in-memory index of all workouts listed on mapmyride's CSV file
+"""
+from collections.abc import Iterable, Iterator
+from mmr_workout import mmr_workout
+
+class mmr_workout_index:
+  """
+  #### Description
+  All workouts listed on mapmyride's CSV file, viewable in chronological order.
+
+  #### Notes
+  It's built once, right after the CSV file is downloaded, and shared by every stage. The chronological view is sorted the first time it's asked for,
+  and reused afterwards, in either direction, so no stage has to scan nor sort the workout list again.
+
+  Sorting needs every workout, so the whole CSV file is gone through before the first download starts. That's a single pass over a local file,
+  which takes a fraction of the time a single download does, but it means the index holds every workout listed in memory at once.
+
+  Workouts are kept by id, so those listed more than once on the CSV file are only indexed the first time, and never downloaded nor uploaded twice.
+  """
+  def __init__(self, workouts: Iterable[mmr_workout] = ()):
+    """
+    #### Description
+    Builds a new index
+    #### Parameters
+    - `workouts`: The workouts to fill it with. i.e. as generated by the `list_mmr_workouts()` function
+    """
+    self.by_id = {}
+    self.by_date = None
+    for workout in workouts:
+      self.add(workout)
+
+  def __len__(self) -> int:
+    return len(self.by_id)
+
+  def __iter__(self) -> Iterator[mmr_workout]:
+    """
+    #### Description
+    Iterates over all workouts, as ordered on the CSV file
+    """
+    return iter(self.by_id.values())
+
+  def add(self, workout: mmr_workout) -> bool:
+    """
+    #### Description
+    Adds a workout to the index
+    #### Parameters
+    - `workout`: The workout
+    #### Returns
+    - `True` if added, `False` if it was already there
+    """
+    if workout.workout_id in self.by_id:
+      return False
+    self.by_id[workout.workout_id] = workout
+    self.by_date = None
+    return True
+
+  def chronological(self, newest_first: bool = False) -> Iterator[mmr_workout]:
+    """
+    #### Description
+    Iterates over all workouts by the day they took place on
+    #### Parameters
+    - `newest_first`: Whether to begin with the most recent workout, instead of the oldest one. Defaults to `False`
+    #### Returns
+    - An `iterator` of workouts
+    """
+    if self.by_date is None:
+      self.by_date = sorted(self.by_id.values(), key=mmr_workout.sort_key)
+    return reversed(self.by_date) if newest_first else iter(self.by_date)
@@ -0,0 +1,131 @@
+"""
+This module contains the request body workouts are uploaded to strava with, streamed straight from disk
+"""
+import os
+import zlib
+
+class multipart_upload: # pylint: disable=too-many-instance-attributes
+  """
+  #### Description
+  A `multipart/form-data` request body, made of a few text fields plus a file, read from disk chunk by chunk as it's sent, optionally gzip-compressing the file on the fly.
+
+  #### Notes
+  It's a read-only file-like object, so `urllib3` streams it onto the socket as is, instead of encoding the whole body onto memory along with a copy of the file.
+  Only the multipart framing and a single chunk of the file are ever held in memory, however large the file is, so memory per upload in flight stays constant.
+
+  Its length is known upfront for files sent as they are, and sent as `Content-Length`. Those compressed on the fly are sent with `Transfer-Encoding: chunked` instead,
+  since their length isn't known until they've been compressed.
+
+  It can be rewound to its start, re-reading the file from scratch, so `urllib3` can send it again when retrying after a connection error.
+  """
+  chunk_size = 64 * 1024 # Bytes read from the file at a time
+
+  def __init__(self, fields: dict, file_field: str, path: str, filename: str, content_type: str, compress: bool = False): # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    #### Description
+    Builds a new body, opening the file it streams
+    #### Parameters
+    - `fields`: The text fields, sent ahead of the file
+    - `file_field`: The name of the field holding the file
+    - `path`: Full path to the file
+    - `filename`: The name the file is sent with
+    - `content_type`: The file's content type
+    - `compress`: Whether to gzip-compress the file while it's sent. Defaults to `False`
+    #### Notes
+    Raises an `OSError` if the file can't be opened
+    """
+    self.boundary = os.urandom(16).hex()
+    head = b""
+    for name, value in fields.items():
+      head += (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{self.quote(name)}\"\r\n\r\n").encode("utf8") + str(value).encode("utf8") + b"\r\n"
+    head += (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{self.quote(file_field)}\"; filename=\"{self.quote(filename)}\"\r\n"
+             f"Content-Type: {content_type}\r\n\r\n").encode("utf8")
+    self.head = head
+    self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf8")
+    self.compress = compress
+    self.file = open(path, mode="rb") # pylint: disable=consider-using-with
+    self.length = None if compress else len(self.head) + os.fstat(self.file.fileno()).st_size + len(self.tail)
+    self.sent = 0 # Bytes read from it so far
+    self.pending = b"" # Bytes read ahead of what's been asked for
+    self.parts = self.generate()
+
+  @staticmethod
+  def quote(value: str) -> str:
+    """
+    #### Description
+    Escapes a field or file name as browsers do, so it can't break out of its quotes
+    """
+    return value.replace("\r", "%0D").replace("\n", "%0A").replace("\"", "%22")
+
+  def headers(self) -> dict:
+    """
+    #### Description
+    Gets the headers the body must be sent with
+    #### Returns
+    - A `dict` with its `Content-Type`, including its boundary, and its `Content-Length` if known
+    """
+    headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+    if self.length is not None:
+      headers["Content-Length"] = str(self.length)
+    return headers
+
+  def generate(self):
+    """
+    #### Description
+    Generates the body, a chunk at a time, from the file's current position
+    """
+    yield self.head
+    compressor = zlib.compressobj(wbits=31) if self.compress else None # A gzip stream, as strava expects on "tcx.gz" and "fit.gz" uploads
+    for chunk in iter(lambda: self.file.read(self.chunk_size), b""):
+      yield compressor.compress(chunk) if compressor else chunk
+    if compressor:
+      yield compressor.flush()
+    yield self.tail
+
+  def read(self, size: int = -1) -> bytes:
+    """
+    #### Description
+    Reads the body's next bytes
+    #### Parameters
+    - `size`: The most bytes to read. Defaults to reading what's left of it
+    #### Returns
+    - The bytes read. An empty `bytes` once it's all been read
+    """
+    while size < 0 or len(self.pending) < size:
+      part = next(self.parts, None)
+      if part is None:
+        break
+      self.pending += part
+    data, self.pending = (self.pending, b"") if size < 0 else (self.pending[:size], self.pending[size:])
+    self.sent += len(data)
+    return data
+
+  def tell(self) -> int:
+    """
+    #### Description
+    Gets how many bytes have been read from it so far
+    """
+    return self.sent
+
+  def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+    """
+    #### Description
+    Rewinds the body to its start, so it can be sent again
+    #### Notes
+    Raises an `OSError` if asked to go anywhere but its start, or where it already is
+    """
+    if whence == os.SEEK_SET and offset == self.sent:
+      return self.sent
+    if whence != os.SEEK_SET or offset != 0:
+      raise OSError("Multipart uploads can only be rewound to their start")
+    self.file.seek(0)
+    self.sent, self.pending = 0, b""
+    self.parts = self.generate()
+    return 0
+
+  def close(self):
+    """
+    #### Description
+    Closes the file it streams
+    """
+    self.file.close()
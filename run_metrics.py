@@ -0,0 +1,183 @@
+"""
+This module contains the collector of each run's metrics, so where its time goes can be told apart
+"""
+import json
+import os
+import threading
+import time
+from strava_app_pool import strava_app_pool
+
+class run_metrics: # pylint: disable=too-many-instance-attributes
+  """
+  #### Description
+  Collects timings, byte counts and events from each stage of a run, and writes them as a JSON summary and, optionally, as a Prometheus textfile.
+
+  #### Notes
+  Stages recorded so far:
+    - `csv_fetch`: Downloading mapmyride's CSV file
+    - `download`: Downloading each TCX file, including the time spent on `decompress`, `compress` and `disk_write`, which are also recorded on their own
+    - `upload`: Each request to strava's uploads endpoint, so its latency
+    - `poll`: Each check on an upload's processing status
+    - `ratelimit_sleep`: Time spent waiting for strava's ratelimits to reset, as accounted by the `strava_app_pool` being tracked
+    - `oauth_check` & `oauth_refresh`: Requests to validate and refresh strava's access token
+
+  It's thread-safe, so a single instance can be shared by all stages of the same run.
+  """
+  prometheus_prefix = "mmr2strava"
+
+  def __init__(self, summary_file: str = "", prometheus_file: str = ""):
+    """
+    #### Description
+    Builds a new, empty collector
+    #### Parameters
+    - `summary_file`: Where to write the JSON summary to. Nothing is written if empty
+    - `prometheus_file`: Where to write the Prometheus textfile to. Nothing is written if empty
+    """
+    self.summary_file = summary_file
+    self.prometheus_file = prometheus_file
+    self.lock = threading.Lock()
+    self.started_at = time.time()
+    self.stages = {} # Stage -> {"calls", "seconds", "max_seconds", "bytes"}
+    self.events = {} # Event -> times it happened
+    self.workouts = {} # Status -> amount of workouts, as last seen on the ledger
+    self.eta = None # Seconds left, as last estimated
+    self.apps = None
+
+  def track(self, apps: strava_app_pool):
+    """
+    #### Description
+    Sets the scheduler whose sleeps are reported, and whose headroom bounds the ETA
+    #### Parameters
+    - `apps`: The scheduler spreading requests across strava API applications
+    """
+    self.apps = apps
+
+  def record(self, stage: str, seconds: float, size: int = 0):
+    """
+    #### Description
+    Records a stage having been gone through once
+    #### Parameters
+    - `stage`: The stage's name
+    - `seconds`: How long it took
+    - `size`: Bytes moved by it, if any
+    """
+    with self.lock:
+      stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0})
+      stats["calls"] += 1
+      stats["seconds"] += seconds
+      stats["max_seconds"] = max(stats["max_seconds"], seconds)
+      stats["bytes"] += size
+
+  def count(self, event: str, amount: int = 1):
+    """
+    #### Description
+    Counts an event. i.e. a retry or an error
+    #### Parameters
+    - `event`: The event's name
+    - `amount`: Times it happened
+    """
+    with self.lock:
+      self.events[event] = self.events.get(event, 0) + amount
+
+  def estimate(self, workouts: dict) -> float:
+    """
+    #### Description
+    Estimates how long it'll take to upload all remaining workouts, bound by both the current upload rate and the ratelimit's headroom
+    #### Parameters
+    - `workouts`: Amount of workouts on each state, as returned by the ledger's `counts()`
+    #### Returns
+    - The estimated `seconds` left
+    """
+    remaining = workouts.get("pending", 0) + workouts.get("downloaded", 0)
+    with self.lock:
+      self.workouts = dict(workouts)
+      uploads = self.stages.get("upload", {}).get("calls", 0)
+      polls = self.stages.get("poll", {}).get("calls", 0)
+      elapsed = time.time() - self.started_at
+    # Every upload is followed by at least a poll, so each workout costs two requests until told otherwise
+    requests_per_workout = (uploads + polls) / uploads if uploads else 2
+    by_rate = remaining / (uploads / elapsed) if uploads and elapsed > 0 else 0
+    by_quota = self.apps.time_for(requests=int(remaining * requests_per_workout)) if self.apps is not None else 0
+    eta = max(by_rate, by_quota)
+    with self.lock:
+      self.eta = eta
+    return eta
+
+  def summary(self) -> dict:
+    """
+    #### Description
+    Gets all metrics collected so far
+    #### Returns
+    - A `dict` with the run's duration, each stage's stats, each event's count, the workouts on each state and the last ETA
+    """
+    with self.lock:
+      stages = {stage: dict(stats) for stage, stats in self.stages.items()}
+      if self.apps is not None:
+        stages["ratelimit_sleep"] = {"calls": self.apps.sleeps, "seconds": self.apps.slept, "max_seconds": self.apps.max_sleep, "bytes": 0}
+      return {
+        "started_at": self.started_at,
+        "duration": time.time() - self.started_at,
+        "stages": stages,
+        "events": dict(self.events),
+        "workouts": dict(self.workouts),
+        "eta": self.eta
+      }
+
+  def prometheus(self) -> str:
+    """
+    #### Description
+    Renders all metrics collected so far in Prometheus' text exposition format
+    #### Returns
+    - The metrics, as a `string`
+    """
+    summary = self.summary()
+    p = self.prometheus_prefix
+    lines = [
+      f"# HELP {p}_run_duration_seconds Time since the run started",
+      f"# TYPE {p}_run_duration_seconds gauge",
+      f"{p}_run_duration_seconds {summary['duration']:.3f}",
+      f"# HELP {p}_eta_seconds Estimated time left to upload all remaining workouts",
+      f"# TYPE {p}_eta_seconds gauge",
+      f"{p}_eta_seconds {summary['eta'] if summary['eta'] is not None else 'NaN'}"
+    ]
+    for name, key, description in (("stage_calls_total", "calls", "Times each stage was gone through"),
+                                   ("stage_seconds_total", "seconds", "Time spent on each stage"),
+                                   ("stage_bytes_total", "bytes", "Bytes moved by each stage")):
+      lines += [f"# HELP {p}_{name} {description}", f"# TYPE {p}_{name} counter"]
+      lines += [f"{p}_{name}{{stage=\"{stage}\"}} {stats[key]}" for stage, stats in sorted(summary["stages"].items())]
+    lines += [f"# HELP {p}_events_total Times each event happened", f"# TYPE {p}_events_total counter"]
+    lines += [f"{p}_events_total{{event=\"{event}\"}} {amount}" for event, amount in sorted(summary["events"].items())]
+    lines += [f"# HELP {p}_workouts Workouts on each state", f"# TYPE {p}_workouts gauge"]
+    lines += [f"{p}_workouts{{status=\"{status}\"}} {amount}" for status, amount in sorted(summary["workouts"].items())]
+    return "\n".join(lines) + "\n"
+
+  def write(self):
+    """
+    #### Description
+    Writes the JSON summary and the Prometheus textfile, if set to
+    #### Notes
+    Each file is written onto a `.part` file first, then renamed, so readers like Prometheus' textfile collector never see a half-written one
+    """
+    for path, render in ((self.summary_file, lambda: json.dumps(self.summary(), indent=2)), (self.prometheus_file, self.prometheus)):
+      if not path:
+        continue
+      with open(f"{path}.part", mode="w", encoding="utf8") as file:
+        file.write(render())
+      os.replace(f"{path}.part", path)
+
+  @staticmethod
+  def format_eta(seconds: float) -> str:
+    """
+    #### Description
+    Formats an ETA for humans
+    #### Parameters
+    - `seconds`: The ETA, in seconds
+    #### Returns
+    - The ETA, as a `string` like `1h 05m` or `42s`
+    """
+    seconds = int(seconds)
+    if seconds >= 3600:
+      return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+      return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
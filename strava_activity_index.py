@@ -0,0 +1,130 @@
+"""
+This module contains the index of activities already on strava, used to skip uploading workouts that are already there
+"""
+import gzip
+import json
+import xml.etree.ElementTree as ET
+from endpoints import STRAVA_BASE_URL
+from http_transport import http_transport
+from strava_app_pool import strava_app_pool
+from tcx_preprocessor import TCX_NAMESPACE, parse_tcx_time
+
+class strava_activity_index:
+  """
+  #### Description
+  An in-memory index of an athlete's strava activities, keyed by their start time (bucketed) and distance.
+
+  #### Notes
+  It's built by paging through `/athlete/activities` once, which takes a request per 200 activities. Checking a workout against it takes none,
+  so on accounts that are mostly migrated already, it saves most of the requests otherwise wasted on uploads rejected as duplicates.
+
+  Reading activities requires the `activity:read_all` scope.
+  """
+  url = f"{STRAVA_BASE_URL}/api/v3/athlete/activities"
+  page_size = 200 # The most strava allows
+  bucket_seconds = 60 # Start times are compared within a minute of each other
+  distance_tolerance = 0.02 # Distances are compared within a 2% of each other
+  distance_slack = 50 # Meters always allowed between distances, for short or distance-less workouts
+
+  def __init__(self):
+    """
+    #### Description
+    Builds a new, empty index
+    """
+    self.buckets = {} # Start time bucket -> list of (distance, activity id)
+    self.size = 0
+
+  def add(self, start: float, distance: float, activity_id: int):
+    """
+    #### Description
+    Adds an activity to the index
+    #### Parameters
+    - `start`: The activity's start time, as a unix timestamp
+    - `distance`: The activity's distance, in meters
+    - `activity_id`: strava's activity id
+    """
+    self.buckets.setdefault(int(start // self.bucket_seconds), []).append((distance, activity_id))
+    self.size += 1
+
+  def find(self, start: float, distance: float) -> int:
+    """
+    #### Description
+    Looks for an activity matching a given start time and distance
+    #### Parameters
+    - `start`: The start time to look for, as a unix timestamp
+    - `distance`: The distance to look for, in meters
+    #### Returns
+    - The matching `activity id` if found. Otherwise `0`
+    """
+    bucket = int(start // self.bucket_seconds)
+    tolerance = max(distance * self.distance_tolerance, self.distance_slack)
+    # Neighbour buckets are checked too, so start times right by a bucket's edge still match
+    for candidate in (bucket - 1, bucket, bucket + 1):
+      for activity_distance, activity_id in self.buckets.get(candidate, ()):
+        if abs(activity_distance - distance) <= tolerance:
+          return activity_id
+    return 0
+
+  def load(self, apps: strava_app_pool) -> bool:
+    """
+    #### Description
+    Fills the index by paging through all of the athlete's activities on strava
+    #### Parameters
+    - `apps`: The strava API applications to list them with, each with its own credentials and ratelimiter
+    #### Returns
+    - `True` if successful, `False` if not, or if stopped through the applications' `shutdown` event between pages
+    """
+    http = http_transport.shared()
+    page = 1
+    while True:
+      if apps.shutdown.is_set():
+        return False
+      app = apps.acquire()
+      if app is None:
+        return False
+      credentials, ratelimiter = app
+      strava_access_token = credentials.token()
+      try:
+        response = http.request("GET", self.url, fields={"page": page, "per_page": self.page_size},
+                                headers={'Authorization': f'Bearer {strava_access_token}'})
+      except:
+        return False
+      ratelimiter.update(response.headers)
+
+      if response.status == 429:
+        ratelimiter.exhaust()
+        continue
+      if response.status != 200:
+        print(f"[strava] ⚠️  Unable to list existing activities ({response.status}). If the app lacks the \"activity:read_all\" scope, delete its access token from the secrets file to authorize it again")
+        return False
+
+      activities = json.loads(response.data)
+      for activity in activities:
+        self.add(start=parse_tcx_time(activity["start_date"]), distance=activity.get("distance") or 0, activity_id=activity["id"])
+      if len(activities) < self.page_size:
+        return True
+      page += 1
+
+  @staticmethod
+  def workout_summary(path: str) -> tuple:
+    """
+    #### Description
+    Gets a TCX workout's start time and distance, streaming through the file
+    #### Parameters
+    - `path`: Full path to the TCX file, which may be gzip-compressed
+    #### Returns
+    - A tuple containing the workout's `start time`, as a unix timestamp, and its `distance` in meters. The start time is `0` if not found
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    start, distance = 0, 0
+    with opener(path, mode="rb") as source:
+      for _, element in ET.iterparse(source, events=("end",)):
+        if element.tag == f"{{{TCX_NAMESPACE}}}Id" and not start and element.text:
+          start = parse_tcx_time(element.text)
+        elif element.tag == f"{{{TCX_NAMESPACE}}}Lap":
+          if not start and element.get("StartTime"):
+            start = parse_tcx_time(element.get("StartTime"))
+          lap_distance = element.find(f"{{{TCX_NAMESPACE}}}DistanceMeters")
+          distance += float(lap_distance.text) if lap_distance is not None and lap_distance.text else 0
+          element.clear() # Laps hold the trackpoints, so they're dropped right away to keep memory flat
+    return start, distance
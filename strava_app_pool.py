@@ -0,0 +1,109 @@
+"""
+This module contains the scheduler that spreads requests across several strava API applications
+"""
+import threading
+import time
+
+class strava_app_pool:
+  """
+  #### Description
+  Several strava API applications authorized by the same athlete, each with its own credentials and `strava_ratelimiter`, handed out one request at a time.
+
+  #### Notes
+  Strava's ratelimits are enforced per application, so each one added multiplies the requests that can be sent. Each request goes to the application with the most headroom left,
+  which spreads them evenly, as tracked by each one's ratelimiter from its own `x-ratelimit-*` headers. Only once all of them are used up does it wait, for the earliest reset.
+
+  A single application behaves exactly as its own ratelimiter would. It's thread-safe, so a single instance can be shared by everything that talks to strava on behalf of the same account.
+
+  Its waits can be cut short by setting its `shutdown` event, i.e. when the program is asked to stop, in which case no more requests are handed out.
+  """
+  def __init__(self, apps: list, wait_for_daily: bool = False, shutdown: threading.Event = None):
+    """
+    #### Description
+    Builds a new pool
+    #### Parameters
+    - `apps`: The applications, each as a `(strava_credentials, strava_ratelimiter)` tuple
+    - `wait_for_daily`: Whether to sleep until the daily window resets once all applications have used up their quota, instead of giving up. Defaults to `False`
+    - `shutdown`: Event that, once set, cuts any wait short and stops handing out requests. A new one is used if not provided
+    """
+    self.lock = threading.Lock()
+    self.apps = list(apps)
+    self.wait_for_daily = wait_for_daily
+    self.shutdown = shutdown if shutdown is not None else threading.Event()
+    self.sleeps = 0 # Times it's waited for a reset
+    self.slept = 0.0 # Seconds spent waiting for resets
+    self.max_sleep = 0.0
+
+  def __len__(self) -> int:
+    with self.lock:
+      return len(self.apps)
+
+  def acquire(self) -> tuple:
+    """
+    #### Description
+    Picks the application to send the next request with, sleeping until the earliest reset if all of them have been used up
+    #### Returns
+    - A `(strava_credentials, strava_ratelimiter)` tuple once a request can be sent. `None` if all daily quotas have been used up and it's not set to wait for them,
+      if it's been shut down, or if there are no applications left
+    """
+    while True:
+      if self.shutdown.is_set():
+        return None
+      with self.lock:
+        apps = sorted(self.apps, key=lambda app: app[1].headroom(), reverse=True)
+      if not apps:
+        return None
+
+      waits = []
+      for app in apps:
+        wait = app[1].reserve()
+        if wait == 0:
+          return app
+        waits.append((app[1].exhausted(), wait))
+
+      if all(exhausted for exhausted, _ in waits):
+        if not self.wait_for_daily:
+          return None
+        wait = min(wait for _, wait in waits)
+        print(f"\n💤 Daily ratelimit reached. Sleeping {round(wait / 3600, 1)} hours, until it gets reset at "
+              f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(time.time() + wait))} UTC\n")
+      else:
+        wait = min(wait for exhausted, wait in waits if not exhausted)
+        print(f"\n⏰ 15-min ratelimit reached. Waiting {round(wait / 60, 1)} minutes, until it gets reset\n")
+
+      if self.shutdown.wait(wait):
+        return None
+      with self.lock:
+        self.sleeps += 1
+        self.slept += wait
+        self.max_sleep = max(self.max_sleep, wait)
+
+  def discard(self, app: tuple) -> int:
+    """
+    #### Description
+    Stops handing out an application. i.e. once strava keeps rejecting its access token
+    #### Parameters
+    - `app`: The application, as returned by `acquire()`
+    #### Returns
+    - The amount of applications left
+    """
+    with self.lock:
+      if app in self.apps:
+        self.apps.remove(app)
+      return len(self.apps)
+
+  def time_for(self, requests: int) -> float:
+    """
+    #### Description
+    Calculates how long it'd take, at the very least, for a given amount of requests to be allowed, spread evenly across all applications
+    #### Parameters
+    - `requests`: The amount of requests
+    #### Returns
+    - The `seconds` it'd take. `0` if all of them fit within the current windows
+    """
+    with self.lock:
+      ratelimiters = [ratelimiter for _, ratelimiter in self.apps]
+    if not ratelimiters:
+      return 0
+    share = -(-requests // len(ratelimiters))
+    return max(ratelimiter.time_for(share) for ratelimiter in ratelimiters)
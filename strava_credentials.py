@@ -0,0 +1,107 @@
+"""
+This module contains the holder of an account's strava credentials, which keeps its access token fresh throughout long runs
+"""
+import threading
+import time
+from run_metrics import run_metrics
+from strava_oauth import strava_oauth as oauth
+
+class strava_credentials: # pylint: disable=too-many-instance-attributes
+  """
+  #### Description
+  An account's strava credentials, as stored on its secrets file, renewing the access token ahead of its expiry.
+
+  #### Notes
+  Strava's access tokens last 6 hours, and their expiry is told by the token endpoint itself. Since it's stored on the secrets file,
+  a token can be known to be valid, or about to expire, without spending a request on checking it. Runs forced to span several days
+  by the daily ratelimit get their token renewed as needed, instead of failing with `401`s.
+
+  It's thread-safe, so a single instance can be shared by everything that talks to strava on behalf of the same account.
+  """
+  refresh_margin = 600 # Seconds before its expiry in which a token gets renewed
+
+  def __init__(self, secrets_file: str, client_id: str, client_secret: str, access_token: str = "", refresh_token: str = "", # pylint: disable=too-many-arguments,too-many-positional-arguments
+               expires_at: int = 0, athlete_id: int = 0, metrics: run_metrics = None):
+    """
+    #### Description
+    Builds a new holder for an account's credentials
+    #### Parameters
+    - `secrets_file`: full path to the file where secrets are stored. Renewed tokens get written onto it
+    - `client_id`: strava's client ID (from strava's API settings)
+    - `client_secret`: strava's client secret (from strava's API settings)
+    - `access_token`: strava's access token
+    - `refresh_token`: strava's refresh token
+    - `expires_at`: when the access token expires, as a unix timestamp. `0` if unknown
+    - `athlete_id`: the id of the strava athlete who authorized the app. `0` if unknown
+    - `metrics`: If provided, each token refresh's latency gets recorded on it
+    """
+    self.lock = threading.Lock()
+    self.secrets_file = secrets_file
+    self.client_id = client_id
+    self.client_secret = client_secret
+    self.access_token = access_token
+    self.refresh_token = refresh_token
+    self.expires_at = expires_at
+    self.athlete_id = athlete_id
+    self.metrics = metrics
+
+  def expiring(self) -> bool:
+    """
+    #### Description
+    Tells whether the access token is expired, or about to. Tokens whose expiry is unknown never are
+    """
+    return self.expires_at != 0 and self.expires_at - self.refresh_margin <= time.time()
+
+  def token(self) -> str:
+    """
+    #### Description
+    Gets the access token, renewing it first if it's about to expire
+    #### Returns
+    - A valid `access token`, or an `empty string` if it's expired and couldn't be renewed
+    """
+    with self.lock:
+      if self.expiring() and not self.refresh() and self.expires_at <= time.time():
+        return ""
+      return self.access_token
+
+  def renew(self, stale_token: str) -> bool:
+    """
+    #### Description
+    Renews the access token after strava rejected it. i.e. with a `401`
+    #### Parameters
+    - `stale_token`: The token rejected. If it's been renewed meanwhile by some other thread, it isn't renewed again
+    #### Returns
+    - `True` if successful, `False` if not
+    """
+    with self.lock:
+      if stale_token != self.access_token:
+        return self.access_token != ""
+      return self.refresh()
+
+  def refresh(self) -> bool:
+    """
+    #### Description
+    Gets a new access token with the refresh token, then writes both onto the secrets file. Must be called while holding the lock
+    #### Returns
+    - `True` if successful, `False` if not
+    """
+    try:
+      access_token, refresh_token, expires_at = oauth.refresh_access_token(client_id=self.client_id, client_secret=self.client_secret,
+                                                                           refresh_token=self.refresh_token, metrics=self.metrics)
+    except: # i.e. a connection error. The current token is kept, in case it's still valid
+      return False
+    if access_token == "":
+      return False
+    self.access_token, self.refresh_token, self.expires_at = access_token, refresh_token, expires_at
+    self.save()
+    print(f"[strava] 🔄 Access token renewed. It expires at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}")
+    return True
+
+  def save(self):
+    """
+    #### Description
+    Writes the credentials onto the secrets file
+    """
+    oauth.write_secrets_file(secrets_file=self.secrets_file, client_id=self.client_id, client_secret=self.client_secret,
+                             access_token=self.access_token, refresh_token=self.refresh_token, expires_at=self.expires_at,
+                             athlete_id=self.athlete_id)
@@ -4,10 +4,11 @@ This module contains all functions related to strava's oauth flow
 import os
 import json
 import getpass as g
+import time
 from urllib.parse import urlencode
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from webbrowser import open_new_tab
-import requests
+from endpoints import STRAVA_BASE_URL
+from http_transport import http_transport
+from run_metrics import run_metrics
 
 class strava_oauth:
   """
@@ -21,9 +22,16 @@ class strava_oauth:
     #### Parameters
     - `client_id`: client ID from strava's API config
     - `client_secret`: client secret from strava's API config
+    #### Returns
+    - A tuple containing the `access token`, the `refresh token`, when the access token expires, as a `unix timestamp`, and the id of the athlete who authorized it.
+      Empty strings and `0`s if unsuccessful
     #### Notes
-    Interactive function. It'll open a browser tab asking the used to authorize this app for read access
+    Interactive function. It'll open a browser tab asking the used to authorize this app for read access.
+    The local server and browser modules it needs are only imported here, since most runs already hold a valid token and never get this far
     """
+    # pylint: disable=import-outside-toplevel
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from webbrowser import open_new_tab
 
     # Get auth successful screen
     with open(f"{os.path.dirname(os.path.realpath(__file__))}/oauth_success.htm", mode="r", encoding="utf8") as file:
@@ -31,7 +39,7 @@ class strava_oauth:
 
     # Step 1: Get Authorization Code
     redirect_uri = 'http://localhost:8000/'
-    auth_url = f'https://www.strava.com/oauth/authorize?{urlencode({"client_id": client_id, "redirect_uri": redirect_uri, "response_type": "code", "scope": "activity:write"})}'
+    auth_url = f'{STRAVA_BASE_URL}/oauth/authorize?{urlencode({"client_id": client_id, "redirect_uri": redirect_uri, "response_type": "code", "scope": "activity:write,activity:read_all"})}'
     print("[strava] \033[93m🟡 Please authorize this script to write to your Strava profile\033[0m")
     print("[strava] \033[93m   Ensure the app being authorized is actually yours on Strava's website\033[0m")
     open_new_tab(auth_url)
@@ -50,22 +58,26 @@ class strava_oauth:
         """
         code = self.path.split('code=')[1].split("&")[0]
         # Exchange Authorization Code for Access Token
-        token_url = 'https://www.strava.com/oauth/token'
+        token_url = f'{STRAVA_BASE_URL}/oauth/token'
         payload = {
           'client_id': client_id,
           'client_secret': client_secret,
           'code': code,
           'grant_type': 'authorization_code'
         }
-        response = requests.post(token_url, data=payload, timeout=60)
-        if response.status_code != 200:
+        response = http_transport.shared().request("POST", token_url, fields=payload, multipart=False)
+        if response.status != 200:
           self.server.access_token = ""
           self.server.refresh_token = ""
+          self.server.expires_at = 0
+          self.server.athlete_id = 0
         else:
           # Store access_token as an instance variable,
           # so we can return it later from the do_auth_flow function
           self.server.access_token = response.json().get('access_token')
           self.server.refresh_token = response.json().get('refresh_token')
+          self.server.expires_at = response.json().get('expires_at', 0)
+          self.server.athlete_id = (response.json().get('athlete') or {}).get('id', 0)
 
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
@@ -75,9 +87,9 @@ class strava_oauth:
     # Start the local server to handle the OAuth redirect
     server = HTTPServer(('localhost', 8000), RequestHandler)
     server.handle_request()
-    return server.access_token, server.refresh_token
+    return server.access_token, server.refresh_token, server.expires_at, server.athlete_id
 
-  def refresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> str:
+  def refresh_access_token(client_id: str, client_secret: str, refresh_token: str, metrics: run_metrics = None) -> tuple:
     """
     #### Description
     This function gets a new access token using strava's oauth refresh token
@@ -85,10 +97,14 @@ class strava_oauth:
     - `client_id`: client ID from strava's API config page
     - `client_secret`: client secret from strava's API config page
     - `refresh_token`: strava's refresh token
+    - `metrics`: If provided, the request's latency gets recorded on it
     #### Returns
-    A `valid strava's access token` if successful. Otherwise an `empty string`
+    A tuple containing a `valid strava's access token`, the `refresh token` to use next time, and when the access token expires, as a `unix timestamp`.
+    Empty strings and `0` if unsuccessful
+    #### Notes
+    Strava may rotate the refresh token on each refresh, so the one returned must always replace the one used
     """
-    token_url = 'https://www.strava.com/oauth/token'
+    token_url = f'{STRAVA_BASE_URL}/oauth/token'
     payload = {
       'client_id': client_id,
       'client_secret': client_secret,
@@ -96,29 +112,36 @@ class strava_oauth:
       'grant_type': 'refresh_token'
     }
 
-    response = requests.post(token_url, data=payload, timeout=60)
+    started = time.perf_counter()
+    response = http_transport.shared().request("POST", token_url, fields=payload, multipart=False)
+    if metrics is not None:
+      metrics.record("oauth_refresh", time.perf_counter() - started)
 
-    if response.status_code == 200:
-      access_token = response.json().get('access_token')
-      return access_token
-    print(f"[strava] Error refreshing access token: {response.status_code}, {response.text}")
-    return ""
+    if response.status == 200:
+      tokens = response.json()
+      return tokens.get('access_token'), tokens.get('refresh_token', refresh_token), tokens.get('expires_at', 0)
+    print(f"[strava] Error refreshing access token: {response.status}, {response.data.decode('utf8', errors='replace')}")
+    return "", "", 0
 
-  def check_access_token(access_token: str) -> bool:
+  def check_access_token(access_token: str, metrics: run_metrics = None) -> bool:
     """
     #### Description
     Checks if the provided strava access token is still valid
     #### Parameters
     - `access_token`: strava's access token
+    - `metrics`: If provided, the request's latency gets recorded on it
     #### Returns
     `True` if valid, `False` otherwise
     """
-    check_url = 'https://www.strava.com/api/v3/athlete'
+    check_url = f'{STRAVA_BASE_URL}/api/v3/athlete'
     headers = {'Authorization': f'Bearer {access_token}'}
 
-    response = requests.get(check_url, headers=headers, timeout=60)
+    started = time.perf_counter()
+    response = http_transport.shared().request("GET", check_url, headers=headers)
+    if metrics is not None:
+      metrics.record("oauth_check", time.perf_counter() - started)
 
-    if response.status_code == 200:
+    if response.status == 200:
       return True
     return False
 
@@ -143,17 +166,21 @@ class strava_oauth:
     #### Parameters
     - `secrets_file`: full path to the file where secrets are stored
     #### Returns
-    - A list containing all of the app's secrets
+    - A list containing all of the app's secrets, plus when the access token expires and the id of the athlete who authorized it
     #### Notes
+    Files written by previous versions lack the access token's expiry and the athlete's id, so they're returned as `0`, meaning unknown
     """
     with open(f"{secrets_file}", mode="r", encoding="utf8") as f:
       config = json.loads(f.read())
       return config['access_token'], \
             config['refresh_token'], \
             config['client_id'], \
-            config['client_secret']
+            config['client_secret'], \
+            int(config.get('expires_at', 0)), \
+            int(config.get('athlete_id', 0))
 
-  def write_secrets_file(secrets_file: str, client_id: str, client_secret: str, access_token: str = "", refresh_token: str = ""):
+  def write_secrets_file(secrets_file: str, client_id: str, client_secret: str, access_token: str = "", refresh_token: str = "", expires_at: int = 0, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                         athlete_id: int = 0):
     """
     #### Description
     Writes the app's secrets file to disk
@@ -163,7 +190,9 @@ class strava_oauth:
     - `client_secret`: strava's client secret (from strava's API settings)
     - `access_token`: strava's access token
     - `refresh_token`: strava's refresh token
+    - `expires_at`: when the access token expires, as a unix timestamp. `0` if unknown
+    - `athlete_id`: the id of the strava athlete who authorized the app. `0` if unknown
     """
     with open(f"{secrets_file}", mode="w", encoding="utf8") as f:
-      buffer = f'{{"client_id": "{client_id}", "client_secret": "{client_secret}", "access_token": "{access_token}", "refresh_token": "{refresh_token}"}}'
+      buffer = f'{{"client_id": "{client_id}", "client_secret": "{client_secret}", "access_token": "{access_token}", "refresh_token": "{refresh_token}", "expires_at": {int(expires_at)}, "athlete_id": {int(athlete_id)}}}'
       f.write(buffer)
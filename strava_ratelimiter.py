@@ -0,0 +1,180 @@
+"""
+This module contains the scheduler that paces requests to strava's API as per its ratelimiter
+"""
+import threading
+import time
+
+class strava_ratelimiter:
+  """
+  #### Description
+  A token bucket that mirrors [strava's API ratelimiter](https://developers.strava.com/docs/rate-limits/), so requests are paced to use its full quota without idle gaps.
+
+  #### Notes
+  Strava's 15-minute windows reset at natural 15-minute intervals (0, 15, 30 and 45 minutes after the hour), and its daily window resets at midnight UTC.
+  The bucket is refilled exactly at those boundaries, and it's kept in sync with strava's own accounting by feeding it the `x-ratelimit-*` headers from each response.
+
+  It never waits on its own. `strava_app_pool` takes tokens from it, and decides how long to wait when there are none left.
+  It's thread-safe, so a single instance can be shared by everything that talks to strava on behalf of the same API application.
+  """
+  short_window = 900 # 15 minutes, in seconds
+  daily_window = 86400 # A day, in seconds
+  reset_margin = 2 # Seconds to wait past a reset, to make up for small clock differences with strava
+
+  def __init__(self, short_limit: int = 100, daily_limit: int = 1000):
+    """
+    #### Description
+    Builds a new, full token bucket
+    #### Parameters
+    - `short_limit`: Requests allowed every 15 minutes. Replaced by strava's own value as soon as a response is received
+    - `daily_limit`: Requests allowed every day. Replaced by strava's own value as soon as a response is received
+    """
+    self.lock = threading.Lock()
+    self.short_limit = short_limit
+    self.daily_limit = daily_limit
+    self.short_usage = 0
+    self.daily_usage = 0
+    self.short_reset = self.next_reset(time.time(), self.short_window)
+    self.daily_reset = self.next_reset(time.time(), self.daily_window)
+
+  @staticmethod
+  def next_reset(now: float, window: int) -> float:
+    """
+    #### Description
+    Calculates when the clock-aligned window that contains a given moment ends
+    #### Parameters
+    - `now`: The moment, as a unix timestamp
+    - `window`: The window's length, in seconds
+    #### Returns
+    - The window's end, as a `unix timestamp`
+    """
+    return (now // window + 1) * window
+
+  def roll(self, now: float):
+    """
+    #### Description
+    Refills the bucket if any of its windows has been reset since it was last used. Must be called while holding the lock
+    #### Parameters
+    - `now`: The current moment, as a unix timestamp
+    """
+    if now >= self.short_reset:
+      self.short_usage = 0
+      self.short_reset = self.next_reset(now, self.short_window)
+    if now >= self.daily_reset:
+      self.daily_usage = 0
+      self.daily_reset = self.next_reset(now, self.daily_window)
+
+  def reserve(self) -> float:
+    """
+    #### Description
+    Takes a token from the bucket if there's any left, without waiting
+    #### Returns
+    - `0` if a request can be sent right away. Otherwise, the `seconds` until the window that's been used up resets, and a token could be taken again
+    """
+    with self.lock:
+      now = time.time()
+      self.roll(now)
+      if self.daily_usage >= self.daily_limit:
+        return self.daily_reset - now + self.reset_margin
+      if self.short_usage >= self.short_limit:
+        return self.short_reset - now + self.reset_margin
+      self.short_usage += 1
+      self.daily_usage += 1
+      return 0
+
+  def exhausted(self) -> bool:
+    """
+    #### Description
+    Tells whether the daily quota has been used up
+    """
+    with self.lock:
+      self.roll(time.time())
+      return self.daily_usage >= self.daily_limit
+
+  def headroom(self) -> int:
+    """
+    #### Description
+    Tells how many requests could be sent right away
+    #### Returns
+    - The amount of `requests` left on the current windows
+    """
+    with self.lock:
+      self.roll(time.time())
+      return max(min(self.short_limit - self.short_usage, self.daily_limit - self.daily_usage), 0)
+
+  def update(self, headers):
+    """
+    #### Description
+    Syncs the bucket with strava's own accounting
+    #### Parameters
+    - `headers`: The headers from strava's response, containing both `x-ratelimit-limit` and `x-ratelimit-usage`
+    """
+    limit = headers.get("x-ratelimit-limit", "")
+    usage = headers.get("x-ratelimit-usage", "")
+    if limit.count(",") != 1 or usage.count(",") != 1:
+      return # Not all responses carry them. i.e. some errors
+
+    # [15min-limit, daily-limit] & [15min-limit-usage, daily-limit-usage]
+    short_limit, daily_limit = [int(value) for value in limit.split(",")]
+    short_usage, daily_usage = [int(value) for value in usage.split(",")]
+
+    with self.lock:
+      self.roll(time.time())
+      self.short_limit, self.daily_limit = short_limit, daily_limit
+      # Requests still in flight may not have been accounted for by strava yet, so never go below our own count
+      self.short_usage = max(self.short_usage, short_usage)
+      self.daily_usage = max(self.daily_usage, daily_usage)
+
+  def exhaust(self):
+    """
+    #### Description
+    Empties the current 15-minute window, so requests wait for its reset. Meant to be called when strava replies with a `429`
+    """
+    with self.lock:
+      self.roll(time.time())
+      self.short_usage = max(self.short_usage, self.short_limit)
+
+  def time_for(self, requests: int) -> float:
+    """
+    #### Description
+    Calculates how long it'd take, at the very least, for a given amount of requests to be allowed
+    #### Parameters
+    - `requests`: The amount of requests
+    #### Returns
+    - The `seconds` it'd take. `0` if all of them fit within the current windows
+    """
+    with self.lock:
+      now = time.time()
+      self.roll(now)
+      moment, short_reset, daily_reset = now, self.short_reset, self.daily_reset
+      short_left = max(self.short_limit - self.short_usage, 0)
+      daily_left = max(self.daily_limit - self.daily_usage, 0)
+      short_limit, daily_limit = self.short_limit, self.daily_limit
+
+    if short_limit <= 0 or daily_limit <= 0:
+      return 0
+    # Go window by window, jumping to the next reset whenever the requests left don't fit
+    while True:
+      taken = min(requests, short_left, daily_left)
+      requests -= taken
+      short_left, daily_left = short_left - taken, daily_left - taken
+      if requests <= 0:
+        return moment - now
+      if daily_left <= 0:
+        moment = daily_reset
+        daily_reset += self.daily_window
+        short_reset = self.next_reset(moment, self.short_window)
+        short_left, daily_left = short_limit, daily_limit
+      else:
+        moment = short_reset
+        short_reset += self.short_window
+        short_left = short_limit
+
+  def status(self) -> str:
+    """
+    #### Description
+    Describes the bucket's current usage
+    #### Returns
+    - A `string` with both the 15-minute and daily usage, as `[used/limit]`
+    """
+    with self.lock:
+      return f"15m ratelimit [used/limit]: [{self.short_usage}/{self.short_limit}] daily ratelimit [used/limit]: [{self.daily_usage}/{self.daily_limit}]"
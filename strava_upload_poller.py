@@ -0,0 +1,159 @@
+"""
+This module contains the background poller that follows up on strava's upload processing
+"""
+import heapq
+import json
+import threading
+import time
+from endpoints import STRAVA_BASE_URL
+from http_transport import http_transport
+from run_metrics import run_metrics
+from strava_app_pool import strava_app_pool
+from workout_ledger import workout_ledger
+
+class strava_upload_poller: # pylint: disable=too-many-instance-attributes
+  """
+  #### Description
+  Polls strava, from a background thread, for the outcome of each upload, recording it on the ledger.
+
+  #### Notes
+  Strava processes uploads asynchronously, so a `201` from its uploads endpoint only means the file was queued. Each upload is checked on `/uploads/{id}`,
+  in batches of those that are due, backing off exponentially while strava is still processing it.
+
+  Polls go through the same `strava_app_pool` as uploads, so they count against the same quotas.
+  """
+  url = f"{STRAVA_BASE_URL}/api/v3/uploads"
+  batch_size = 10 # Uploads to check on each round
+  base_delay = 2 # Seconds to wait before the first check of each upload
+  max_delay = 120 # Seconds between checks, at most
+  max_attempts = 10 # Checks per upload before giving up on it for this run
+
+  def __init__(self, ledger: workout_ledger, apps: strava_app_pool, metrics: run_metrics = None):
+    """
+    #### Description
+    Builds a new poller. It doesn't start polling until `start()` is called
+    #### Parameters
+    - `ledger`: The ledger where to record each upload's outcome
+    - `apps`: The strava API applications to poll with, each with its own credentials and ratelimiter
+    - `metrics`: If provided, each check's latency gets recorded on it
+    """
+    self.ledger = ledger
+    self.metrics = metrics
+    self.apps = apps
+    self.http = http_transport.shared()
+    self.pending = [] # Heap of (due time, attempt, workout id, upload id)
+    self.condition = threading.Condition()
+    self.stopping = False
+    self.draining = False
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    """
+    #### Description
+    Starts polling, beginning with those uploads left unresolved by previous runs
+    """
+    for workout_id, upload_id in self.ledger.unresolved_uploads():
+      self.add(workout_id=workout_id, upload_id=upload_id)
+    self.thread.start()
+
+  def add(self, workout_id: str, upload_id: int, attempt: int = 0):
+    """
+    #### Description
+    Schedules an upload to be checked
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `upload_id`: The upload id returned by strava
+    - `attempt`: How many times it's been checked already. Used to back off
+    """
+    delay = min(self.base_delay * 2 ** attempt, self.max_delay)
+    with self.condition:
+      heapq.heappush(self.pending, (time.time() + delay, attempt, workout_id, upload_id))
+      self.condition.notify()
+
+  def run(self):
+    """
+    #### Description
+    The poller's loop. Waits for uploads to be due, then checks them in batches
+    """
+    while True:
+      with self.condition:
+        while not self.stopping and (not self.pending or self.pending[0][0] > time.time()):
+          if self.draining and not self.pending:
+            return
+          self.condition.wait(timeout=self.pending[0][0] - time.time() if self.pending else None)
+        if self.stopping:
+          return
+        batch = []
+        while self.pending and self.pending[0][0] <= time.time() and len(batch) < self.batch_size:
+          batch.append(heapq.heappop(self.pending))
+
+      for _, attempt, workout_id, upload_id in batch:
+        self.poll(workout_id=workout_id, upload_id=upload_id, attempt=attempt)
+
+  def poll(self, workout_id: str, upload_id: int, attempt: int):
+    """
+    #### Description
+    Checks an upload on strava, then records its outcome or schedules it to be checked again
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `upload_id`: The upload id returned by strava
+    - `attempt`: How many times it's been checked already
+    """
+    app = self.apps.acquire()
+    if app is None:
+      # No quota left. Unresolved uploads remain recorded as such, and will be checked on the next run
+      self.stop()
+      return
+
+    credentials, ratelimiter = app
+    strava_access_token = credentials.token()
+    started = time.perf_counter()
+    try:
+      response = self.http.request("GET", f"{self.url}/{upload_id}", headers={'Authorization': f'Bearer {strava_access_token}'})
+    except:
+      response = None
+    if self.metrics is not None:
+      if response is not None:
+        self.metrics.record("poll", time.perf_counter() - started)
+      if response is None or response.status != 200:
+        self.metrics.count(f"poll_{response.status if response is not None else 'errors'}")
+
+    if response is not None:
+      ratelimiter.update(response.headers)
+      if response.status == 429:
+        ratelimiter.exhaust()
+      elif response.status == 401:
+        # The token got revoked or expired ahead of time. It's checked again once renewed
+        credentials.renew(stale_token=strava_access_token)
+      elif response.status == 200:
+        upload = json.loads(response.data)
+        if upload.get("error"):
+          print(f"❌ Workout \"{workout_id}\" was rejected by strava: {upload['error']}")
+          self.ledger.mark_failed(workout_id=workout_id, error=upload["error"])
+          return
+        if upload.get("activity_id"):
+          self.ledger.mark_processed(workout_id=workout_id, activity_id=upload["activity_id"])
+          return
+
+    if attempt + 1 < self.max_attempts:
+      self.add(workout_id=workout_id, upload_id=upload_id, attempt=attempt + 1)
+
+  def stop(self):
+    """
+    #### Description
+    Stops polling right away. Uploads not yet resolved are checked on the next run
+    """
+    with self.condition:
+      self.stopping = True
+      self.condition.notify()
+
+  def finish(self):
+    """
+    #### Description
+    Waits for all scheduled uploads to be resolved, or given up on, then stops polling
+    """
+    with self.condition:
+      self.draining = True
+      self.condition.notify()
+    if self.thread.is_alive():
+      self.thread.join()
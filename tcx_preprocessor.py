@@ -0,0 +1,447 @@
+"""
+This module contains the optional stage that shrinks and validates TCX files before they get uploaded, optionally converting them into FIT files.
+
+  - `preprocess_tcx()`: rewrites a TCX file without redundant trackpoints nor empty extension blocks
+  - `read_tcx()`: reads a TCX file's laps and trackpoints onto an activity, as taken by the `fit_file` module
+  - `fit_filename()`: gets the name a workout's FIT file is stored with
+  - `convert_to_fit()`: converts a TCX file into a FIT file, checking nothing gets lost on the way
+  - `preprocess_workout()`: preprocesses a single workout, reporting invalid files instead of raising. Meant to be run on a process pool
+  - `pool_context()`: gets the way preprocessing processes get started, never forking them
+  - `preprocess_workouts()`: preprocesses all downloaded workouts across a process pool
+  - `preprocess_queue()`: preprocesses workouts as they get downloaded, when running on pipeline mode
+
+For more details onto each function, these are also docstring'd.
+"""
+import concurrent.futures
+import gzip
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import fit_file
+from workout_ledger import workout_ledger
+
+TCX_NAMESPACE = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+EXTENSION_NAMESPACE = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
+FIT_SPORTS = {"Running": 1, "Biking": 2} # TCX sport -> FIT sport. Any other is generic
+
+def parse_tcx_time(value: str) -> float:
+  """
+  #### Description
+  Parses a TCX timestamp.
+
+  #### Parameters
+    - `value`: The timestamp, in ISO 8601 format. i.e. `2023-10-03T17:30:12Z`
+
+  #### Returns
+    - The timestamp, as a `unix timestamp`
+  """
+  return datetime.fromisoformat(value.strip().replace("Z", "+00:00")).timestamp()
+
+def trackpoint_readings(trackpoint: ET.Element) -> tuple:
+  """
+  #### Description
+  Gets all of a trackpoint's readings but its time, so two trackpoints can be compared.
+
+  #### Parameters
+    - `trackpoint`: The trackpoint's element
+
+  #### Returns
+    - A `tuple` with the text of each of the trackpoint's readings
+  """
+  return tuple((child.tag, "".join(child.itertext()).strip()) for child in trackpoint if child.tag != f"{{{TCX_NAMESPACE}}}Time")
+
+def preprocess_tcx(path: str, downsample: int = 0) -> dict:
+  """
+  #### Description
+  Rewrites a TCX file, or a gzip-compressed one, without duplicate nor zero-movement trackpoints, and without empty extension blocks.
+
+  #### Parameters
+    - `path`: Full path to the TCX file
+    - `downsample`: If set, trackpoints closer than this amount of seconds to the previous one kept are dropped too. Defaults to `0`
+
+  #### Returns
+    - A `dict` containing the amount of trackpoints `kept` and `dropped`, plus the resulting file's `bytes` and sha256 `checksum`
+
+  #### Notes
+  The file is parsed with `iterparse`, pruning each trackpoint as soon as it's been read, so only those kept are ever held in memory.
+  A trackpoint is considered a duplicate if it has the same time as the previous one kept, and zero-movement if all its readings match those of the previous one kept.
+  The last trackpoint of each track is always kept, so the workout's duration remains the same.
+
+  Raises an `ET.ParseError` if the file is malformed, or a `ValueError` if it isn't a TCX file with at least an activity on it.
+  """
+  opener = gzip.open if path.endswith(".gz") else open
+  trackpoint_tag = f"{{{TCX_NAMESPACE}}}Trackpoint"
+  track_tag = f"{{{TCX_NAMESPACE}}}Track"
+  kept, dropped = 0, 0
+  stack = []
+  previous_time, previous_readings = None, None # From the previous trackpoint kept
+  held_back = None # Last trackpoint dropped, restored if it turns out to be the track's last one
+  root = None
+
+  with opener(path, mode="rb") as source:
+    for event, item in ET.iterparse(source, events=("start-ns", "start", "end")):
+      if event == "start-ns":
+        try:
+          ET.register_namespace(*item)
+        except ValueError: # Prefixes reserved by ElementTree itself, like ns0
+          pass
+        continue
+
+      if event == "start":
+        if root is None:
+          root = item
+        stack.append(item)
+        continue
+
+      stack.pop()
+      parent = stack[-1] if stack else None
+
+      if item.tag == trackpoint_tag:
+        time_element = item.find(f"{{{TCX_NAMESPACE}}}Time")
+        point_time = parse_tcx_time(time_element.text) if time_element is not None and time_element.text else None
+        readings = trackpoint_readings(item)
+
+        redundant = previous_readings is not None and (
+          (point_time is not None and point_time == previous_time) or
+          readings == previous_readings or
+          (downsample > 0 and point_time is not None and previous_time is not None and point_time - previous_time < downsample)
+        )
+        if redundant:
+          parent.remove(item)
+          held_back = (parent, item)
+          dropped += 1
+        else:
+          previous_time, previous_readings = point_time, readings
+          held_back = None
+          kept += 1
+
+      elif item.tag == track_tag:
+        if held_back is not None:
+          held_back[0].append(held_back[1])
+          kept += 1
+          dropped -= 1
+        previous_time, previous_readings, held_back = None, None, None
+
+      elif item.tag.endswith("}Extensions") and len(item) == 0 and not (item.text or "").strip() and parent is not None:
+        parent.remove(item)
+
+  if root is None or root.tag != f"{{{TCX_NAMESPACE}}}TrainingCenterDatabase" or root.find(f".//{{{TCX_NAMESPACE}}}Activity") is None:
+    raise ValueError("Not a TCX file containing any activity")
+
+  # Let's write the result onto a temp file first, so the original is never left half-written
+  partfile = f"{path}.part"
+  with opener(partfile, mode="wb") as target:
+    ET.ElementTree(root).write(target, encoding="UTF-8", xml_declaration=True)
+  os.replace(partfile, path)
+
+  checksum = hashlib.sha256()
+  with open(path, mode="rb") as f:
+    for chunk in iter(lambda: f.read(65536), b""):
+      checksum.update(chunk)
+
+  return {"kept": kept, "dropped": dropped, "bytes": os.path.getsize(path), "checksum": checksum.hexdigest()}
+
+def tcx_number(element: ET.Element, path: str) -> float:
+  """
+  #### Description
+  Gets the number held by one of an element's descendants, or `None` if it's missing or empty
+  """
+  child = element.find(path)
+  text = "".join(child.itertext()).strip() if child is not None else ""
+  return float(text) if text else None
+
+def read_tcx(path: str) -> dict:
+  """
+  #### Description
+  Reads a TCX file, or a gzip-compressed one, onto an activity, as taken by `fit_file.encode_fit()`.
+
+  #### Parameters
+    - `path`: Full path to the TCX file
+
+  #### Returns
+    - The activity, as described on the `fit_file` module's docstring
+
+  #### Notes
+  The file is parsed with `iterparse`, pruning each trackpoint as soon as it's been read, so only their readings are held in memory.
+  Speed, power and running cadence are taken from garmin's `ActivityExtension` blocks, when there.
+
+  Raises an `ET.ParseError` if the file is malformed, or a `ValueError` if it doesn't hold a single activity, or it has trackpoints without a time, which FIT can't hold.
+  """
+  opener = gzip.open if path.endswith(".gz") else open
+  ns, ext = f"{{{TCX_NAMESPACE}}}", f"{{{EXTENSION_NAMESPACE}}}"
+  activity = {"sport": 0, "laps": []}
+  activities = 0
+  records = [] # Of the lap being read
+
+  with opener(path, mode="rb") as source:
+    for event, element in ET.iterparse(source, events=("start", "end")):
+      if event == "start":
+        if element.tag == f"{ns}Activity":
+          activities += 1
+          activity["sport"] = FIT_SPORTS.get(element.get("Sport"), 0)
+        continue
+
+      if element.tag == f"{ns}Trackpoint":
+        time_element = element.find(f"{ns}Time")
+        if time_element is None or not (time_element.text or "").strip():
+          raise ValueError("Found a trackpoint without a time")
+        records.append({
+          "time": parse_tcx_time(time_element.text),
+          "lat": tcx_number(element, f"{ns}Position/{ns}LatitudeDegrees"),
+          "lon": tcx_number(element, f"{ns}Position/{ns}LongitudeDegrees"),
+          "altitude": tcx_number(element, f"{ns}AltitudeMeters"),
+          "distance": tcx_number(element, f"{ns}DistanceMeters"),
+          "heart_rate": tcx_number(element, f"{ns}HeartRateBpm/{ns}Value"),
+          "cadence": tcx_number(element, f"{ns}Cadence") if element.find(f"{ns}Cadence") is not None else tcx_number(element, f".//{ext}RunCadence"),
+          "speed": tcx_number(element, f".//{ext}Speed"),
+          "power": tcx_number(element, f".//{ext}Watts")
+        })
+        element.clear()
+
+      elif element.tag == f"{ns}Lap":
+        if element.get("StartTime"):
+          start = parse_tcx_time(element.get("StartTime"))
+        elif records:
+          start = records[0]["time"]
+        else:
+          raise ValueError("Found a lap without a start time")
+        activity["laps"].append({
+          "start": start,
+          "elapsed": tcx_number(element, f"{ns}TotalTimeSeconds"),
+          "distance": tcx_number(element, f"{ns}DistanceMeters"),
+          "calories": tcx_number(element, f"{ns}Calories"),
+          "max_speed": tcx_number(element, f"{ns}MaximumSpeed"),
+          "avg_hr": tcx_number(element, f"{ns}AverageHeartRateBpm/{ns}Value"),
+          "max_hr": tcx_number(element, f"{ns}MaximumHeartRateBpm/{ns}Value"),
+          "avg_cadence": tcx_number(element, f"{ns}Cadence"),
+          "records": records
+        })
+        records = []
+        element.clear()
+
+  if activities != 1 or not activity["laps"]:
+    raise ValueError(f"Holds {activities} activities, instead of a single one with at least a lap")
+  return activity
+
+def fit_filename(filename: str) -> str:
+  """
+  #### Description
+  Gets the name a workout's FIT file is stored with, next to its TCX file. i.e. `0001-1234567-Ride.fit` for `0001-1234567-Ride.tcx.gz`
+  """
+  base = filename[:-3] if filename.endswith(".gz") else filename
+  return f"{base[:-4] if base.endswith('.tcx') else base}.fit"
+
+def convert_to_fit(path: str) -> dict:
+  """
+  #### Description
+  Converts a TCX file into a FIT file, stored next to it, keeping its laps, and each trackpoint's time, position, altitude, distance, heart rate, cadence, speed and power.
+
+  #### Parameters
+    - `path`: Full path to the TCX file, which is left in place
+
+  #### Returns
+    - A `dict` containing the FIT file's `filename` and `bytes`
+
+  #### Notes
+  Before it's written, the FIT file is decoded back and compared against the TCX file with `fit_file.verify_fit()`, so a FIT file is only ever written if nothing got lost.
+
+  Raises an `ET.ParseError` if the TCX file is malformed, or a `ValueError` if it can't be converted without losing anything.
+  """
+  activity = read_tcx(path)
+  data = fit_file.encode_fit(activity)
+  fit_file.verify_fit(activity, data)
+
+  filename = fit_filename(os.path.basename(path))
+  outputfile = f"{os.path.dirname(path)}/{filename}"
+  with open(f"{outputfile}.part", mode="wb") as target:
+    target.write(data)
+  os.replace(f"{outputfile}.part", outputfile)
+  return {"filename": filename, "bytes": len(data)}
+
+def preprocess_workout(path: str, downsample: int = 0, fit: bool = False) -> tuple:
+  """
+  #### Description
+  Preprocesses a single workout, optionally converting it into a FIT file too. Meant to be run on a process pool.
+
+  #### Parameters
+    - `path`: Full path to the TCX file
+    - `downsample`: If set, trackpoints closer than this amount of seconds to the previous one kept are dropped too. Defaults to `0`
+    - `fit`: Whether to convert it into a FIT file too, with `convert_to_fit()`. Defaults to `False`
+
+  #### Returns
+    - A tuple containing `True` and the results from `preprocess_tcx()` if successful, or `False` and the reason why the file is invalid if not.
+      When converted, the results hold those from `convert_to_fit()` as `fit`, or the reason why it couldn't be converted as `fit_error`
+  """
+  try:
+    details = preprocess_tcx(path=path, downsample=downsample)
+  except (ET.ParseError, ValueError, EOFError, OSError) as e:
+    return False, str(e)
+  if fit:
+    # A workout that can't be converted is still valid, and gets uploaded as TCX instead
+    try:
+      details["fit"] = convert_to_fit(path=path)
+    except (ET.ParseError, ValueError, struct.error, EOFError, OSError) as e:
+      details["fit_error"] = str(e)
+  return True, details
+
+def record_result(ledger: workout_ledger, workout_id: str, filename: str, result: tuple) -> bool:
+  """
+  #### Description
+  Records a workout's preprocessing result on the ledger, and reports it.
+
+  #### Parameters
+    - `ledger`: The ledger keeping track of each workout's progress
+    - `workout_id`: mapmyride's workout id
+    - `filename`: The name the workout is stored with
+    - `result`: The tuple returned by `preprocess_workout()`
+
+  #### Returns
+    - `True` if the workout is valid, `False` if not
+  """
+  valid, details = result
+  if valid:
+    print(f"🧹 Workout \"{filename}\" preprocessed. Kept {details['kept']} trackpoints, dropped {details['dropped']}")
+    if "fit" in details:
+      print(f"🗜️  Workout \"{filename}\" converted to FIT. {round(details['fit']['bytes'] / 1024, 1)} KB, from {round(details['bytes'] / 1024, 1)} KB as TCX")
+    elif "fit_error" in details:
+      print(f"⚠️  Workout \"{filename}\" couldn't be converted to FIT, so it'll be uploaded as TCX: {details['fit_error']}")
+    ledger.mark_preprocessed(workout_id=workout_id, size=details["bytes"], checksum=details["checksum"])
+  else:
+    print(f"❌ Workout \"{filename}\" is invalid, so it won't be uploaded: {details}")
+    ledger.mark_invalid(workout_id=workout_id, error=details)
+  return valid
+
+def pool_context() -> multiprocessing.context.BaseContext:
+  """
+  #### Description
+  Gets the way preprocessing processes get started. They're never forked straight from this one, since its download, upload and poller threads
+  may be holding locks, like urllib3's, SQLite's or stdout's, at that very moment, which a forked child would inherit held, and deadlock on.
+
+  They aren't started through a fork server either: the pool learns about its processes from it, so once `systemctl stop` kills it along with the rest
+  of the service, the pool takes them all for dead.
+
+  #### Returns
+    - A `spawn` context
+  """
+  return multiprocessing.get_context("spawn")
+
+def ignore_sigterm():
+  """
+  #### Description
+  Makes preprocessing processes ignore `SIGTERM`. Meant as their pool's initializer.
+
+  #### Notes
+  `systemctl stop` sends it to every process on the service, not just to this one. Stopping cleanly is up to this one, which lets the workouts in flight finish,
+  whereas a worker killed halfway breaks the whole pool.
+  """
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def preprocess_workouts(workouts_dir: str, ledger: workout_ledger, workers: int = 0, downsample: int = 0, fit: bool = False, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                        shutdown: threading.Event = None) -> bool:
+  """
+  #### Description
+  Preprocesses all downloaded workouts not preprocessed yet, across a process pool.
+
+  #### Parameters
+    - `workouts_dir`: The full path to the directory where all the TCX files reside
+    - `ledger`: The ledger keeping track of each workout's progress
+    - `workers`: Amount of processes to use. Defaults to one per CPU
+    - `downsample`: If set, trackpoints closer than this amount of seconds to the previous one kept are dropped too. Defaults to `0`
+    - `fit`: Whether to convert them into FIT files too. Defaults to `False`
+    - `shutdown`: If provided, no more workouts are submitted once it's set, though those in flight are waited for
+
+  #### Returns
+    - `True` once done. `False` if stopped early through `shutdown`, or if the pool's processes were killed
+
+  #### Notes
+  Invalid workouts are recorded as such on the ledger, so they're never uploaded. Those left over when stopped early are preprocessed on the next run.
+  """
+  if shutdown is None:
+    shutdown = threading.Event()
+  max_workers = workers or os.cpu_count() or 1
+  pending = {}
+
+  def collect(return_when: str):
+    done, _ = concurrent.futures.wait(pending, return_when=return_when)
+    for future in done:
+      workout_id, filename = pending.pop(future)
+      record_result(ledger=ledger, workout_id=workout_id, filename=filename, result=future.result())
+
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=pool_context(), initializer=ignore_sigterm) as executor:
+      for workout_id, filename in ledger.pending_preprocessing():
+        if shutdown.is_set():
+          break
+        pending[executor.submit(preprocess_workout, f"{workouts_dir}/{filename}", downsample, fit)] = (workout_id, filename)
+        # Keep only a bounded amount of workouts in flight, so stopping doesn't have to wait for all of them
+        if len(pending) >= max_workers * 2:
+          collect(return_when=concurrent.futures.FIRST_COMPLETED)
+      if pending:
+        collect(return_when=concurrent.futures.ALL_COMPLETED)
+  except BrokenProcessPool:
+    print("⚠️  The preprocessing processes were killed. The workouts left will be preprocessed on the next run")
+    return False
+  return not shutdown.is_set()
+
+def preprocess_queue(input_queue: queue.Queue, output_queue: queue.Queue, workouts_dir: str, ledger: workout_ledger, workers: int = 0, downsample: int = 0, # pylint: disable=too-many-arguments,too-many-positional-arguments
+                     fit: bool = False, shutdown: threading.Event = None):
+  """
+  #### Description
+  Preprocesses workouts across a process pool as they're taken from a queue, putting those valid onto another one. Meant to sit between the download and upload stages on pipeline mode.
+
+  #### Parameters
+    - `input_queue`: Queue to take workouts from, until a `None` is found
+    - `output_queue`: Queue to put valid workouts onto. A `None` is put onto it once done
+    - `workouts_dir`: The full path to the directory where all the TCX files reside
+    - `ledger`: The ledger keeping track of each workout's progress
+    - `workers`: Amount of processes to use. Defaults to one per CPU
+    - `downsample`: If set, trackpoints closer than this amount of seconds to the previous one kept are dropped too. Defaults to `0`
+    - `fit`: Whether to convert them into FIT files too. Defaults to `False`
+    - `shutdown`: If provided, workouts taken once it's set are left for the next run, though those in flight are waited for.
+      The input queue keeps being emptied, so the stage before doesn't block on it
+  #### Notes
+  If the pool's processes get killed, the workouts left are preprocessed on the next run instead, and the input queue keeps being emptied just the same.
+  """
+  if shutdown is None:
+    shutdown = threading.Event()
+  preprocessed = ledger.preprocessed_ids()
+  max_workers = workers or os.cpu_count() or 1
+  pending = {}
+
+  def collect(return_when: str):
+    done, _ = concurrent.futures.wait(pending, return_when=return_when)
+    for future in done:
+      workout = pending.pop(future)
+      if record_result(ledger=ledger, workout_id=workout.workout_id, filename=workout.filename, result=future.result()):
+        output_queue.put(workout)
+
+  taken_all = False
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=pool_context(), initializer=ignore_sigterm) as executor:
+      for workout in iter(input_queue.get, None):
+        if shutdown.is_set():
+          continue
+        if workout.workout_id in preprocessed:
+          output_queue.put(workout)
+          continue
+        pending[executor.submit(preprocess_workout, f"{workouts_dir}/{workout.filename}", downsample, fit)] = workout
+        # Keep only a bounded amount of workouts in flight
+        if len(pending) >= max_workers * 2:
+          collect(return_when=concurrent.futures.FIRST_COMPLETED)
+      taken_all = True
+      if pending:
+        collect(return_when=concurrent.futures.ALL_COMPLETED)
+  except BrokenProcessPool:
+    print("⚠️  The preprocessing processes were killed. The workouts left will be preprocessed on the next run")
+    # Keep taking workouts, so the stage before doesn't block on the queue
+    while not taken_all and input_queue.get() is not None:
+      pass
+  finally:
+    output_queue.put(None)
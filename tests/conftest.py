@@ -0,0 +1,7 @@
+"""
+Makes the migrator's modules, which live at the repository's root, importable from the tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,141 @@
+"""
+Checks FIT files written by `fit_file.encode_fit()` against an independent reader, fitdecode, rather than against `fit_file.decode_fit()`
+"""
+import struct
+from datetime import datetime, timezone
+import pytest
+import fit_file
+
+fitdecode = pytest.importorskip("fitdecode")
+
+ACTIVITY = {
+  "sport": 2, # Cycling
+  "laps": [
+    {"start": 1700000000, "elapsed": 60, "distance": 250.5, "calories": 12, "max_speed": 5.25, "avg_hr": 121, "max_hr": 140, "avg_cadence": 80, "records": [
+      {"time": 1700000000, "lat": 40.4168, "lon": -3.7038, "altitude": 650.2, "distance": 0, "heart_rate": 110, "cadence": 78, "speed": 4.1, "power": 180},
+      {"time": 1700000030, "lat": 40.4170, "lon": -3.7040, "altitude": 651.0, "distance": 125.25, "heart_rate": 130, "cadence": 82, "speed": 4.25, "power": None}
+    ]},
+    {"start": 1700000060, "elapsed": 30, "distance": 100, "calories": 5, "records": [
+      {"time": 1700000060, "lat": 40.4180, "lon": -3.7050, "altitude": -12.4, "distance": 250.5, "heart_rate": 142, "cadence": 85, "speed": 4.3, "power": 210}
+    ]}
+  ]
+}
+
+def reference_crc(data: bytes) -> int:
+  """
+  CRC-16/ARC, worked out bit by bit as the FIT SDK describes it, instead of with `fit_file`'s lookup table
+  """
+  crc = 0
+  for byte in data:
+    crc ^= byte
+    for _ in range(8):
+      crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+  return crc
+
+def utc(timestamp: int) -> datetime:
+  """
+  Gets a unix timestamp as the timezone-aware datetime fitdecode reads FIT timestamps as
+  """
+  return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+def read_messages(data: bytes) -> list:
+  """
+  Reads every data message off a FIT file with fitdecode, raising if any of its CRCs doesn't match
+  """
+  with fitdecode.FitReader(data, check_crc=fitdecode.CrcCheck.RAISE) as reader:
+    return [frame for frame in reader if isinstance(frame, fitdecode.FitDataMessage)]
+
+@pytest.fixture(name="data")
+def encoded_activity() -> bytes:
+  """
+  The test activity, encoded onto a FIT file
+  """
+  return fit_file.encode_fit(ACTIVITY)
+
+def test_header_and_crcs(data):
+  """
+  The header is a FIT 2.0 one, and both it and the whole file carry a valid CRC
+  """
+  header_size, protocol, _, body_size, signature, header_crc = struct.unpack("<BBHI4sH", data[:14])
+  assert (header_size, protocol, signature) == (14, 0x20, b".FIT")
+  assert body_size == len(data) - 14 - 2
+  assert header_crc == reference_crc(data[:12])
+  assert struct.unpack("<H", data[-2:])[0] == reference_crc(data[:-2])
+  assert fit_file.fit_crc(data) == 0
+
+def test_corrupted_file_is_caught(data):
+  """
+  A flipped byte is caught by the file's CRC
+  """
+  corrupted = bytearray(data)
+  corrupted[len(data) // 2] ^= 0xFF
+  with pytest.raises(fitdecode.FitCRCError):
+    read_messages(bytes(corrupted))
+
+def test_message_order(data):
+  """
+  Laps follow their records, and the file closes with the timer stopping, the session and the activity
+  """
+  assert [message.name for message in read_messages(data)] == ["file_id", "event", "record", "record", "lap", "record", "lap", "event", "session", "activity"]
+
+def test_records(data):
+  """
+  Each record's fields are written with the FIT profile's field numbers, scales and offsets
+  """
+  records = [message for message in read_messages(data) if message.name == "record"]
+  originals = [record for lap in ACTIVITY["laps"] for record in lap["records"]]
+  assert len(records) == len(originals)
+  for message, original in zip(records, originals):
+    assert {field.name: field.def_num for field in message.fields if field.name in ("timestamp", "position_lat", "position_long", "altitude", "heart_rate", "cadence",
+                                                                                     "distance", "speed", "power")} == {
+      "timestamp": 253, "position_lat": 0, "position_long": 1, "altitude": 2, "heart_rate": 3, "cadence": 4, "distance": 5, "speed": 6, "power": 7}
+    assert message.get_value("timestamp") == utc(original["time"])
+    assert message.get_raw_value("position_lat") == round(original["lat"] * 2 ** 31 / 180)
+    assert message.get_raw_value("position_long") == round(original["lon"] * 2 ** 31 / 180)
+    assert message.get_value("altitude") == pytest.approx(original["altitude"], abs=0.2)
+    assert message.get_value("distance") == pytest.approx(original["distance"], abs=0.01)
+    assert message.get_value("speed") == pytest.approx(original["speed"], abs=0.001)
+    assert message.get_value("heart_rate") == original["heart_rate"]
+    assert message.get_value("cadence") == original["cadence"]
+    assert message.get_value("power") == original["power"] # Missing readings are written as invalid, which fitdecode reads as None
+
+def test_laps(data):
+  """
+  Each lap's totals are written with the FIT profile's field numbers, scales and offsets, and those missing as invalid
+  """
+  laps = [message for message in read_messages(data) if message.name == "lap"]
+  assert len(laps) == len(ACTIVITY["laps"])
+  for message, original in zip(laps, ACTIVITY["laps"]):
+    assert message.get_value("start_time") == utc(original["start"])
+    assert message.get_value("timestamp") == utc(original["start"] + original["elapsed"])
+    assert message.get_value("total_elapsed_time") == pytest.approx(original["elapsed"])
+    assert message.get_value("total_timer_time") == pytest.approx(original["elapsed"])
+    assert message.get_value("total_distance") == pytest.approx(original["distance"])
+    assert message.get_value("total_calories") == original["calories"]
+  assert laps[0].get_value("max_speed") == pytest.approx(5.25)
+  assert (laps[0].get_value("avg_heart_rate"), laps[0].get_value("max_heart_rate"), laps[0].get_value("avg_cadence")) == (121, 140, 80)
+  assert laps[1].get_value("max_speed") is None
+
+def test_session_and_activity(data):
+  """
+  The session and activity add up the laps
+  """
+  messages = {message.name: message for message in read_messages(data)}
+  session, activity = messages["session"], messages["activity"]
+  assert session.get_value("sport") == "cycling"
+  assert session.get_value("start_time") == utc(1700000000)
+  assert session.get_value("total_elapsed_time") == pytest.approx(90)
+  assert session.get_value("total_distance") == pytest.approx(350.5)
+  assert session.get_value("total_calories") == 17
+  assert session.get_value("num_laps") == 2
+  assert activity.get_value("num_sessions") == 1
+  assert activity.get_value("total_timer_time") == pytest.approx(90)
+  assert messages["file_id"].get_value("type") == "activity"
+
+def test_out_of_range_values_are_invalid():
+  """
+  Values a field can't hold are written as invalid instead of wrapping around
+  """
+  activity = {"sport": 0, "laps": [{"start": 1700000000, "elapsed": 1, "records": [{"time": 1700000000, "altitude": 20000}]}]}
+  record = next(message for message in read_messages(fit_file.encode_fit(activity)) if message.name == "record")
+  assert record.get_value("altitude") is None
@@ -0,0 +1,53 @@
+"""
+Checks responses get streamed onto disk as `helpers.save_response_to_file()` promises
+"""
+import gzip
+import io
+import os
+import pytest
+import helpers
+
+TCX = b"<?xml version=\"1.0\"?>\n<TrainingCenterDatabase>" + b"<Trackpoint/>" * 5000 + b"</TrainingCenterDatabase>"
+EXPECT = (b"<?xml", b"<TrainingCenterDatabase")
+
+def read_file(path: str) -> bytes:
+  """
+  Reads a whole file
+  """
+  with open(path, mode="rb") as file:
+    return file.read()
+
+@pytest.mark.parametrize("body", [TCX, gzip.compress(TCX), b"\xef\xbb\xbf\r\n" + TCX])
+def test_expected_body(tmp_path, body):
+  """
+  Bodies starting as expected are saved decompressed, whether they came compressed or not, or after a byte order mark
+  """
+  outputfile = str(tmp_path / "workout.tcx")
+  size, _ = helpers.save_response_to_file(response=io.BytesIO(body), outputfile=outputfile, chunk_size=1000, expect=EXPECT)
+  assert read_file(outputfile).endswith(TCX) and size == os.path.getsize(outputfile)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_kept_compressed(tmp_path, compress):
+  """
+  Bodies are kept gzip-compressed when asked to, checked against what they hold once decompressed
+  """
+  outputfile = str(tmp_path / "workout.tcx.gz")
+  helpers.save_response_to_file(response=io.BytesIO(gzip.compress(TCX) if compress else TCX), outputfile=outputfile, compress=True, expect=EXPECT)
+  assert gzip.decompress(read_file(outputfile)) == TCX
+
+@pytest.mark.parametrize("body", [b"<!DOCTYPE html><html><body>Log in</body></html>", gzip.compress(b"<html>Log in</html>"), b""])
+def test_unexpected_body(tmp_path, body):
+  """
+  Anything else, like a login page, raises, leaving nothing behind
+  """
+  with pytest.raises(ValueError):
+    helpers.save_response_to_file(response=io.BytesIO(body), outputfile=str(tmp_path / "workout.tcx"), expect=EXPECT)
+  assert not os.listdir(tmp_path)
+
+def test_truncated_body(tmp_path):
+  """
+  A gzip stream cut short raises, leaving nothing behind
+  """
+  with pytest.raises(EOFError):
+    helpers.save_response_to_file(response=io.BytesIO(gzip.compress(TCX)[:-20]), outputfile=str(tmp_path / "workout.tcx"), expect=EXPECT)
+  assert not os.listdir(tmp_path)
@@ -0,0 +1,110 @@
+"""
+Round trips files through `multipart_upload`'s streamed bodies, parsing them back as a server would
+"""
+import email.parser
+import email.policy
+import gzip
+import os
+import pytest
+from multipart_upload import multipart_upload
+
+FIELDS = {"data_type": "tcx", "name": "Morning \"ride\"\r\n", "private": 1}
+
+def parse(upload: multipart_upload, body: bytes) -> dict:
+  """
+  Parses a body back onto its fields, each as the `bytes` it held, plus the file's name
+  """
+  headers = "".join(f"{name}: {value}\r\n" for name, value in upload.headers().items()).encode("utf8")
+  message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(headers + b"\r\n" + body)
+  assert message.is_multipart() and not message.defects
+  parts = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+  return {name: part.get_payload(decode=True) for name, part in parts.items()}, parts["file"].get_filename()
+
+@pytest.fixture(name="workout")
+def workout_file(tmp_path) -> str:
+  """
+  A workout file spanning a few chunks, holding something that looks like a boundary
+  """
+  path = str(tmp_path / "workout.tcx")
+  with open(path, mode="wb") as file:
+    file.write(os.urandom(multipart_upload.chunk_size) + b"\r\n--not-a-boundary\r\n" + os.urandom(3 * multipart_upload.chunk_size + 7))
+  return path
+
+def read_file(path: str) -> bytes:
+  """
+  Reads a whole file
+  """
+  with open(path, mode="rb") as file:
+    return file.read()
+
+def test_round_trip(workout):
+  """
+  The file and fields are parsed back as they were, and the body is as long as its Content-Length says
+  """
+  upload = multipart_upload(fields=FIELDS, file_field="file", path=workout, filename="workout.tcx", content_type="application/octet-stream")
+  body = upload.read()
+  upload.close()
+  assert int(upload.headers()["Content-Length"]) == len(body) == upload.tell()
+  fields, filename = parse(upload, body)
+  assert fields["file"] == read_file(workout)
+  assert filename == "workout.tcx"
+  assert fields["data_type"] == b"tcx" and fields["private"] == b"1"
+  assert fields["name"] == "Morning \"ride\"\r\n".encode("utf8")
+
+def test_compressed_on_the_fly(workout):
+  """
+  Files compressed on the fly are sent chunked, and decompress back onto the original
+  """
+  upload = multipart_upload(fields={"data_type": "tcx.gz"}, file_field="file", path=workout, filename="workout.tcx.gz", content_type="application/octet-stream",
+                            compress=True)
+  assert "Content-Length" not in upload.headers()
+  body = b"".join(iter(lambda: upload.read(1000), b""))
+  upload.close()
+  fields, filename = parse(upload, body)
+  assert gzip.decompress(fields["file"]) == read_file(workout)
+  assert filename == "workout.tcx.gz"
+
+def test_quoted_names(workout):
+  """
+  Names are escaped, so they can't inject headers onto the body
+  """
+  upload = multipart_upload(fields={}, file_field="file", path=workout, filename="evil\".tcx\r\nX-Injected: 1", content_type="application/octet-stream")
+  body = upload.read()
+  upload.close()
+  assert b"X-Injected: 1\r\n" not in body
+  assert parse(upload, body)[1] == "evil%22.tcx%0D%0AX-Injected: 1"
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_rewind(workout, compress):
+  """
+  Rewinding in the middle of a body sends it again from scratch
+  """
+  upload = multipart_upload(fields=FIELDS, file_field="file", path=workout, filename="workout.tcx", content_type="application/octet-stream", compress=compress)
+  first = upload.read(5000)
+  assert upload.seek(upload.tell()) == 5000 # Seeking to where it already is, as urllib3 does before sending, changes nothing
+  first += upload.read(70000)
+  assert upload.seek(0) == 0 and upload.tell() == 0
+  body = upload.read()
+  upload.close()
+  assert body.startswith(first)
+  fields, _ = parse(upload, body)
+  assert (gzip.decompress(fields["file"]) if compress else fields["file"]) == read_file(workout)
+
+def test_only_rewinds_to_its_start(workout):
+  """
+  Seeking anywhere but its start, or where it already is, raises
+  """
+  upload = multipart_upload(fields={}, file_field="file", path=workout, filename="workout.tcx", content_type="application/octet-stream")
+  upload.read(10)
+  with pytest.raises(OSError):
+    upload.seek(5)
+  with pytest.raises(OSError):
+    upload.seek(0, os.SEEK_END)
+  upload.close()
+
+def test_missing_file(tmp_path):
+  """
+  A missing file raises right away, before anything is sent
+  """
+  with pytest.raises(OSError):
+    multipart_upload(fields={}, file_field="file", path=str(tmp_path / "missing.tcx"), filename="missing.tcx", content_type="application/octet-stream")
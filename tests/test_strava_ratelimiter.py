@@ -0,0 +1,135 @@
+"""
+Checks `strava_ratelimiter`'s accounting against a frozen clock
+"""
+import time
+import types
+import pytest
+from strava_ratelimiter import strava_ratelimiter
+
+MIDNIGHT = 1700006400 # Midnight UTC, so both windows start on it
+
+@pytest.fixture(name="clock")
+def fixture_clock(monkeypatch):
+  """
+  A clock frozen at 10 minutes past midnight UTC, moved by setting its `now`
+  """
+  clock = types.SimpleNamespace(now=MIDNIGHT + 600)
+  monkeypatch.setattr(time, "time", lambda: clock.now)
+  return clock
+
+def test_next_reset():
+  """
+  Windows end at clock-aligned boundaries, and a boundary starts the next window
+  """
+  assert strava_ratelimiter.next_reset(MIDNIGHT + 600, 900) == MIDNIGHT + 900
+  assert strava_ratelimiter.next_reset(MIDNIGHT + 900, 900) == MIDNIGHT + 1800
+  assert strava_ratelimiter.next_reset(MIDNIGHT + 600, 86400) == MIDNIGHT + 86400
+
+def test_reserve_until_short_window_is_used_up(clock):
+  """
+  Tokens are taken until the 15-minute window is used up, then it tells how long until it resets
+  """
+  limiter = strava_ratelimiter(short_limit=2, daily_limit=10)
+  assert limiter.reserve() == 0
+  assert limiter.reserve() == 0
+  assert limiter.reserve() == 300 + strava_ratelimiter.reset_margin
+  assert limiter.headroom() == 0
+
+  clock.now = MIDNIGHT + 900
+  assert limiter.headroom() == 2
+  assert limiter.reserve() == 0
+  assert (limiter.short_usage, limiter.daily_usage) == (1, 3)
+
+def test_reserve_until_daily_window_is_used_up(clock):
+  """
+  Once the daily window is used up, tokens are only taken again the next day, no matter the 15-minute window
+  """
+  limiter = strava_ratelimiter(short_limit=10, daily_limit=2)
+  assert limiter.reserve() == 0 and limiter.reserve() == 0
+  assert limiter.exhausted()
+  assert limiter.reserve() == 86400 - 600 + strava_ratelimiter.reset_margin
+
+  clock.now = MIDNIGHT + 900
+  assert limiter.exhausted()
+  clock.now = MIDNIGHT + 86400
+  assert not limiter.exhausted()
+  assert limiter.reserve() == 0
+
+@pytest.mark.usefixtures("clock")
+def test_update():
+  """
+  strava's limits replace ours, while its usage never lowers our own count
+  """
+  limiter = strava_ratelimiter(short_limit=100, daily_limit=1000)
+  limiter.update({"x-ratelimit-limit": "200,2000", "x-ratelimit-usage": "50,500"})
+  assert (limiter.short_limit, limiter.daily_limit) == (200, 2000)
+  assert (limiter.short_usage, limiter.daily_usage) == (50, 500)
+  assert limiter.headroom() == 150
+
+  # Requests still in flight haven't been accounted for by strava yet
+  limiter.update({"x-ratelimit-limit": "200,2000", "x-ratelimit-usage": "40,490"})
+  assert (limiter.short_usage, limiter.daily_usage) == (50, 500)
+
+  # Responses without the headers are ignored
+  limiter.update({})
+  limiter.update({"x-ratelimit-limit": "200", "x-ratelimit-usage": "60"})
+  assert (limiter.short_limit, limiter.short_usage) == (200, 50)
+
+def test_update_after_reset(clock):
+  """
+  Usage from a window that's been reset since is dropped before syncing
+  """
+  limiter = strava_ratelimiter(short_limit=2, daily_limit=10)
+  limiter.reserve()
+  limiter.reserve()
+  clock.now = MIDNIGHT + 900
+  limiter.update({"x-ratelimit-limit": "2,10", "x-ratelimit-usage": "1,3"})
+  assert (limiter.short_usage, limiter.daily_usage) == (1, 3)
+  assert limiter.short_reset == MIDNIGHT + 1800
+
+def test_exhaust(clock):
+  """
+  A `429` empties the current 15-minute window, so requests wait for its reset
+  """
+  limiter = strava_ratelimiter(short_limit=100, daily_limit=1000)
+  limiter.exhaust()
+  assert limiter.headroom() == 0
+  assert limiter.reserve() == 300 + strava_ratelimiter.reset_margin
+  clock.now = MIDNIGHT + 900
+  assert limiter.reserve() == 0
+
+def test_time_for(clock):
+  """
+  Requests that don't fit within the current windows take until the resets they need
+  """
+  limiter = strava_ratelimiter(short_limit=100, daily_limit=1000)
+  assert limiter.time_for(100) == 0
+  assert limiter.time_for(101) == 300
+  assert limiter.time_for(250) == 300 + 900
+
+  # 100 now, 50 more once the 15-minute window resets, and the last one the next day
+  limiter = strava_ratelimiter(short_limit=100, daily_limit=150)
+  assert limiter.time_for(151) == 86400 - 600
+
+  # Its own usage counts too, and it doesn't take any token
+  limiter.reserve()
+  assert limiter.time_for(99) == 0 and limiter.time_for(100) == 300
+  assert limiter.short_usage == 1
+  clock.now = MIDNIGHT + 900
+  assert limiter.time_for(100) == 0
+
+def test_time_for_without_limits():
+  """
+  There's nothing to wait for when strava has given no limits
+  """
+  limiter = strava_ratelimiter(short_limit=0, daily_limit=0)
+  assert limiter.time_for(1000) == 0
+
+@pytest.mark.usefixtures("clock")
+def test_status():
+  """
+  Usage is described against its limits
+  """
+  limiter = strava_ratelimiter(short_limit=100, daily_limit=1000)
+  limiter.update({"x-ratelimit-limit": "100,1000", "x-ratelimit-usage": "5,50"})
+  assert limiter.status() == "15m ratelimit [used/limit]: [5/100] daily ratelimit [used/limit]: [50/1000]"
@@ -0,0 +1,87 @@
+"""
+Round trips workouts through `workout_archive`'s packs and indexes
+"""
+import gzip
+import os
+from workout_archive import workout_archive
+
+TCX = b"<?xml version=\"1.0\"?><TrainingCenterDatabase>" + b"<Trackpoint/>" * 200 + b"</TrainingCenterDatabase>"
+
+def write(path: str, data: bytes) -> str:
+  """
+  Writes a file, returning its path
+  """
+  with open(path, mode="wb") as file:
+    file.write(data)
+  return path
+
+def test_round_trip(tmp_path):
+  """
+  Workouts read back as they were added, whether they were compressed or not, also once the archive is reopened
+  """
+  archive = workout_archive(str(tmp_path / "archive"))
+  archive.add("101", write(str(tmp_path / "plain.tcx"), TCX))
+  archive.add("102", write(str(tmp_path / "compressed.tcx.gz"), gzip.compress(TCX + b"<!-- 102 -->")))
+  assert archive.read("101") == TCX
+  assert archive.read("102") == TCX + b"<!-- 102 -->"
+  assert gzip.decompress(archive.read("101", decompress=False)) == TCX
+  assert archive.read("103") is None
+
+  # Everything's found again once reopened, and the pack is still a plain gzip stream
+  reopened = workout_archive(str(tmp_path / "archive"))
+  assert len(reopened) == 2 and "101" in reopened and "102" in reopened
+  assert reopened.read("102") == TCX + b"<!-- 102 -->"
+  with gzip.open(reopened.pack_file(1), mode="rb") as pack:
+    assert pack.read() == TCX + TCX + b"<!-- 102 -->"
+
+def test_extract(tmp_path):
+  """
+  Workouts get extracted onto plain TCX files
+  """
+  archive = workout_archive(str(tmp_path / "archive"))
+  archive.add("101", write(str(tmp_path / "plain.tcx"), TCX))
+  with open(archive.extract("101", str(tmp_path)), mode="rb") as file:
+    assert file.read() == TCX
+  assert archive.extract("103", str(tmp_path)) == ""
+
+def test_torn_index_record(tmp_path):
+  """
+  A record left incomplete by an interrupted write is ignored, and doesn't misalign those written after it
+  """
+  archive = workout_archive(str(tmp_path / "archive"))
+  archive.add("101", write(str(tmp_path / "plain.tcx"), TCX))
+  # An interrupted write leaves part of a record behind
+  with open(archive.index_file(1), mode="ab") as file:
+    file.write(b"\x01\x02\x03")
+
+  reopened = workout_archive(str(tmp_path / "archive"))
+  assert len(reopened) == 1 and reopened.read("101") == TCX
+  reopened.add("102", write(str(tmp_path / "other.tcx"), TCX + b"<!-- 102 -->"))
+  assert os.path.getsize(reopened.index_file(1)) == 2 * workout_archive.record.size
+  again = workout_archive(str(tmp_path / "archive"))
+  assert again.read("101") == TCX and again.read("102") == TCX + b"<!-- 102 -->"
+
+def test_new_pack_once_full(tmp_path):
+  """
+  A new pack is started once the current one reaches its size
+  """
+  archive = workout_archive(str(tmp_path / "archive"))
+  archive.pack_size = 1
+  for workout_id in ("101", "102", "103"):
+    archive.add(workout_id, write(str(tmp_path / f"{workout_id}.tcx"), TCX + workout_id.encode("utf8")))
+  assert archive.packs == [1, 2, 3]
+  reopened = workout_archive(str(tmp_path / "archive"))
+  assert [reopened.read(workout_id) for workout_id in ("101", "102", "103")] == [TCX + b"101", TCX + b"102", TCX + b"103"]
+
+def test_pack_loose_files(tmp_path):
+  """
+  Workouts archived as loose files are moved onto the packs, leaving anything else alone
+  """
+  archive_dir = tmp_path / "archive"
+  archive = workout_archive(str(archive_dir))
+  write(str(archive_dir / "2024-101-ride.tcx"), TCX)
+  write(str(archive_dir / "2024-102-ride.tcx.gz"), gzip.compress(TCX))
+  write(str(archive_dir / "notes.txt"), b"Not a workout")
+  assert archive.pack_loose_files() == 2
+  assert sorted(os.listdir(archive_dir)) == ["notes.txt", "pack-0001.idx", "pack-0001.pack"]
+  assert archive.read("101") == TCX and archive.read("102") == TCX
@@ -0,0 +1,167 @@
+"""
+Walks workouts through `workout_ledger`'s states, with a frozen clock
+"""
+import time
+import types
+import pytest
+from mmr_workout import mmr_workout
+from workout_ledger import workout_ledger
+
+NOW = 1700000000
+
+@pytest.fixture(name="clock")
+def fixture_clock(monkeypatch):
+  """
+  A frozen clock, moved by setting its `now`
+  """
+  clock = types.SimpleNamespace(now=NOW)
+  monkeypatch.setattr(time, "time", lambda: clock.now)
+  return clock
+
+@pytest.fixture(name="ledger")
+def fixture_ledger(tmp_path):
+  """
+  A new ledger, with three workouts registered, closed once the test is done
+  """
+  ledger = workout_ledger(workouts_dir=str(tmp_path))
+  ledger.register(workouts=[workout(workout_id) for workout_id in ("101", "102", "103")])
+  yield ledger
+  ledger.close()
+
+def workout(workout_id: str, date: int = 0) -> mmr_workout:
+  """
+  Builds a workout as listed on mapmyride's CSV file
+  """
+  return mmr_workout(workout_id=workout_id, date=date, workout_type="Road Cycling", notes="", link=f"https://www.mapmyride.com/workout/{workout_id}/",
+                     seq=int(workout_id) - 100)
+
+def row(ledger: workout_ledger, workout_id: str) -> tuple:
+  """
+  Gets a workout's `(status, error, attempts, updated_at)`
+  """
+  return ledger.db.execute("SELECT status, error, attempts, updated_at FROM workouts WHERE workout_id = ?", (workout_id,)).fetchone()
+
+def download(tmp_path, ledger: workout_ledger, workout_id: str) -> str:
+  """
+  Stores a workout on disk, and records it as downloaded
+  """
+  filename = f"000{int(workout_id) - 100}-{workout_id}-Road-Cycling.tcx"
+  (tmp_path / filename).write_bytes(b"<?xml version=\"1.0\"?><TrainingCenterDatabase/>")
+  ledger.mark_downloaded(workout_id=workout_id, filename=filename, size=48, checksum="sum")
+  return filename
+
+def test_register(ledger):
+  """
+  Registered workouts start as pending, and registering them again refreshes their details without touching their state
+  """
+  assert ledger.states() == {"101": ("pending", None), "102": ("pending", None), "103": ("pending", None)}
+  assert ledger.registered_ids() == {"101", "102", "103"}
+
+  ledger.mark_processed(workout_id="101", activity_id=1)
+  ledger.register(workouts=[workout("101", date=5)])
+  assert ledger.states()["101"] == ("processed", None)
+  assert ledger.db.execute("SELECT workout_date FROM workouts WHERE workout_id = '101'").fetchone() == (5,)
+  assert ledger.states(unfinished_only=True) == {"102": ("pending", None), "103": ("pending", None)}
+
+def test_upload_lifecycle(tmp_path, ledger, clock):
+  """
+  A workout goes from pending to downloaded, preprocessed, uploaded and processed, each change stamped with the time it happened
+  """
+  filename = download(tmp_path, ledger, "101")
+  assert ledger.states()["101"] == ("downloaded", filename)
+  assert ledger.pending_preprocessing() == [("101", filename)]
+
+  clock.now = NOW + 10
+  ledger.mark_preprocessed(workout_id="101", size=40, checksum="other")
+  assert not ledger.pending_preprocessing() and ledger.preprocessed_ids() == {"101"}
+  assert [(upload.workout_id, upload.filename) for upload in ledger.pending_uploads()] == [("101", filename)]
+
+  clock.now = NOW + 20
+  ledger.mark_uploaded(workout_id="101", upload_id=7)
+  assert not ledger.pending_uploads() and ledger.unresolved_uploads() == [("101", 7)]
+  assert row(ledger, "101") == ("uploaded", None, 0, NOW + 20)
+
+  clock.now = NOW + 30
+  ledger.mark_processed(workout_id="101", activity_id=8)
+  assert not ledger.unresolved_uploads()
+  assert row(ledger, "101") == ("processed", None, 0, NOW + 30)
+  assert ledger.counts() == {"pending": 2, "processed": 1}
+
+def test_missing_file_goes_back_to_pending(tmp_path, ledger):
+  """
+  A workout recorded as downloaded whose file is gone is pending again, so it's downloaded on the next run
+  """
+  filename = download(tmp_path, ledger, "101")
+  ledger.mark_preprocessed(workout_id="101", size=40, checksum="other")
+  (tmp_path / filename).unlink()
+  assert ledger.states(unfinished_only=True)["101"] == ("pending", None)
+  assert row(ledger, "101")[:2] == ("pending", f"download: file \"{filename}\" went missing")
+  assert not ledger.preprocessed_ids()
+
+def test_rejections(tmp_path, ledger):
+  """
+  strava's rejections are final, and those mentioning a duplicate are recorded as such
+  """
+  for workout_id in ("101", "102", "103"):
+    download(tmp_path, ledger, workout_id)
+  ledger.mark_failed(workout_id="101", error="Error parsing file")
+  ledger.mark_failed(workout_id="102", error="file.tcx duplicate of activity 5")
+  ledger.mark_rejected(workout_id="103", error="HTTP 400")
+  assert [row(ledger, workout_id)[:3] for workout_id in ("101", "102", "103")] == [
+    ("failed", "Error parsing file", 0), ("duplicate", "file.tcx duplicate of activity 5", 0), ("rejected", "HTTP 400", 1)]
+  assert not ledger.states(unfinished_only=True)
+
+def test_transient_errors(tmp_path, ledger, clock):
+  """
+  Transient errors keep the workout's state, counting attempts until it moves on, and only stuck workouts are reported as failures
+  """
+  ledger.mark_error(workout_id="101", error="download: HTTP 503")
+  clock.now = NOW + 10
+  ledger.mark_error(workout_id="101", error="download: HTTP 502")
+  assert row(ledger, "101") == ("pending", "download: HTTP 502", 2, NOW + 10)
+
+  filename = download(tmp_path, ledger, "102")
+  ledger.mark_invalid(workout_id="102", error="preprocess: no trackpoints")
+  ledger.mark_duplicate(workout_id="103", activity_id=9)
+  assert ledger.failures() == [("101", "", "pending", 2, "download: HTTP 502"), ("102", filename, "invalid", 0, "preprocess: no trackpoints")]
+
+  # Moving onto its next state clears the error
+  download(tmp_path, ledger, "101")
+  assert row(ledger, "101")[:3] == ("downloaded", None, 2)
+  assert ledger.failures() == [("102", filename, "invalid", 0, "preprocess: no trackpoints")]
+
+def test_import_files(tmp_path):
+  """
+  Workouts left on disk before the ledger existed are imported as downloaded, or as uploaded if archived, but not as registered
+  """
+  (tmp_path / "archive").mkdir()
+  (tmp_path / "0001-101-Road-Cycling.tcx").write_bytes(b"<TrainingCenterDatabase/>")
+  (tmp_path / "archive" / "0002-102-Road-Cycling.tcx.gz").write_bytes(b"\x1f\x8b")
+  (tmp_path / "notes.txt").write_bytes(b"Not a workout")
+  ledger = workout_ledger(workouts_dir=str(tmp_path))
+  assert ledger.states() == {"101": ("downloaded", "0001-101-Road-Cycling.tcx"), "102": ("uploaded", "0002-102-Road-Cycling.tcx.gz")}
+  assert not ledger.registered_ids()
+  ledger.close()
+
+def test_sync_state(tmp_path, clock):
+  """
+  Syncs are recorded with their time, and the watermark is only ever raised, also once the ledger is reopened
+  """
+  ledger = workout_ledger(workouts_dir=str(tmp_path))
+  assert ledger.last_sync() == 0 and ledger.watermark() == 0
+  ledger.record_sync(new_workouts=3, watermark=103)
+  clock.now = NOW + 60
+  ledger.record_sync(new_workouts=0, watermark=0)
+  assert ledger.last_sync() == NOW + 60 and ledger.watermark() == 103
+  ledger.close()
+
+  reopened = workout_ledger(workouts_dir=str(tmp_path))
+  assert reopened.last_sync() == NOW + 60 and reopened.watermark() == 103
+  reopened.close()
+
+def test_watermark_from_older_ledgers(ledger):
+  """
+  Ledgers synced before the watermark was recorded take it from their highest workout id
+  """
+  ledger.db.execute("INSERT INTO sync_state (key, value) VALUES ('last_sync', ?)", (str(NOW),))
+  assert ledger.watermark() == 103
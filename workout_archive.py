@@ -0,0 +1,169 @@
+"""
+This module contains the packed archive where finished workouts are kept, instead of as loose files
+"""
+import gzip
+import mmap
+import os
+import re
+import struct
+import threading
+
+class workout_archive:
+  """
+  #### Description
+  Finished workouts, appended into a few large pack files, each with a compact index to extract any of them by its mapmyride id.
+
+  #### Notes
+  Each pack, `pack-NNNN.pack`, is a plain concatenation of gzip members, one per workout, so it can still be read as a whole with `zcat`.
+  Workouts already stored gzip-compressed are appended as they are, and the rest get compressed on their way in.
+  Once a pack grows beyond `pack_size`, a new one is started.
+
+  Next to each pack, `pack-NNNN.idx` holds a fixed-size `(workout id, offset, length)` record per workout. Records are only written once their workout
+  is fully on its pack, so an interrupted write never leaves a record pointing to a truncated workout. All indexes are loaded onto memory when opened,
+  and workouts are read straight from their pack, memory-mapped, without reading anything else.
+
+  mapmyride's workout ids are numeric, so they're stored as such. It's thread-safe, so a single instance can be shared by everything finishing workouts.
+  """
+  pack_size = 256 * 1024 * 1024 # Bytes a pack grows to before a new one is started
+  record = struct.Struct("<QQI") # Workout id, offset and length of each workout on its pack
+  pack_name = re.compile(r"pack-(\d{4})\.pack")
+
+  def __init__(self, archive_dir: str):
+    """
+    #### Description
+    Opens the archive stored on a given directory, creating it if it doesn't exist yet
+    #### Parameters
+    - `archive_dir`: The full path to the directory where packs are stored
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    self.archive_dir = archive_dir
+    self.lock = threading.Lock()
+    self.index = {} # Workout id -> (pack number, offset, length)
+    self.packs = sorted(int(match.group(1)) for match in map(self.pack_name.fullmatch, os.listdir(archive_dir)) if match)
+    for pack in self.packs:
+      self.load_index(pack)
+    if not self.packs:
+      self.packs.append(1)
+
+  def pack_file(self, pack: int) -> str:
+    """
+    #### Description
+    Gets the full path to a pack
+    """
+    return f"{self.archive_dir}/pack-{pack:04}.pack"
+
+  def index_file(self, pack: int) -> str:
+    """
+    #### Description
+    Gets the full path to a pack's index
+    """
+    return f"{self.archive_dir}/pack-{pack:04}.idx"
+
+  def load_index(self, pack: int):
+    """
+    #### Description
+    Loads a pack's index onto memory, dropping any record left incomplete by an interrupted write
+    #### Parameters
+    - `pack`: The pack's number
+    """
+    if not os.path.isfile(self.index_file(pack)):
+      return
+    with open(self.index_file(pack), mode="rb") as file:
+      data = file.read()
+    complete = len(data) - len(data) % self.record.size
+    for workout_id, offset, length in self.record.iter_unpack(data[:complete]):
+      self.index[str(workout_id)] = (pack, offset, length)
+
+  def __contains__(self, workout_id: str) -> bool:
+    return workout_id in self.index
+
+  def __len__(self) -> int:
+    return len(self.index)
+
+  def add(self, workout_id: str, path: str):
+    """
+    #### Description
+    Appends a workout onto the current pack, then records it on its index
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `path`: Full path to the workout's file, either plain or gzip-compressed. It's left in place
+    """
+    with open(path, mode="rb") as file:
+      data = file.read()
+    if data[:2] != b"\x1f\x8b":
+      data = gzip.compress(data, mtime=0)
+
+    with self.lock:
+      pack = self.packs[-1]
+      if os.path.isfile(self.pack_file(pack)) and os.path.getsize(self.pack_file(pack)) >= self.pack_size:
+        pack += 1
+        self.packs.append(pack)
+      with open(self.pack_file(pack), mode="ab") as file:
+        offset = file.tell()
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+      with open(self.index_file(pack), mode="ab") as file:
+        # Whatever an interrupted write left behind is skipped over, so records stay aligned
+        file.truncate(os.path.getsize(self.index_file(pack)) // self.record.size * self.record.size)
+        file.seek(0, os.SEEK_END)
+        file.write(self.record.pack(int(workout_id), offset, len(data)))
+      self.index[workout_id] = (pack, offset, len(data))
+
+  def pack_loose_files(self) -> int:
+    """
+    #### Description
+    Moves the workouts archived as loose files, by previous versions or runs not packing them, onto the packs
+    #### Returns
+    - The amount of workouts moved
+    """
+    moved = 0
+    for filename in sorted(os.listdir(self.archive_dir)):
+      if not filename.endswith((".tcx", ".tcx.gz")) or filename.count("-") < 2:
+        continue
+      workout_id = filename.split("-")[1]
+      if not workout_id.isdigit():
+        continue
+      if workout_id not in self.index:
+        self.add(workout_id=workout_id, path=f"{self.archive_dir}/{filename}")
+      os.remove(f"{self.archive_dir}/{filename}")
+      moved += 1
+    return moved
+
+  def read(self, workout_id: str, decompress: bool = True) -> bytes:
+    """
+    #### Description
+    Reads a single workout from its pack
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `decompress`: Whether to return it as plain TCX, instead of gzip-compressed. Defaults to `True`
+    #### Returns
+    - The workout's `bytes`, or `None` if it's not on the archive
+    """
+    with self.lock:
+      location = self.index.get(workout_id)
+    if location is None:
+      return None
+    pack, offset, length = location
+    with open(self.pack_file(pack), mode="rb") as file:
+      with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as packed:
+        data = packed[offset:offset + length]
+    return gzip.decompress(data) if decompress else data
+
+  def extract(self, workout_id: str, output_dir: str) -> str:
+    """
+    #### Description
+    Extracts a single workout from its pack onto a TCX file
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `output_dir`: Directory where to write the workout to, as `{workout_id}.tcx`
+    #### Returns
+    - The full path to the extracted workout, or an `empty string` if it's not on the archive
+    """
+    data = self.read(workout_id)
+    if data is None:
+      return ""
+    outputfile = f"{output_dir}/{workout_id}.tcx"
+    with open(outputfile, mode="wb") as file:
+      file.write(data)
+    return outputfile
@@ -0,0 +1,417 @@
+"""
+This module contains the ledger that keeps track of each workout's migration progress
+"""
+import os
+import sqlite3
+import threading
+import time
+from mmr_workout import mmr_workout
+
+class workout_ledger: # pylint: disable=too-many-public-methods
+  """
+  #### Description
+  A small SQLite database, keyed by mapmyride's workout id, recording each workout's progress through the migration.
+
+  #### Notes
+  A workout goes through the following states:
+    - `pending`: Listed on mapmyride's CSV file, but not downloaded yet
+    - `downloaded`: Stored on disk, waiting to be uploaded
+    - `uploaded`: Accepted by strava, which returned an upload id for it, but still waiting to be processed
+    - `processed`: Turned into a strava activity, whose id is recorded
+    - `duplicate`: Rejected by strava, or skipped before being uploaded, since it's a duplicate of an existing activity. Its id is recorded if known
+    - `failed`: Rejected by strava while being processed. i.e. due to a parse error. Strava's error is recorded
+    - `invalid`: Found to be malformed while being preprocessed, so it's never uploaded. The reason why is recorded
+    - `rejected`: Refused by strava when uploaded, i.e. with a `400`, so it's never uploaded again. Strava's error is recorded
+
+  Transient errors, like a download or upload that kept failing after being retried, don't change a workout's state, so it's retried on the next run.
+  The last one is recorded along with how many attempts have failed so far, until the workout moves onto its next state.
+
+  It's thread-safe, so a single instance can be shared by all download and upload workers.
+  """
+  db_name = "ledger.sqlite3"
+
+  def __init__(self, workouts_dir: str):
+    """
+    #### Description
+    Opens the ledger stored on a given directory, creating it if it doesn't exist yet
+    #### Parameters
+    - `workouts_dir`: The full path to the directory where all the TCX files reside
+    #### Notes
+    When the ledger is created, any workouts already on disk from previous runs get imported onto it, so those aren't downloaded nor uploaded again
+    """
+    db_file = f"{workouts_dir}/{self.db_name}"
+    is_new = not os.path.isfile(db_file)
+    self.workouts_dir = workouts_dir
+
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(db_file, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("""
+      CREATE TABLE IF NOT EXISTS workouts (
+        workout_id TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL DEFAULT 0,
+        workout_date INTEGER NOT NULL DEFAULT 0,
+        link TEXT NOT NULL DEFAULT '',
+        notes TEXT NOT NULL DEFAULT '',
+        workout_type TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT 'pending',
+        filename TEXT,
+        bytes INTEGER,
+        checksum TEXT,
+        upload_id INTEGER,
+        activity_id INTEGER,
+        error TEXT,
+        preprocessed INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL
+      )""")
+    self.db.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    self.migrate()
+    self.db.execute("CREATE INDEX IF NOT EXISTS workouts_by_status ON workouts (status)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS workouts_by_date ON workouts (status, workout_date)")
+    self.db.commit()
+
+    if is_new:
+      self.import_files(workouts_dir)
+
+  def migrate(self):
+    """
+    #### Description
+    Adds any columns missing from ledgers created by previous versions
+    """
+    columns = {row[1] for row in self.db.execute("PRAGMA table_info(workouts)")}
+    for column, definition in (("error", "TEXT"), ("preprocessed", "INTEGER NOT NULL DEFAULT 0"), ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                               ("workout_date", "INTEGER NOT NULL DEFAULT 0")):
+      if column not in columns:
+        self.db.execute(f"ALTER TABLE workouts ADD COLUMN {column} {definition}")
+
+  def import_files(self, workouts_dir: str):
+    """
+    #### Description
+    Records the workouts left on disk by runs made before the ledger existed
+    #### Parameters
+    - `workouts_dir`: The full path to the directory where all the TCX files reside. Those in its `archive` folder are considered as uploaded
+    """
+    for directory, status in ((workouts_dir, "downloaded"), (f"{workouts_dir}/archive", "uploaded")):
+      if not os.path.isdir(directory):
+        continue
+      for filename in os.listdir(directory):
+        if not filename.endswith((".tcx", ".tcx.gz")) or filename.count("-") < 2:
+          continue
+        seq, workout_id = filename.split("-")[0:2]
+        with self.lock:
+          self.db.execute("INSERT OR REPLACE INTO workouts (workout_id, seq, status, filename, bytes, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                          (workout_id, int(seq) if seq.isdigit() else 0, status, filename, os.path.getsize(f"{directory}/{filename}"), time.time()))
+    with self.lock:
+      self.db.commit()
+
+  def register(self, workouts: list):
+    """
+    #### Description
+    Adds workouts from mapmyride's CSV file to the ledger, in a single statement, or refreshes their details if they're already there
+    #### Parameters
+    - `workouts`: The `mmr_workout` records, as generated by the `list_mmr_workouts()` function
+    #### Notes
+    Changes aren't committed right away, but along with the next state change, so registering thousands of workouts stays cheap
+    """
+    if not workouts:
+      return
+    with self.lock:
+      self.db.executemany("""
+        INSERT INTO workouts (workout_id, seq, workout_date, link, notes, workout_type, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (workout_id) DO UPDATE SET seq = excluded.seq, workout_date = excluded.workout_date, link = excluded.link, notes = excluded.notes,
+          workout_type = excluded.workout_type
+        """, [(workout.workout_id, workout.seq, workout.date, workout.link, workout.notes, workout.workout_type, time.time()) for workout in workouts])
+
+  def registered_ids(self) -> set:
+    """
+    #### Description
+    Gets the ids of all workouts registered from mapmyride's CSV file, as opposed to those only known from files left on disk by runs made before the ledger existed
+    #### Returns
+    - A `set` with their mapmyride workout ids
+    """
+    with self.lock:
+      return {row[0] for row in self.db.execute("SELECT workout_id FROM workouts WHERE link != ''")}
+
+  def states(self, unfinished_only: bool = False) -> dict:
+    """
+    #### Description
+    Gets the state of every workout on the ledger, with a single query
+    #### Parameters
+    - `unfinished_only`: Whether to only get those still `pending` or `downloaded`, leaving out those already dealt with. Defaults to `False`
+    #### Returns
+    - A `dict` using the workout id as key, and a `(status, filename)` tuple as value
+    #### Notes
+    Workouts recorded as downloaded whose file is gone from disk are reset to `pending` first, so they get downloaded again
+    """
+    query = "SELECT workout_id, status, filename FROM workouts" + (" WHERE status IN ('pending', 'downloaded')" if unfinished_only else "")
+    with self.lock:
+      states = {row[0]: (row[1], row[2]) for row in self.db.execute(query)}
+    for workout_id, (status, filename) in states.items():
+      if status == "downloaded" and not (filename and os.path.isfile(f"{self.workouts_dir}/{filename}")):
+        self.mark_pending(workout_id=workout_id, error=f"download: file \"{filename}\" went missing")
+        states[workout_id] = ("pending", None)
+    return states
+
+  def mark_downloaded(self, workout_id: str, filename: str, size: int, checksum: str):
+    """
+    #### Description
+    Records a workout as stored on disk
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `filename`: The name the workout was stored with
+    - `size`: The file's size, in bytes
+    - `checksum`: The file's sha256 checksum
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'downloaded', filename = ?, bytes = ?, checksum = ?, error = NULL, updated_at = ? WHERE workout_id = ?",
+                      (filename, size, checksum, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_preprocessed(self, workout_id: str, size: int, checksum: str):
+    """
+    #### Description
+    Records a workout as preprocessed, along with its new size and checksum
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `size`: The preprocessed file's size, in bytes
+    - `checksum`: The preprocessed file's sha256 checksum
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET preprocessed = 1, bytes = ?, checksum = ?, updated_at = ? WHERE workout_id = ?",
+                      (size, checksum, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_invalid(self, workout_id: str, error: str):
+    """
+    #### Description
+    Records a workout as malformed, so it's never uploaded
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `error`: The reason why it's malformed
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'invalid', error = ?, updated_at = ? WHERE workout_id = ?",
+                      (error, time.time(), workout_id))
+      self.db.commit()
+
+  def pending_preprocessing(self) -> list:
+    """
+    #### Description
+    Gets all workouts stored on disk that haven't been preprocessed yet
+    #### Returns
+    - A `list` with each workout as a `(workout_id, filename)` tuple
+    """
+    with self.lock:
+      return self.db.execute("SELECT workout_id, filename FROM workouts WHERE status = 'downloaded' AND preprocessed = 0").fetchall()
+
+  def preprocessed_ids(self) -> set:
+    """
+    #### Description
+    Gets the ids of all workouts already preprocessed
+    #### Returns
+    - A `set` with their mapmyride workout ids
+    """
+    with self.lock:
+      return {row[0] for row in self.db.execute("SELECT workout_id FROM workouts WHERE preprocessed = 1")}
+
+  def mark_uploaded(self, workout_id: str, upload_id: int):
+    """
+    #### Description
+    Records a workout as accepted by strava
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `upload_id`: The upload id returned by strava
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'uploaded', upload_id = ?, error = NULL, updated_at = ? WHERE workout_id = ?",
+                      (upload_id, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_processed(self, workout_id: str, activity_id: int):
+    """
+    #### Description
+    Records a workout as turned into a strava activity
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `activity_id`: The id of the activity created by strava
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'processed', activity_id = ?, error = NULL, updated_at = ? WHERE workout_id = ?",
+                      (activity_id, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_failed(self, workout_id: str, error: str):
+    """
+    #### Description
+    Records a workout as rejected by strava while being processed
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `error`: The error returned by strava. Workouts whose error mentions a duplicate are recorded as such
+    """
+    status = "duplicate" if "duplicate" in error.lower() else "failed"
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = ?, error = ?, updated_at = ? WHERE workout_id = ?",
+                      (status, error, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_rejected(self, workout_id: str, error: str):
+    """
+    #### Description
+    Records a workout as refused by strava when uploaded, so no more requests are spent on it
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `error`: The error returned by strava
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'rejected', error = ?, attempts = attempts + 1, updated_at = ? WHERE workout_id = ?",
+                      (error, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_duplicate(self, workout_id: str, activity_id: int):
+    """
+    #### Description
+    Records a workout as skipped, since it's already on strava
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `activity_id`: The id of the matching strava activity
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'duplicate', activity_id = ?, updated_at = ? WHERE workout_id = ?",
+                      (activity_id, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_pending(self, workout_id: str, error: str):
+    """
+    #### Description
+    Records a workout as pending again, i.e. once its file has gone missing from disk, so it's downloaded again on the next run
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `error`: Why it's pending again
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET status = 'pending', filename = NULL, preprocessed = 0, error = ?, updated_at = ? WHERE workout_id = ?",
+                      (error, time.time(), workout_id))
+      self.db.commit()
+
+  def mark_error(self, workout_id: str, error: str):
+    """
+    #### Description
+    Records a transient error on a workout, without changing its state, so it's retried later on
+    #### Parameters
+    - `workout_id`: mapmyride's workout id
+    - `error`: What went wrong, prefixed by the stage it happened on. i.e. `download: HTTP 503`
+    """
+    with self.lock:
+      self.db.execute("UPDATE workouts SET error = ?, attempts = attempts + 1, updated_at = ? WHERE workout_id = ?",
+                      (error, time.time(), workout_id))
+      self.db.commit()
+
+  def failures(self) -> list:
+    """
+    #### Description
+    Gets all workouts that are stuck due to an error, whether transient or not
+    #### Returns
+    - A `list` with each workout as a `(workout_id, filename, status, attempts, error)` tuple
+    """
+    with self.lock:
+      return self.db.execute("""
+        SELECT workout_id, COALESCE(filename, ''), status, attempts, error FROM workouts
+        WHERE error IS NOT NULL AND status IN ('pending', 'downloaded', 'failed', 'invalid', 'rejected') ORDER BY seq""").fetchall()
+
+  def unresolved_uploads(self) -> list:
+    """
+    #### Description
+    Gets all workouts accepted by strava whose processing outcome is still unknown
+    #### Returns
+    - A `list` with each workout as a `(workout_id, upload_id)` tuple
+    """
+    with self.lock:
+      return self.db.execute("SELECT workout_id, upload_id FROM workouts WHERE status = 'uploaded' AND upload_id IS NOT NULL").fetchall()
+
+  def pending_uploads(self, newest_first: bool = False) -> list:
+    """
+    #### Description
+    Gets all workouts stored on disk that haven't been uploaded yet, in chronological order
+    #### Parameters
+    - `newest_first`: Whether to begin with the most recent workout, instead of the oldest one. Defaults to `False`
+    #### Returns
+    - A `list` of `mmr_workout` records, with their `filename` set
+    #### Notes
+    Workouts whose date is unknown, like those imported from files left by versions prior to the ledger, are sorted as the oldest ones
+    """
+    order = "DESC" if newest_first else "ASC"
+    with self.lock:
+      rows = self.db.execute(f"""
+        SELECT workout_id, workout_date, workout_type, notes, link, seq, filename FROM workouts WHERE status = 'downloaded'
+        ORDER BY workout_date {order}, CAST(workout_id AS INTEGER) {order}""").fetchall()
+    return [mmr_workout(*row) for row in rows]
+
+  def record_sync(self, new_workouts: int, watermark: int = 0):
+    """
+    #### Description
+    Records a finished pass over mapmyride's CSV file
+    #### Parameters
+    - `new_workouts`: Amount of workouts found that weren't known by the ledger yet
+    - `watermark`: The highest workout id gone through. It's only ever raised
+    """
+    with self.lock:
+      self.db.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                          (("last_sync", str(time.time())), ("last_sync_new_workouts", str(new_workouts))))
+      self.db.execute("INSERT INTO sync_state (key, value) VALUES ('watermark', ?) ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                      (watermark,))
+      self.db.commit()
+
+  def watermark(self) -> int:
+    """
+    #### Description
+    Gets the highest workout id gone through by past syncs. mapmyride assigns ids incrementally, so any workout added since then has a higher one
+    #### Returns
+    - The workout id, as an `int`. `0` if there's been no sync yet
+    #### Notes
+    Ledgers synced by versions that didn't record it get it from their workouts instead, since those syncs registered every workout listed
+    """
+    with self.lock:
+      row = self.db.execute("SELECT value FROM sync_state WHERE key = 'watermark'").fetchone()
+      if row is None and self.db.execute("SELECT 1 FROM sync_state WHERE key = 'last_sync'").fetchone():
+        row = self.db.execute("SELECT MAX(CAST(workout_id AS INTEGER)) FROM workouts").fetchone()
+    return int(row[0] or 0) if row else 0
+
+  def last_sync(self) -> float:
+    """
+    #### Description
+    Gets when mapmyride's CSV file was last fully gone through
+    #### Returns
+    - The last sync's time, as a `unix timestamp`. `0` if there's been none yet
+    """
+    with self.lock:
+      row = self.db.execute("SELECT value FROM sync_state WHERE key = 'last_sync'").fetchone()
+    return float(row[0]) if row else 0
+
+  def counts(self) -> dict:
+    """
+    #### Description
+    Counts how many workouts are on each state
+    #### Returns
+    - A `dict` using each state as key, and its amount of workouts as value
+    """
+    with self.lock:
+      return dict(self.db.execute("SELECT status, COUNT(*) FROM workouts GROUP BY status").fetchall())
+
+  def commit(self):
+    """
+    #### Description
+    Commits any changes not committed yet, like freshly registered workouts
+    """
+    with self.lock:
+      self.db.commit()
+
+  def close(self):
+    """
+    #### Description
+    Commits any pending changes and closes the ledger
+    """
+    with self.lock:
+      self.db.commit()
+      self.db.close()